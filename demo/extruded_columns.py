@@ -0,0 +1,118 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""PyOP2 column vectorisation benchmark
+
+Times loops over the cells of an extruded structured mesh of
+quadrilaterals (an interval mesh extruded vertically), walking up the
+columns or with ``vectorise_columns``.  The first loop writes the area
+of each cell, the second increments a discontinuous field with four
+values per cell.
+"""
+
+from __future__ import print_function
+from pyop2 import op2, utils
+import numpy as np
+from time import time
+
+parser = utils.parser(group=True, description=__doc__)
+parser.add_argument('-c', '--cells', action='store', default=1 << 20, type=int,
+                    help='total number of cells')
+parser.add_argument('-ll', '--layers', action='store', default=64, type=int,
+                    help='number of cells in each column')
+parser.add_argument('-r', '--repeats', action='store', default=10, type=int,
+                    help='number of timed loops')
+
+opt = vars(parser.parse_args())
+layers = opt.pop('layers')
+ncols = max(1, opt.pop('cells') // layers)
+repeats = opt.pop('repeats')
+op2.init(**opt)
+
+# Vertices are numbered up each column, cells likewise
+columns = op2.ExtrudedSet(op2.Set(ncols, "columns"), layers=layers + 1)
+vertices = op2.Set((ncols + 1) * (layers + 1), "vertices")
+cells = op2.Set(ncols * layers, "cells")
+dofs = op2.Set(ncols * layers * 4, "dofs")
+bottom = np.arange(ncols) * (layers + 1)
+cell_vertex = op2.Map(columns, vertices, 4,
+                      np.stack([bottom, bottom + 1, bottom + layers + 1,
+                                bottom + layers + 2], axis=1),
+                      "cell_vertex", np.ones(4, dtype=np.int32))
+cell_area = op2.Map(columns, cells, 1, np.arange(ncols).reshape(-1, 1) * layers,
+                    "cell_area", np.ones(1, dtype=np.int32))
+cell_dg = op2.Map(columns, dofs, 4,
+                  np.arange(ncols).reshape(-1, 1) * layers * 4 + np.arange(4),
+                  "cell_dg", np.full(4, 4, dtype=np.int32))
+
+x, z = np.meshgrid(np.arange(ncols + 1, dtype=np.float64),
+                   np.arange(layers + 1, dtype=np.float64), indexing='ij')
+coords = np.stack([x + 0.1 * np.sin(z), z * (1.0 + 0.01 * x)], axis=2).reshape(-1, 2)
+coordinates = op2.Dat(vertices ** 2, coords, np.float64, "coordinates")
+area = op2.Dat(cells, None, np.float64, "area")
+dg = op2.Dat(dofs, None, np.float64, "dg")
+
+area_kernel = op2.Kernel("""
+void area(double *x[], double *a[]) {
+  double ax = x[3][0] - x[0][0], ay = x[3][1] - x[0][1];
+  double bx = x[2][0] - x[1][0], by = x[2][1] - x[1][1];
+  a[0][0] = 0.5 * fabs(ax * by - ay * bx);
+}""", "area")
+
+dg_kernel = op2.Kernel("""
+void dg(double *x[], double *a[]) {
+  double ax = x[3][0] - x[0][0], ay = x[3][1] - x[0][1];
+  double bx = x[2][0] - x[1][0], by = x[2][1] - x[1][1];
+  double det = 0.5 * fabs(ax * by - ay * bx);
+  for (int k = 0; k < 4; k++)
+    a[k][0] += det * (1.0 + x[k][0] * x[k][1]);
+}""", "dg")
+
+print("%d columns of %d cells" % (ncols, layers))
+for kernel, dat, m, access in [(area_kernel, area, cell_area, op2.WRITE),
+                               (dg_kernel, dg, cell_dg, op2.INC)]:
+    for vectorise in [False, True]:
+        def run():
+            loop = op2.par_loop(kernel, columns, coordinates(op2.READ, cell_vertex),
+                                dat(access, m), vectorise_columns=vectorise)
+            dat.data_ro
+            return loop
+        # Untimed first loop compiles the kernel
+        assert run().column_vectorised == vectorise
+        best = float('inf')
+        for _ in range(repeats):
+            t = time()
+            run()
+            best = min(best, time() - t)
+        print("%-4s vectorise_columns=%-5s %.3e s per loop" % (kernel.name, vectorise, best))
@@ -44,7 +44,9 @@ import itertools
 import numpy as np
 import ctypes
 import operator
+import os
 import types
+import weakref
 from hashlib import md5
 
 from pyop2.datatypes import IntType, as_cstr
@@ -465,6 +467,30 @@ class Arg(object):
     def _uses_itspace(self):
         return self._is_mat or isinstance(self.idx, IterationIndex)
 
+    @cached_property
+    def _map_dtype(self):
+        """The integer type in which the maps of this argument are
+        passed to generated code.
+
+        If the ``compact_maps`` configuration option is set, the maps
+        of indirect :class:`Dat` arguments are passed as 32-bit
+        integers where their values allow (see
+        :attr:`Map._compact_values`).  :class:`Mat` arguments pass
+        their maps on to PETSc, so always use ``IntType``."""
+        if not (configuration["compact_maps"] and self._is_indirect):
+            return IntType
+        if all(m._compact_values.dtype == np.int32 for m in self.map):
+            return np.dtype(np.int32)
+        return IntType
+
+    def _map_values(self, m):
+        """The values of the :class:`Map` ``m`` (one of the maps of
+        this argument) to pass to generated code (see
+        :attr:`_map_dtype`)."""
+        if self._map_dtype == IntType:
+            return m._values
+        return m._compact_values
+
     @collective
     def halo_exchange_begin(self, update_inc=False):
         """Begin halo exchange for the argument if a halo update is required.
@@ -477,10 +503,15 @@ class Arg(object):
         access = [READ, RW]
         if update_inc:
             access.append(INC)
-        if self.access in access and self.data.needs_halo_update:
+        if self.access not in access:
+            return
+        if self.data.needs_halo_update:
             self.data.needs_halo_update = False
             self._in_flight = True
             self.data.halo_exchange_begin()
+        else:
+            for d in self.data:
+                d._skip_halo_exchange()
 
     @collective
     def halo_exchange_end(self, update_inc=False):
@@ -531,6 +562,41 @@ class Arg(object):
             self.data._data[:] = self.data._buf[:]
 
 
+def _hdf5_read_rows(slot, indices):
+    """Read the rows ``indices`` of the HDF5 dataset ``slot``.
+
+    Rather than reading the whole dataset, the (sorted) indices are
+    split into chunks whose extent is bounded by the
+    ``hdf5_chunk_size`` configuration option and each chunk is read
+    with a single hyperslab selection.  ``slot`` may live in a file
+    opened with the MPI-IO driver, every rank reads independently.
+
+    :arg slot: an HDF5 dataset.
+    :arg indices: the (global) rows to read, in the order they should
+        be returned.
+    :returns: an array of shape ``(len(indices), ) + slot.shape[1:]``.
+    """
+    indices = np.asarray(indices, dtype=np.int64).reshape(-1)
+    out = np.empty((len(indices), ) + tuple(slot.shape[1:]), dtype=slot.dtype)
+    if len(indices) == 0:
+        return out
+    order = np.argsort(indices, kind='mergesort')
+    sorted_indices = indices[order]
+    if sorted_indices[0] < 0 or sorted_indices[-1] >= slot.shape[0]:
+        raise IndexValueError("Row indices out of range for dataset of %d rows"
+                              % slot.shape[0])
+    row_bytes = slot.dtype.itemsize * int(np.prod(slot.shape[1:], dtype=int))
+    rows = max(1, configuration["hdf5_chunk_size"] // max(1, row_bytes))
+    start = 0
+    while start < len(sorted_indices):
+        lo = sorted_indices[start]
+        stop = np.searchsorted(sorted_indices, lo + rows, side='left')
+        block = slot[lo:sorted_indices[stop - 1] + 1]
+        out[order[start:stop]] = block[sorted_indices[start:stop] - lo]
+        start = stop
+    return out
+
+
 class Set(object):
 
     """OP2 set.
@@ -711,13 +777,25 @@ class Set(object):
         return None
 
     @classmethod
-    def fromhdf5(cls, f, name):
-        """Construct a :class:`Set` from set named ``name`` in HDF5 data ``f``"""
+    def fromhdf5(cls, f, name, sizes=None, comm=None):
+        """Construct a :class:`Set` from set named ``name`` in HDF5 data ``f``
+
+        :arg sizes: the local sizes of the set on this process (see
+            :class:`Set`) when running in parallel.  The owned sizes
+            summed over ``comm`` must match the global size stored in
+            the file.
+        :arg comm: the communicator the set is defined on.
+        """
         slot = f[name]
         if slot.shape != (1,):
             raise SizeTypeError("Shape of %s is incorrect" % name)
-        size = slot.value.astype(np.int)
-        return cls(size[0], name)
+        size = int(slot[0])
+        if sizes is None:
+            return cls(size, name, comm=comm)
+        s = cls(sizes, name, comm=comm)
+        if s.comm.allreduce(s.size) != size:
+            raise SizeTypeError("Local sizes of %s do not add up to %d" % (name, size))
+        return s
 
 
 class GlobalSet(Set):
@@ -796,19 +874,45 @@ class ExtrudedSet(Set):
     :param parent: The parent :class:`Set` to build this :class:`ExtrudedSet` on top of
     :type parent: a :class:`Set`.
     :param layers: The number of layers in this :class:`ExtrudedSet`.
-    :type layers: an integer.
+    :type layers: an integer, or an array of shape
+        ``(parent.total_size, 2)`` giving the first layer and one past
+        the last layer of the column above every entity of ``parent``.
 
     The number of layers indicates the number of time the base set is
     extruded in the direction of the :class:`ExtrudedSet`.  As a
     result, there are ``layers-1`` extruded "cells" in an extruded set.
+
+    If the number of layers varies, the column above entity ``e`` has
+    ``stop - start - 1`` cells, where ``start, stop = layers[e]``.
+    Only these cells are visited by a :func:`par_loop`, and the values
+    of :class:`Map`\s from an extruded set refer to the bottom cell
+    (or node) of each column, so that no storage is needed for the
+    layers below ``start`` or above ``stop``.
     """
 
     @validate_type(('parent', Set, TypeError))
     def __init__(self, parent, layers):
         self._parent = parent
-        if layers < 2:
-            raise SizeTypeError("Number of layers must be > 1 (not %s)" % layers)
-        self._layers = layers
+        if np.ndim(layers) == 0:
+            if layers < 2:
+                raise SizeTypeError("Number of layers must be > 1 (not %s)" % layers)
+            self._layers = layers
+            self.constant_layers = True
+        else:
+            try:
+                layers = verify_reshape(layers, IntType, (parent.total_size, 2))
+            except DataValueError:
+                raise SizeTypeError("Layers must be given for all %d entities of the parent set"
+                                    % parent.total_size)
+            nlayers = layers[:, 1] - layers[:, 0]
+            if len(layers) and layers[:, 0].min() < 0:
+                raise SizeTypeError("First layer must be >= 0")
+            if len(layers) and nlayers.min() < 2:
+                raise SizeTypeError("Number of layers must be > 1 in every column")
+            layers.setflags(write=False)
+            self._layers_array = layers
+            self._layers = int(nlayers.max()) if len(layers) else 2
+            self.constant_layers = False
         self._extruded = True
 
     def __getattr__(self, name):
@@ -833,9 +937,23 @@ class ExtrudedSet(Set):
 
     @cached_property
     def layers(self):
-        """The number of layers in this extruded set."""
+        """The number of layers in this extruded set (the largest
+        number in any column if it varies, see :attr:`layers_array`)."""
         return self._layers
 
+    @cached_property
+    def layers_array(self):
+        """The first layer and one past the last layer of the column
+        above every entity of the parent set, as a read-only array of
+        shape ``(parent.total_size, 2)``."""
+        if not self.constant_layers:
+            return self._layers_array
+        layers = np.empty((self._parent.total_size, 2), dtype=IntType)
+        layers[:, 0] = 0
+        layers[:, 1] = self._layers
+        layers.setflags(write=False)
+        return layers
+
 
 class LocalSet(ExtrudedSet, ObjectCached):
 
@@ -903,12 +1021,31 @@ class Subset(ExtrudedSet):
     :param indices: Elements of the superset that form the
         subset. Duplicate values are removed when constructing the subset.
     :type indices: a list of integers, or a numpy array.
+
+    Subsets made of a few contiguous runs of superset elements are
+    stored, and iterated over by generated code, as ranges.  Otherwise
+    subsets covering a large enough fraction of their superset are
+    stored as a bitmask, and any others as an array of indices.  In
+    parallel all processes use the same layout, so constructing a
+    Subset is collective.
     """
+
+    _min_run_length = 4
+    """Minimum mean length of the runs of contiguous elements for a
+    :class:`Subset` to be stored as ranges."""
+
+    _min_mask_density = 0.5
+    """Minimum fraction of the superset elements (up to the last one
+    in the subset) in a :class:`Subset` for it to be stored as a
+    bitmask."""
+
     @validate_type(('superset', Set, TypeError),
                    ('indices', (list, tuple, np.ndarray), TypeError))
     def __init__(self, superset, indices):
-        # sort and remove duplicates
-        indices = np.unique(indices)
+        # sort and remove duplicates, unless already sorted and unique
+        indices = np.asarray(indices)
+        if len(indices) > 1 and not (indices[1:] > indices[:-1]).all():
+            indices = np.unique(indices)
         if isinstance(superset, Subset):
             # Unroll indices to point to those in the parent
             indices = superset.indices[indices]
@@ -925,10 +1062,93 @@ class Subset(ExtrudedSet):
                 'Out of bounds indices in Subset construction: [%d, %d) not [0, %d)' %
                 (self._indices[0], self._indices[-1], self._superset.total_size))
 
-        self._sizes = ((self._indices < superset.core_size).sum(),
-                       (self._indices < superset.size).sum(),
-                       (self._indices < superset.exec_size).sum(),
-                       len(self._indices))
+        # The indices are sorted, so count those below each superset
+        # size by bisection
+        self._sizes = tuple(np.searchsorted(self._indices,
+                                            (superset.core_size, superset.size,
+                                             superset.exec_size),
+                                            side='left')) + (len(self._indices), )
+        # Results of set algebra with this subset (see _algebra)
+        self._algebra_cache = {}
+        self._compress()
+
+    def _compress(self):
+        """Choose the representation of the subset's (sorted, unique)
+        indices, setting :attr:`_layout` and :attr:`_layout_array`.
+
+        Unless the layout is ``"indices"`` the dense indices are
+        dropped, they are rebuilt on demand from the compressed
+        layout."""
+        indices = self._indices
+        n = len(indices)
+        # Positions at which runs of contiguous indices start
+        starts = np.flatnonzero(np.diff(indices) != 1) + 1
+        if n and (len(starts) + 1) * self._min_run_length <= n:
+            layout = "ranges"
+        elif n and n >= self._min_mask_density * (indices[-1] + 1):
+            layout = "bitmask"
+        else:
+            layout = "indices"
+        comm = self._superset.comm
+        if comm.size > 1 and len(set(comm.allgather(layout))) > 1:
+            # The generated code depends on the layout, so all
+            # processes must agree on it
+            layout = "indices"
+        if layout == "ranges":
+            # Rows of (position, index) for the start of each run,
+            # followed by a sentinel row
+            ranges = np.empty((len(starts) + 2, 2), dtype=IntType)
+            ranges[0] = 0, indices[0]
+            ranges[1:-1, 0] = starts
+            ranges[1:-1, 1] = indices[starts]
+            ranges[-1] = n, indices[-1] + 1
+            self._layout, self._layout_array = "ranges", ranges
+        elif layout == "bitmask":
+            bits = np.zeros(-(-(indices[-1] + 1) // 64) * 64, dtype=bool)
+            bits[indices] = True
+            # Bit j of word w is set if index 64 * w + j is in the
+            # subset (built by hand, as packbits only has bitorder
+            # from NumPy 1.17)
+            shifts = np.arange(64, dtype=np.uint64)
+            mask = np.bitwise_or.reduce(bits.reshape(-1, 64).astype(np.uint64) << shifts,
+                                        axis=1)
+            self._layout, self._layout_array = "bitmask", mask
+        else:
+            self._layout, self._layout_array = "indices", indices
+            return
+        # Rebuilt lazily (see _indices)
+        del self._indices
+
+    @cached_property
+    def _indices(self):
+        if self._layout == "ranges":
+            ranges = self._layout_array
+            lengths = np.diff(ranges[:, 0])
+            return (np.arange(ranges[-1, 0], dtype=IntType) +
+                    np.repeat(ranges[:-1, 1] - ranges[:-1, 0], lengths))
+        shifts = np.arange(64, dtype=np.uint64)
+        bits = (self._layout_array[:, np.newaxis] >> shifts) & np.uint64(1)
+        return np.flatnonzero(bits).astype(IntType)
+
+    def _layout_bounds(self, start, end):
+        """Translate the range ``[start, end)`` of positions in the
+        subset into the bounds passed to generated code, which for the
+        ``"bitmask"`` layout are bounds on the superset elements."""
+        if self._layout != "bitmask":
+            return start, end
+        superset = self._superset
+        bounds = dict(zip((0, ) + tuple(self._sizes),
+                          (0, superset.core_size, superset.size,
+                           superset.exec_size, superset.total_size)))
+        if start in bounds and end in bounds:
+            start, end = bounds[start], bounds[end]
+        elif start >= end:
+            return 0, 0
+        else:
+            start, end = self._indices[start], self._indices[end - 1] + 1
+        # Don't read past the end of the mask
+        limit = len(self._layout_array) * 64
+        return min(start, limit), min(end, limit)
 
     # Look up any unspecified attributes on the _set.
     def __getattr__(self, name):
@@ -959,6 +1179,80 @@ class Subset(ExtrudedSet):
                 indices = [indices]
         return _make_object('Subset', self, indices)
 
+    def _algebra(self, op, other, compute):
+        """Return the :class:`Subset` ``op(self, other)``, memoized on
+        the operands for as long as both are alive.
+
+        The result is stored on the first operand, keyed on a weak
+        reference to the second, so memoizing it does not keep
+        temporary subsets alive.  Whether a result is found then only
+        depends on the operations performed on live subsets, which is
+        the same on all processes, so they all construct the result
+        (collectively) or none do.
+
+        :arg compute: a function mapping the (sorted) indices of
+            ``self`` and ``other`` to the (sorted) result indices."""
+        if other is not None:
+            if not isinstance(other, Subset):
+                raise SetTypeError("Set algebra requires a Subset, not %s" % type(other))
+            if other.superset is not self._superset:
+                raise SetValueError("Set algebra requires Subsets of the same superset")
+        first, second = self, other
+        if op in ("intersection", "union"):
+            first, second = sorted((self, other), key=id)
+        if second is None:
+            cache, key = first._algebra_cache, op
+        else:
+            cache, key = first._algebra_cache.setdefault(op, weakref.WeakKeyDictionary()), second
+        try:
+            return cache[key]
+        except KeyError:
+            indices = compute(self._indices, None if other is None else other._indices)
+            result = cache[key] = _make_object('Subset', self._superset, indices)
+            return result
+
+    def intersection(self, other):
+        """Return the :class:`Subset` of elements in both this and
+        ``other`` (a :class:`Subset` of the same superset)."""
+        def compute(a, b):
+            return a[_sorted_in(a, b)]
+        return self._algebra("intersection", other, compute)
+
+    def union(self, other):
+        """Return the :class:`Subset` of elements in this or ``other``
+        (a :class:`Subset` of the same superset)."""
+        def compute(a, b):
+            a = a[~_sorted_in(a, b)]
+            # Merge the two disjoint sorted arrays: each element's
+            # position is its own index plus the number of elements
+            # of the other array below it.
+            merged = np.empty(len(a) + len(b), dtype=IntType)
+            merged[np.arange(len(a)) + np.searchsorted(b, a)] = a
+            merged[np.arange(len(b)) + np.searchsorted(a, b)] = b
+            return merged
+        return self._algebra("union", other, compute)
+
+    def difference(self, other):
+        """Return the :class:`Subset` of elements in this but not in
+        ``other`` (a :class:`Subset` of the same superset)."""
+        def compute(a, b):
+            return a[~_sorted_in(a, b)]
+        return self._algebra("difference", other, compute)
+
+    def complement(self):
+        """Return the :class:`Subset` of the superset's elements
+        (including halo elements) not in this one."""
+        def compute(a, b):
+            mask = np.ones(self._superset.total_size, dtype=bool)
+            mask[a] = False
+            return np.flatnonzero(mask).astype(IntType)
+        return self._algebra("complement", None, compute)
+
+    __and__ = intersection
+    __or__ = union
+    __sub__ = difference
+    __invert__ = complement
+
     @cached_property
     def superset(self):
         """Returns the superset Set"""
@@ -974,6 +1268,37 @@ class Subset(ExtrudedSet):
         """Ctypes argtype for this :class:`Subset`"""
         return ctypes.c_voidp
 
+    @cached_property
+    def _c_iteration(self):
+        """Tuple of the declaration of the wrapper argument holding the
+        subset and of the code opening and closing the loop defining
+        ``i``, the superset element, for iterating over it."""
+        int_t = as_cstr(IntType)
+        if self._layout == "ranges":
+            return ("%s* ssranges," % int_t,
+                    """for ( int r = 0; ssranges[2 * r] < end; r++ ) {
+  for ( int n = ssranges[2 * r] > start ? ssranges[2 * r] : start; n < end && n < ssranges[2 * r + 2]; n++ ) {
+    %s i = ssranges[2 * r + 1] + (n - ssranges[2 * r]);""" % int_t,
+                    "}\n}")
+        if self._layout == "bitmask":
+            return ("uint64_t* ssmask,",
+                    """for ( %s i = start; i < end; i++ ) {
+    if ( !((ssmask[i >> 6] >> (i & 63)) & 1) ) continue;""" % int_t,
+                    "}")
+        return ("%s* ssinds," % int_t,
+                """for ( int n = start; n < end; n++ ) {
+    %s i = ssinds[n];""" % int_t,
+                "}")
+
+
+def _sorted_in(a, b):
+    """Return a boolean mask of the entries of the sorted array ``a``
+    which are in the sorted array ``b``."""
+    pos = np.searchsorted(b, a)
+    found = pos < len(b)
+    found[found] = b[pos[found]] == a[found]
+    return found
+
 
 class SetPartition(object):
     def __init__(self, set, offset, size):
@@ -1497,6 +1822,17 @@ class Halo(object):
     petsc (cross-process) dof numbering."""
         return self._global_to_petsc_numbering
 
+    @cached_property
+    def send_indices(self):
+        """Sorted array of the owned :class:`Set` elements that appear in
+        any of the send lists.
+
+        Writes that touch none of these elements leave the halo values
+        on the other processes valid."""
+        if not self.sends:
+            return np.empty(0, dtype=IntType)
+        return np.unique(np.concatenate(list(self.sends.values())))
+
     def verify(self, s):
         """Verify that this :class:`Halo` is valid for a given
 :class:`Set`."""
@@ -1632,7 +1968,8 @@ class IterationSpace(object):
     def cache_key(self):
         """Cache key used to uniquely identify the object in the cache."""
         return self._extents, self._block_shape, self.iterset._extruded, \
-            isinstance(self._iterset, Subset)
+            isinstance(self._iterset, Subset) and self._iterset._layout, \
+            self._iterset._extruded and not self._iterset.constant_layers
 
 
 class DataCarrier(object):
@@ -1689,12 +2026,37 @@ class _EmptyDataMixin(object):
     Accessing the :attr:`_data` property allocates a zeroed data array
     if it does not already exist.
     """
-    def __init__(self, data, dtype, shape):
+    def __init__(self, data, dtype, shape, backing_file=None):
         if data is None:
             self._dtype = np.dtype(dtype if dtype is not None else np.float64)
         else:
             self._numpy_data = verify_reshape(data, dtype, shape, allow_none=True)
-            self._dtype = self._data.dtype
+            self._dtype = self._numpy_data.dtype
+        self._backing_file = backing_file
+        if backing_file is not None:
+            self._numpy_data = self._map_backing_file(data, dtype, shape)
+
+    def _map_backing_file(self, data, dtype, shape):
+        """Return a memory map of :attr:`_backing_file` (in NumPy
+        format) to use as data buffer.
+
+        An existing file is mapped as is if no ``data`` are provided,
+        otherwise the file is (re)created and ``data`` copied into it."""
+        filename = self._backing_file
+        if data is None and os.path.exists(filename):
+            array = np.lib.format.open_memmap(filename, mode='r+')
+            if dtype is None:
+                self._dtype = array.dtype
+            if array.shape != shape or array.dtype != self._dtype:
+                raise DataValueError("%s holds %s data of shape %s, expected %s of shape %s"
+                                     % (filename, array.dtype, array.shape,
+                                        self._dtype, shape))
+            return array
+        array = np.lib.format.open_memmap(filename, mode='w+',
+                                          dtype=self._dtype, shape=shape)
+        if data is not None:
+            array[...] = self._numpy_data
+        return array
 
     @cached_property
     def _data(self):
@@ -1725,6 +2087,14 @@ class Dat(DataCarrier, _EmptyDataMixin):
     case, allocation of the data buffer is postponed until it is
     accessed.
 
+    If a ``backing_file`` is given, the data buffer is a memory map of
+    that (process-local) file in NumPy ``.npy`` format, rather than
+    anonymous memory.  Values are then paged in by the operating system
+    as they are touched.  If the file already exists and no ``data``
+    are passed, its contents are used as the values of the
+    :class:`Dat`.  :meth:`save` to the backing file only needs to
+    :meth:`flush` the mapping.
+
     .. note::
         If the data buffer is not passed in, it is implicitly
         initialised to be zero.
@@ -1745,8 +2115,19 @@ class Dat(DataCarrier, _EmptyDataMixin):
     :class:`Dat` objects support the pointwise linear algebra operations
     ``+=``, ``*=``, ``-=``, ``/=``, where ``*=`` and ``/=`` also support
     multiplication / division by a scalar.
+
+    The validity of the halo is tracked in :attr:`halo_state`, which is
+    one of :attr:`HALO_VALID` (the halo agrees with the owning
+    processes), :attr:`OWNED_DIRTY` (owned entries were written, but
+    none that other processes hold in their halo) and
+    :attr:`HALO_STALE` (a halo exchange is required before the halo
+    may be read).
     """
 
+    HALO_VALID = "HALO_VALID"
+    OWNED_DIRTY = "OWNED_DIRTY"
+    HALO_STALE = "HALO_STALE"
+
     _globalcount = 0
     _modes = [READ, WRITE, RW, INC]
 
@@ -1754,7 +2135,7 @@ class Dat(DataCarrier, _EmptyDataMixin):
                    ('name', str, NameTypeError))
     @validate_dtype(('dtype', None, DataTypeError))
     def __init__(self, dataset, data=None, dtype=None, name=None,
-                 soa=None, uid=None):
+                 soa=None, uid=None, backing_file=None):
 
         if isinstance(dataset, Dat):
             self.__init__(dataset.dataset, None, dtype=dataset.dtype,
@@ -1766,13 +2147,16 @@ class Dat(DataCarrier, _EmptyDataMixin):
             # a dataset dimension of 1.
             dataset = dataset ** 1
         self._shape = (dataset.total_size,) + (() if dataset.cdim == 1 else dataset.dim)
-        _EmptyDataMixin.__init__(self, data, dtype, self._shape)
+        _EmptyDataMixin.__init__(self, data, dtype, self._shape,
+                                 backing_file=backing_file)
 
         self._dataset = dataset
         self.comm = dataset.comm
         # Are these data to be treated as SoA on the device?
         self._soa = bool(soa)
-        self.needs_halo_update = False
+        self.halo_state = Dat.HALO_VALID
+        self._halo_exchanges = 0
+        self._halo_exchanges_avoided = 0
         # If the uid is not passed in from outside, assume that Dats
         # have been declared in the same order everywhere.
         if uid is None:
@@ -1834,6 +2218,78 @@ class Dat(DataCarrier, _EmptyDataMixin):
         """Ctypes argtype for this :class:`Dat`"""
         return ctypes.c_voidp
 
+    @property
+    def needs_halo_update(self):
+        """Has this Dat been written to since the last halo exchange?
+
+        This is ``True`` if the :attr:`halo_state` is
+        :attr:`HALO_STALE`.  Setting it to ``True`` marks the halo as
+        stale, setting it to ``False`` marks it as valid."""
+        return self.halo_state is Dat.HALO_STALE
+
+    @needs_halo_update.setter
+    def needs_halo_update(self, val):
+        """Indictate whether this Dat requires a halo update"""
+        self.halo_state = Dat.HALO_STALE if val else Dat.HALO_VALID
+
+    @property
+    def halo_exchange_counts(self):
+        """A tuple ``(performed, avoided)`` counting the forward halo
+        exchanges carried out on this :class:`Dat` and those skipped
+        because the preceding writes left the halo valid."""
+        return (self._halo_exchanges, self._halo_exchanges_avoided)
+
+    def _record_direct_write(self, iterset):
+        """Update the :attr:`halo_state` after a direct write over ``iterset``.
+
+        The halo is tracked per region: a direct loop only modifies
+        owned entries, so the halo only becomes :attr:`HALO_STALE` if
+        one of the written entries appears in a halo send list on any
+        process.  Otherwise the owned region is :attr:`OWNED_DIRTY` but
+        halo values remain valid for reading.  This is collective.
+
+        :arg iterset: the :class:`Set` or :class:`Subset` that was
+            iterated over."""
+        if self.halo_state is Dat.HALO_STALE:
+            return
+        halo = self.dataset.halo
+        if halo is None:
+            self.halo_state = Dat.OWNED_DIRTY
+            return
+        sends = getattr(halo, "send_indices", None)
+        if isinstance(iterset, Subset) and iterset.superset is self.dataset.set:
+            indices = iterset.indices
+        elif iterset is self.dataset.set:
+            indices = None
+        else:
+            # LocalSets and anything we don't understand may touch
+            # halo or send entries.
+            sends = None
+        if sends is None:
+            touched = True
+        elif indices is None:
+            touched = len(sends) > 0
+        else:
+            # Subset indices are sorted and unique
+            pos = np.searchsorted(indices, sends)
+            valid = pos < len(indices)
+            touched = (indices[pos[valid]] == sends[valid]).any()
+        if self.comm.size > 1:
+            # A process's halo is stale if any neighbour wrote to its
+            # send list, so all processes must agree on whether to
+            # exchange.
+            touched = self.comm.allreduce(bool(touched), op=MPI.LOR)
+        self.halo_state = Dat.HALO_STALE if touched else Dat.OWNED_DIRTY
+
+    def _skip_halo_exchange(self):
+        """Note that a forward halo exchange was not required."""
+        if self.dataset.halo is None:
+            return
+        if self.halo_state is Dat.OWNED_DIRTY:
+            # An exchange an unconditional dirty flag would have done
+            self._halo_exchanges_avoided += 1
+        self.halo_state = Dat.HALO_VALID
+
     @property
     @collective
     def data(self):
@@ -1914,8 +2370,25 @@ class Dat(DataCarrier, _EmptyDataMixin):
         v.setflags(write=False)
         return v
 
+    @collective
+    def flush(self):
+        """Write any modified values back to the backing file (see
+        :class:`Dat`).  Does nothing if the data are not backed by a
+        file."""
+        if self._backing_file is not None:
+            self.data_ro        # force evaluation
+            self._data.flush()
+
     def save(self, filename):
-        """Write the data array to file ``filename`` in NumPy format."""
+        """Write the data array to file ``filename`` in NumPy format.
+
+        If ``filename`` is the backing file of this :class:`Dat`, the
+        mapping is just flushed."""
+        backing_file = self._backing_file
+        if backing_file is not None and os.path.exists(filename) and \
+           os.path.samefile(filename, backing_file):
+            self.flush()
+            return
         np.save(filename, self.data_ro)
 
     def load(self, filename):
@@ -2226,6 +2699,8 @@ class Dat(DataCarrier, _EmptyDataMixin):
         halo = self.dataset.halo
         if halo is None:
             return
+        if not reverse:
+            self._halo_exchanges += 1
         halo.begin(self, reverse=reverse)
 
     @collective
@@ -2242,10 +2717,18 @@ class Dat(DataCarrier, _EmptyDataMixin):
         halo.end(self, reverse=reverse)
 
     @classmethod
-    def fromhdf5(cls, dataset, f, name):
-        """Construct a :class:`Dat` from a Dat named ``name`` in HDF5 data ``f``"""
+    def fromhdf5(cls, dataset, f, name, indices=None):
+        """Construct a :class:`Dat` from a Dat named ``name`` in HDF5 data ``f``
+
+        :arg indices: the global numbers of the local (owned and halo)
+            entries of the :class:`Set` underlying ``dataset``, in
+            local order.  If provided, only these rows are read.
+        """
         slot = f[name]
-        data = slot.value
+        if indices is None:
+            data = slot[...]
+        else:
+            data = _hdf5_read_rows(slot, indices)
         soa = slot.attrs['type'].find(':soa') > 0
         ret = cls(dataset, data, name=name, soa=soa)
         return ret
@@ -2787,6 +3270,24 @@ class _MapArg(object):
         self.idx = idx
 
 
+_interned_map_values = weakref.WeakValueDictionary()
+
+
+def _intern_map_values(values):
+    """Return a read-only array with the same contents as ``values``,
+    shared between all interned arrays with those contents, together
+    with a digest of the contents."""
+    digest = md5(values.tobytes()).hexdigest()
+    key = (digest, values.shape)
+    interned = _interned_map_values.get(key)
+    if interned is not None and np.array_equal(interned, values):
+        return interned, digest
+    interned = values.view()
+    interned.setflags(write=False)
+    _interned_map_values[key] = interned
+    return interned, digest
+
+
 class Map(object):
 
     """OP2 map, a relation between two :class:`Set` objects.
@@ -2814,6 +3315,12 @@ class Map(object):
     supplying two lists of indices in `bt_masks`, the first provides
     indices for the bottom, the second for the top.
 
+    If the ``intern_map_values`` configuration option is set, the
+    values of :class:`Map`\s with identical contents share a single
+    read-only buffer, and such maps are treated as equivalent when
+    looking up cached :class:`Sparsity` objects.  The values of an
+    interned map must not be modified.
+
     """
 
     _globalcount = 0
@@ -2828,6 +3335,9 @@ class Map(object):
         self._values = verify_reshape(values, IntType,
                                       (iterset.total_size, arity),
                                       allow_none=True)
+        self._values_digest = None
+        if values is not None and configuration["intern_map_values"]:
+            self._values, self._values_digest = _intern_map_values(self._values)
         self._name = name or "map_%d" % Map._globalcount
         if offset is None or len(offset) == 0:
             self._offset = None
@@ -2945,6 +3455,93 @@ class Map(object):
         points."""
         return self._values
 
+    @cached_property
+    def _compact_values(self):
+        """Mapping array (including halo points) stored as 32-bit
+        integers, if the values fit.  Otherwise, or if ``IntType`` is
+        32 bits wide anyway, the same as :attr:`values_with_halo`.
+
+        The array is built the first time it is needed, so the map
+        values must not be modified afterwards."""
+        values = self._values
+        if values.dtype == np.int32 or values.size == 0:
+            return values
+        info = np.iinfo(np.int32)
+        if values.min() < info.min or values.max() > info.max:
+            return values
+        compact = values.astype(np.int32)
+        compact.setflags(write=False)
+        return compact
+
+    @cached_property
+    def _inverse(self):
+        """The transpose of the map values (including halo points) in
+        CSR form, as a pair of read-only arrays ``(offsets, entries)``.
+
+        The map entries referencing ``toset`` entity ``n`` are
+        ``entries[offsets[n]:offsets[n+1]]``, in ascending order, where
+        entry ``p`` is position ``p % arity`` of ``iterset`` entity
+        ``p // arity``.  Negative (and out of range) map values are
+        ignored.
+
+        The transpose is built the first time it is needed, so the map
+        values must not be modified afterwards."""
+        nnodes = self.toset.total_size
+        flat = self._values.reshape(-1)
+        entries, = np.nonzero((flat >= 0) & (flat < nnodes))
+        targets = flat[entries]
+        # Counting sort by target entity: the bin sizes give the
+        # offsets, a stable sort places the entries in their bins.
+        offsets = np.zeros(nnodes + 1, dtype=IntType)
+        np.cumsum(np.bincount(targets, minlength=nnodes), out=offsets[1:])
+        entries = entries[np.argsort(targets, kind="mergesort")].astype(IntType)
+        offsets.setflags(write=False)
+        entries.setflags(write=False)
+        return offsets, entries
+
+    @cached_property
+    def inverse(self):
+        """The inverse (transpose) of this map in CSR form.
+
+        :returns: a pair of read-only arrays ``(offsets, indices)``
+            such that the ``iterset`` entities (including halo points)
+            referencing ``toset`` entity ``n`` are
+            ``indices[offsets[n]:offsets[n+1]]``, in ascending order.
+            An entity referencing ``n`` more than once appears once per
+            reference.  Negative map values are ignored.
+
+        The inverse is computed once and cached on the map, so the map
+        values must not be modified afterwards."""
+        offsets, entries = self._inverse
+        indices = entries // self.arity
+        indices.setflags(write=False)
+        return offsets, indices
+
+    @cached_property
+    def _columns_disjoint(self):
+        """Do the entries referenced by different layers of any one
+        column of this extruded map never coincide?
+
+        Only maps with a uniform, positive offset are recognised: the
+        entries ``v + j * offset`` of layers ``j`` and ``j'`` coincide
+        if two values of an iterset entity differ by a nonzero multiple
+        of the offset no larger than the number of layers allows."""
+        if not self.iterset._extruded or self.offset is None:
+            return False
+        offset = self.offset[0]
+        if offset <= 0 or (self.offset != offset).any():
+            return False
+        values = self._values
+        bound = (self.iterset.layers - 2) * offset
+        # Compare one pair of columns of the map at a time, to keep
+        # the temporaries the size of the iteration set
+        for i in range(self.arity):
+            for j in range(i + 1, self.arity):
+                diff = values[:, i] - values[:, j]
+                if ((diff != 0) & (diff % offset == 0) & (abs(diff) <= bound)).any():
+                    return False
+        return True
+
     @cached_property
     def name(self):
         """User-defined label"""
@@ -2973,22 +3570,60 @@ class Map(object):
         return "Map(%r, %r, %r, None, %r)" \
                % (self._iterset, self._toset, self._arity, self._name)
 
+    @cached_property
+    def _structure_key(self):
+        """A key identifying :class:`Map`\s with the same structure.
+
+        For maps with interned values (see :class:`Map`) this is built
+        from the sets, the arity, the offsets and masks and a digest
+        of the values, otherwise it is the map itself."""
+        if self._values_digest is None:
+            return self
+        offset = None if self._offset is None else tuple(self._offset)
+        masks = tuple((k, tuple(self._bottom_mask[k]), tuple(self._top_mask[k]))
+                      for k in sorted(self._bottom_mask))
+        return (type(self), self._iterset, self._toset, self._arity,
+                self._values_digest, offset, masks)
+
     def __le__(self, o):
-        """self<=o if o equals self or self._parent <= o."""
+        """self<=o if o equals self (or has the same structure) or
+        self._parent <= o."""
         if isinstance(o, DecoratedMap):
             # The iteration region of self must be a subset of the
             # iteration region of the sparsitymap.
             return len(self.iteration_region - o.iteration_region) == 0 and self <= o._map
-        return self == o or (isinstance(self._parent, Map) and self._parent <= o)
+        return self == o or self._structure_key == getattr(o, '_structure_key', None) or \
+            (isinstance(self._parent, Map) and self._parent <= o)
 
     @classmethod
-    def fromhdf5(cls, iterset, toset, f, name):
-        """Construct a :class:`Map` from set named ``name`` in HDF5 data ``f``"""
+    def fromhdf5(cls, iterset, toset, f, name, indices=None, toset_indices=None):
+        """Construct a :class:`Map` from set named ``name`` in HDF5 data ``f``
+
+        :arg indices: the global numbers of the local ``iterset``
+            entries, in local order.  If provided, only these rows of
+            the map are read.
+        :arg toset_indices: the global numbers of the local ``toset``
+            entries, in local order.  If provided, the map values are
+            renumbered from global to local ``toset`` numbering;
+            values without a local counterpart become -1.
+        """
         slot = f[name]
-        values = slot.value
         arity = slot.shape[1:]
         if len(arity) != 1:
             raise ArityTypeError("Unrecognised arity value %s" % arity)
+        if indices is None:
+            values = slot[...]
+        else:
+            values = _hdf5_read_rows(slot, indices)
+        if toset_indices is not None:
+            toset_indices = np.asarray(toset_indices)
+            order = np.argsort(toset_indices, kind='mergesort')
+            sorted_indices = toset_indices[order]
+            pos = np.searchsorted(sorted_indices, values)
+            found = pos < len(sorted_indices)
+            found[found] = sorted_indices[pos[found]] == values[found]
+            values = np.where(found, order[np.where(found, pos, 0)], -1) \
+                if len(order) else np.full(values.shape, -1)
         return cls(iterset, toset, arity[0], values, name)
 
 
@@ -3080,6 +3715,23 @@ class DecoratedMap(Map, ObjectCached):
     def __getattr__(self, name):
         return getattr(self._map, name)
 
+    @cached_property
+    def _structure_key(self):
+        return (DecoratedMap, self._map._structure_key, self._iteration_region,
+                self.implicit_bcs, self.vector_index)
+
+    @cached_property
+    def _inverse(self):
+        return self._map._inverse
+
+    @cached_property
+    def inverse(self):
+        return self._map.inverse
+
+    @cached_property
+    def _columns_disjoint(self):
+        return self._map._columns_disjoint
+
     @cached_property
     def map(self):
         """The :class:`Map` this :class:`DecoratedMap` is decorating"""
@@ -3120,6 +3772,11 @@ class MixedMap(Map, ObjectCached):
         """The underlying tuple of :class:`Map`\s."""
         return self._maps
 
+    @cached_property
+    def _structure_key(self):
+        return (MixedMap, ) + tuple(None if m is None else m._structure_key
+                                    for m in self._maps)
+
     @cached_property
     def iterset(self):
         """:class:`MixedSet` mapped from."""
@@ -3308,10 +3965,18 @@ class Sparsity(ObjectCached):
                 if isinstance(dset, MixedDataSet) and any([isinstance(d, GlobalDataSet) for d in dset]):
                     raise SparsityFormatError("Mixed monolithic matrices with Global rows or columns are not supported.")
             with timed_region("CreateSparsity"):
-                build_sparsity(self, parallel=(self.comm.size > 1),
-                               block=self._block_sparse)
+                disk_cache = configuration["sparsity_disk_cache"]
+                if not (disk_cache and self._load_from_disk()):
+                    build_sparsity(self, parallel=(self.comm.size > 1),
+                                   block=self._block_sparse,
+                                   nthreads=configuration["sparsity_threads"],
+                                   method=configuration["sparsity_builder"])
+                    if disk_cache:
+                        self._save_to_disk()
             self._blocks = [[self]]
             self._nested = False
+        self._csr_offsets_cache = {}
+        self._thread_partition_cache = {}
         self._initialized = True
 
     _cache = {}
@@ -3392,8 +4057,96 @@ class Sparsity(ObjectCached):
 
     @classmethod
     def _cache_key(cls, dsets, maps, name, nest, block_sparse, *args, **kwargs):
+        # Maps with the same structure (see Map._structure_key) give
+        # the same sparsity
+        maps = frozenset(tuple(None if m is None else m._structure_key for m in pair)
+                         for pair in maps)
         return (dsets, maps, nest, block_sparse)
 
+    _disk_magic = 0x53505253
+
+    @cached_property
+    def _disk_cache_file(self):
+        """File name of this :class:`Sparsity` in the on-disk cache.
+
+        The name is a hash of everything that determines the pattern:
+        the map values, offsets and iteration regions, the set sizes,
+        the dimensions and the blocking.  Each process of a parallel
+        run stores its own part."""
+        hsh = md5()
+        hsh.update(six.b(str((version, np.dtype(IntType).str,
+                              self.comm.size, self.comm.rank,
+                              self._block_sparse, self._has_diagonal,
+                              self._dims))))
+        for dsets in self._dsets:
+            for dset in dsets:
+                hsh.update(six.b(str((dset.set.sizes, dset.cdim))))
+        # The pattern does not depend on the order of the map pairs
+        pairs = []
+        for rmap, cmap in self.maps:
+            h = md5()
+            for m in itertools.chain(rmap, cmap):
+                offset = None if m.offset is None else tuple(m.offset)
+                h.update(six.b(str((m.arity, m.iterset.sizes, m.iterset.layers,
+                                    sorted(r.where for r in m.iteration_region),
+                                    offset))))
+                if m.iterset._extruded and not m.iterset.constant_layers:
+                    h.update(m.iterset.layers_array)
+                h.update(np.ascontiguousarray(m.values_with_halo))
+            pairs.append(h.hexdigest())
+        for digest in sorted(pairs):
+            hsh.update(six.b(digest))
+        return os.path.join(configuration["cache_dir"], "sparsity",
+                            "%s.sparsity" % hsh.hexdigest())
+
+    def _load_from_disk(self):
+        """Map the pattern of this :class:`Sparsity` from the on-disk
+        cache.
+
+        :returns: ``True`` on a cache hit."""
+        try:
+            data = np.memmap(self._disk_cache_file, dtype=IntType, mode="r")
+        except (IOError, OSError, ValueError):
+            return False
+        if len(data) < 6 or data[0] != Sparsity._disk_magic:
+            return False
+        nrows, nrowptr, ncolidx, d_nz, o_nz = (int(x) for x in data[1:6])
+        if len(data) != 6 + 2*nrows + nrowptr + ncolidx:
+            return False
+        data = np.asarray(data)
+        offset = 6
+        arrays = []
+        for n in (nrows, nrows, nrowptr, ncolidx):
+            arrays.append(data[offset:offset + n])
+            offset += n
+        self._d_nnz, self._o_nnz, self._rowptr, self._colidx = arrays
+        self._d_nz = d_nz
+        self._o_nz = o_nz
+        return True
+
+    def _save_to_disk(self):
+        """Write the pattern of this :class:`Sparsity` to the on-disk
+        cache."""
+        fname = self._disk_cache_file
+        dirname = os.path.dirname(fname)
+        if not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Another process got there first
+                if not os.path.isdir(dirname):
+                    raise
+        header = np.asarray([Sparsity._disk_magic, len(self._d_nnz),
+                             len(self._rowptr), len(self._colidx),
+                             self._d_nz, self._o_nz], dtype=IntType)
+        # Write to a temporary file, then rename atomically so
+        # readers never see a partial file.
+        tmpname = "%s_p%d.tmp" % (fname, os.getpid())
+        with open(tmpname, "wb") as f:
+            for a in (header, self._d_nnz, self._o_nnz, self._rowptr, self._colidx):
+                np.asarray(a, dtype=IntType).tofile(f)
+        os.rename(tmpname, fname)
+
     def __getitem__(self, idx):
         """Return :class:`Sparsity` block with row and column given by ``idx``
         or a given row of blocks."""
@@ -3499,6 +4252,100 @@ class Sparsity(ObjectCached):
         """Column indices array of CSR data structure."""
         return self._colidx
 
+    def _csr_offsets(self, rmap, cmap):
+        """Return the positions in the CSR value array of the entries of
+        the element matrices assembled through ``rmap`` and ``cmap``.
+
+        The result has shape ``(n, rarity * rdim * carity * cdim)``,
+        where ``n`` is the size of the iteration set including halos,
+        and lists the entries of each (row major) element matrix.  For
+        a block sparse pattern the positions are in the value array of
+        a BAIJ matrix, which stores each block in column major order.
+        Entries with negative row or column indices, which are dropped
+        from the matrix, get position -1.  The result is cached on this
+        :class:`Sparsity` for the pair of maps."""
+        key = (rmap, cmap)
+        try:
+            return self._csr_offsets_cache[key]
+        except KeyError:
+            pass
+        rdim, cdim = self.dims[0][0]
+        block = rdim == cdim and rdim > 1 and self._block_sparse
+        # The dimensions of the rows and columns of the pattern
+        rpdim, cpdim = (1, 1) if block else (rdim, cdim)
+        rowptr = self.rowptr
+        ncols = cmap.toset.total_size * cpdim
+        # Key each nonzero by its flat (row, column) index.  Rows are
+        # sorted, and so are the columns within a row, so the keys are
+        # sorted too and we can look the entries up by bisection.
+        rows = np.repeat(np.arange(len(rowptr) - 1, dtype=np.int64), np.diff(rowptr))
+        keys = rows * ncols + self.colidx
+        r = rmap.values_with_halo.astype(np.int64)[:, :, np.newaxis]
+        c = cmap.values_with_halo.astype(np.int64)[:, :, np.newaxis]
+        # Row and column of the pattern, and component within it, of
+        # each row and column of the element matrix
+        rcmpt = np.broadcast_to(np.arange(rdim), r.shape[:2] + (rdim,))
+        ccmpt = np.broadcast_to(np.arange(cdim), c.shape[:2] + (cdim,))
+        if block:
+            r = np.broadcast_to(r, rcmpt.shape)
+            c = np.broadcast_to(c, ccmpt.shape)
+        else:
+            r = np.where(r < 0, -1, rdim * r + rcmpt)
+            c = np.where(c < 0, -1, cdim * c + ccmpt)
+        r = r.reshape(len(r), -1, 1)
+        c = c.reshape(len(c), 1, -1)
+        query = r * ncols + c
+        offsets = np.searchsorted(keys, query)
+        valid = (r >= 0) & (c >= 0)
+        found = offsets < len(keys)
+        found[found] = keys[offsets[found]] == query[found]
+        if not found[valid].all():
+            raise MapValueError("Maps %s, %s not part of %s" % (rmap, cmap, self))
+        if block:
+            offsets = rdim * cdim * offsets + \
+                rdim * ccmpt.reshape(len(ccmpt), 1, -1) + \
+                rcmpt.reshape(len(rcmpt), -1, 1)
+        offsets = np.where(valid, offsets, -1).astype(IntType).reshape(len(offsets), -1)
+        self._csr_offsets_cache[key] = offsets
+        return offsets
+
+    def _thread_partition(self, rmap, nthreads):
+        """Partition the rows of this :class:`Sparsity` into ``nthreads``
+        contiguous blocks with balanced numbers of nonzeros, and the
+        iteration set of ``rmap`` between the blocks of rows.
+
+        Returns a triple of arrays ``(values, offsets, elements)``:
+        thread ``t`` owns positions ``values[t]:values[t+1]`` of the
+        CSR value array (the positions returned by
+        :meth:`_csr_offsets`) and executes the iteration set entities
+        ``elements[offsets[t]:offsets[t+1]]`` (in ascending order),
+        which are those referencing a row in its block through
+        ``rmap``.  An entity referencing rows of several blocks is
+        executed by each of the threads owning them.  The result is
+        cached on this :class:`Sparsity`."""
+        key = (rmap, nthreads)
+        try:
+            return self._thread_partition_cache[key]
+        except KeyError:
+            pass
+        rdim, cdim = self.dims[0][0]
+        block = rdim == cdim and rdim > 1 and self._block_sparse
+        rpdim, vdim = (1, rdim * cdim) if block else (rdim, 1)
+        nnodes = rmap.toset.total_size
+        # Nonzeros of the pattern preceding each row of the map's toset
+        nnz = self.rowptr[rpdim * np.arange(nnodes + 1)]
+        bounds = np.searchsorted(nnz, nnz[-1] * np.arange(nthreads + 1) // nthreads)
+        bounds[-1] = nnodes
+        inv_offsets, entries = rmap._inverse
+        elements = [np.unique(entries[inv_offsets[lo]:inv_offsets[hi]] // rmap.arity)
+                    for lo, hi in zip(bounds[:-1], bounds[1:])]
+        offsets = np.zeros(nthreads + 1, dtype=IntType)
+        np.cumsum([len(e) for e in elements], out=offsets[1:])
+        partition = ((vdim * nnz[bounds]).astype(IntType), offsets,
+                     np.concatenate(elements).astype(IntType))
+        self._thread_partition_cache[key] = partition
+        return partition
+
     @cached_property
     def nnz(self):
         """Array containing the number of non-zeroes in the various rows of the
@@ -3599,6 +4446,10 @@ class Mat(DataCarrier):
     _globalcount = 0
     _modes = [WRITE, INC]
 
+    _is_matrix_free = False
+    """Do :func:`par_loop`\s into this ``Mat`` record the action of the
+    loop rather than assembling it?"""
+
     @validate_type(('sparsity', Sparsity, SparsityTypeError),
                    ('name', str, NameTypeError))
     def __init__(self, sparsity, dtype=None, name=None):
@@ -3644,6 +4495,25 @@ class Mat(DataCarrier):
         raise NotImplementedError(
             "Abstract Mat base class doesn't know how to set values.")
 
+    def addto_blocks(self, rows, cols, values):
+        """Add many blocks of values to the :class:`Mat`.
+
+        :arg rows: an array of shape ``(n, r)`` holding the rows of each
+            of the ``n`` blocks.
+        :arg cols: an array of shape ``(n, c)`` holding the columns of
+            each block.
+        :arg values: an array of shape ``(n, r * rdim, c * cdim)``
+            holding the values of each block."""
+        raise NotImplementedError(
+            "Abstract Mat base class doesn't know how to set values.")
+
+    def set_blocks(self, rows, cols, values):
+        """Set many blocks of values in the :class:`Mat`.
+
+        See :meth:`addto_blocks` for the arguments."""
+        raise NotImplementedError(
+            "Abstract Mat base class doesn't know how to set values.")
+
     @cached_property
     def _argtype(self):
         """Ctypes argtype for this :class:`Mat`"""
@@ -3908,7 +4778,7 @@ class JITModule(Cached):
                 else:
                     view_idx = None
                 key += (arg.data.dim, arg.data.dtype, map_arity,
-                        idx, view_idx, arg.access)
+                        idx, view_idx, arg.access, arg._map_dtype)
             elif arg._is_mat:
                 idxs = (arg.idx[0].__class__, arg.idx[0].index,
                         arg.idx[1].index)
@@ -3926,6 +4796,23 @@ class JITModule(Cached):
         if iterate is not None:
             key += ((iterate,))
 
+        if kwargs.get("owner_computes", False):
+            key += (("owner_computes",),)
+
+        if kwargs.get("vectorise_columns", False):
+            key += (("vectorise_columns",),)
+
+        batch = kwargs.get("mat_insertion_batch", 0)
+        if batch:
+            key += (("mat_insertion_batch", batch),)
+
+        if kwargs.get("mat_csr_insertion", False):
+            key += (("mat_csr_insertion",),)
+
+        nthreads = kwargs.get("mat_assembly_threads", 1)
+        if nthreads > 1:
+            key += (("mat_assembly_threads", nthreads),)
+
         return key
 
     def _dump_generated_code(self, src, ext=None):
@@ -4003,8 +4890,56 @@ class ParLoop(LazyComputation):
     An optional keyword argument, ``iterate``, can be used to specify
     which region of an :class:`ExtrudedSet` the parallel loop should
     iterate over.
+
+    An optional keyword argument, ``owner_computes``, (defaulting to
+    the ``owner_computes`` configuration option) requests that the
+    loop be executed over the target set of its indirect increments
+    if it is eligible (see :attr:`owner_map`).
+
+    An optional keyword argument, ``vectorise_columns``, (defaulting to
+    the ``vectorise_columns`` configuration option) requests that the
+    layers of each column of an :class:`ExtrudedSet` be executed as
+    independent iterations if the loop is eligible (see
+    :attr:`column_vectorised`).
+
+    An optional keyword argument, ``mat_insertion_batch``, (defaulting
+    to the ``mat_insertion_batch`` configuration option) gives the
+    number of element matrices to buffer before adding them to each
+    :class:`Mat` argument with a single call, if the loop is eligible
+    (see :attr:`mat_insertion_batch`).
+
+    An optional keyword argument, ``mat_csr_insertion``, (defaulting to
+    the ``mat_csr_insertion`` configuration option) requests that
+    element matrices be added directly into the value arrays of the
+    :class:`Mat` arguments if the loop is eligible (see
+    :attr:`mat_csr_insertion`).
+
+    An optional keyword argument, ``mat_assembly_threads``, (defaulting
+    to the ``mat_assembly_threads`` configuration option) gives the
+    number of threads adding element matrices into the value arrays of
+    the :class:`Mat` arguments if the loop is eligible (see
+    :attr:`mat_assembly_threads`).
     """
 
+    _owner_computes_supported = False
+    """Can this backend execute loops in owner-computes mode?"""
+
+    _column_vectorisation_supported = False
+    """Can this backend execute the layers of extruded columns as
+    independent iterations?"""
+
+    _mat_insertion_batching_supported = False
+    """Can this backend buffer element matrices and add them to a
+    :class:`Mat` in batches?"""
+
+    _mat_csr_insertion_supported = False
+    """Can this backend add element matrices directly into the value
+    array of a :class:`Mat`?"""
+
+    _threaded_assembly_supported = False
+    """Can this backend add element matrices into the value array of a
+    :class:`Mat` from several threads?"""
+
     @validate_type(('kernel', Kernel, KernelTypeError),
                    ('iterset', Set, SetTypeError))
     def __init__(self, kernel, iterset, *args, **kwargs):
@@ -4032,6 +4967,16 @@ class ParLoop(LazyComputation):
         self._is_layered = iterset._extruded
         self._iteration_region = kwargs.get("iterate", None)
         self._pass_layer_arg = kwargs.get("pass_layer_arg", False)
+        self._owner_computes = kwargs.get("owner_computes",
+                                          configuration["owner_computes"])
+        self._vectorise_columns = kwargs.get("vectorise_columns",
+                                             configuration["vectorise_columns"])
+        self._mat_insertion_batch = kwargs.get("mat_insertion_batch",
+                                               configuration["mat_insertion_batch"])
+        self._mat_csr_insertion = kwargs.get("mat_csr_insertion",
+                                             configuration["mat_csr_insertion"])
+        self._mat_assembly_threads = kwargs.get("mat_assembly_threads",
+                                                configuration["mat_assembly_threads"])
 
         if self._pass_layer_arg:
             if self.is_direct:
@@ -4096,13 +5041,29 @@ class ParLoop(LazyComputation):
     def num_flops(self):
         iterset = self.iterset
         size = iterset.size
+        if self.owner_map is not None:
+            # One kernel invocation per reference to an owned target
+            offsets, _ = self.owner_map._inverse
+            return offsets[self.owner_map.toset.size] * self._kernel.num_flops
         if self.needs_exec_halo:
             size = iterset.exec_size
         if self.is_indirect and iterset._extruded:
             region = self.iteration_region
-            if region is ON_INTERIOR_FACETS:
+            if region in [ON_TOP, ON_BOTTOM]:
+                pass
+            elif not iterset.constant_layers:
+                # Count the cells (or interior facets) actually visited
+                # in the columns of the executed entities
+                layers = iterset.layers_array
+                if isinstance(iterset, Subset):
+                    layers = layers[iterset.indices[:size]]
+                else:
+                    layers = layers[:size]
+                nlayers = layers[:, 1] - layers[:, 0]
+                size = (nlayers - (2 if region is ON_INTERIOR_FACETS else 1)).sum()
+            elif region is ON_INTERIOR_FACETS:
                 size *= iterset.layers - 2
-            elif region not in [ON_TOP, ON_BOTTOM]:
+            else:
                 size *= iterset.layers - 1
         return size * self._kernel.num_flops
 
@@ -4129,6 +5090,15 @@ class ParLoop(LazyComputation):
             # in case it's reused.
             for g in six.iterkeys(self._reduced_globals):
                 g._data[...] = 0
+            if self.owner_map is not None:
+                # Every owned target gathers its own contributions, so
+                # there is nothing to overlap the exchange with and
+                # no redundant computation in the exec halo.
+                self.halo_exchange_end()
+                toset = self.owner_map.toset
+                self._compute(SetPartition(toset, 0, toset.size), fun, *arglist)
+                self.update_arg_data_state()
+                return
             self._compute(iterset.core_part, fun, *arglist)
             self.halo_exchange_end()
             self._compute(iterset.owned_part, fun, *arglist)
@@ -4222,7 +5192,11 @@ class ParLoop(LazyComputation):
         for arg in self.args:
             if arg._is_dat:
                 if arg.access in [INC, WRITE, RW]:
-                    arg.data.needs_halo_update = True
+                    if arg._is_direct:
+                        for d in arg.data:
+                            d._record_direct_write(self.iterset)
+                    else:
+                        arg.data.needs_halo_update = True
                 for d in arg.data:
                     d._data.setflags(write=False)
             if arg._is_mat and arg.access is not READ:
@@ -4265,11 +5239,210 @@ class ParLoop(LazyComputation):
     def needs_exec_halo(self):
         """Does the parallel loop need an exec halo?
 
-        True if the parallel loop is not a "local" loop and there are
-        any indirect arguments that are not read-only."""
+        True if the parallel loop is not a "local" loop, is not executed
+        in owner-computes mode and there are any indirect arguments
+        that are not read-only."""
+        if self.owner_map is not None:
+            return False
         return not self._only_local and any(arg._is_indirect_and_not_read or arg._is_mat
                                             for arg in self.args)
 
+    @cached_property
+    def owner_map(self):
+        """The :class:`Map` through which this loop increments if it is
+        executed in owner-computes mode, otherwise ``None``.
+
+        In owner-computes mode, the loop runs over the owned entities
+        of the map's ``toset`` rather than over the iteration set.
+        Each target walks the map's :attr:`~Map.inverse` and, for
+        every source entity referencing it, executes the kernel into
+        scratch space and adds only its own contribution.  No two
+        targets write to the same data, so the loop needs neither
+        colouring nor atomics, and no computation is performed
+        redundantly in the exec halo, at the price of executing the
+        kernel once per reference rather than once per source entity.
+
+        A loop is eligible if its only modified arguments are
+        :class:`Dat`\s incremented through one and the same (non
+        mixed) map, and it has no :class:`Mat` or reduction arguments.
+        Extruded and subset iteration sets are not supported."""
+        if not (self._owner_computes and self._owner_computes_supported):
+            return None
+        iterset = self.iterset
+        if self._only_local or iterset._extruded or isinstance(iterset, Subset):
+            return None
+        owner = None
+        for arg in self.args:
+            if arg._is_mat or arg._is_global_reduction:
+                return None
+            if arg._is_read:
+                continue
+            if not arg._is_indirect_reduction or arg._is_mixed or \
+               arg._is_dat_view or arg._is_soa:
+                return None
+            if owner is None:
+                owner = arg.map
+            elif arg.map is not owner:
+                return None
+        return owner
+
+    @cached_property
+    def column_vectorised(self):
+        """Are the layers of each column of the extruded iteration set
+        executed as independent iterations?
+
+        By default, the generated code walks up each column bumping the
+        data pointers by the map offsets after every layer.  In column
+        vectorised mode the data pointers for layer ``j`` are computed
+        directly as ``values + j * offset`` and the layer loop is marked
+        ``#pragma GCC ivdep``.  This is only a hint to the compiler: the
+        kernel is still called once per layer, and the layers are only
+        executed with SIMD instructions if the compiler inlines the
+        kernel and can vectorise the resulting loop.  Whether this is
+        faster than the default depends on the kernel and the compiler
+        (``demo/extruded_columns.py`` compares the two).
+
+        A loop is eligible if it iterates over the cells (not the
+        interior facets) of an :class:`ExtrudedSet` and has neither
+        :class:`Mat`, iteration space nor reduction arguments.  Its
+        only modified arguments must be :class:`Dat`\s accessed through
+        vector maps whose entries in different layers never coincide
+        (see :attr:`Map._columns_disjoint`), and which no other argument
+        accesses."""
+        if not (self._vectorise_columns and self._column_vectorisation_supported):
+            return False
+        if not self._is_layered or self.is_direct or \
+           self.iteration_region == ON_INTERIOR_FACETS:
+            return False
+        for arg in self.args:
+            if arg._is_mat or arg._uses_itspace or arg._is_global_reduction:
+                return False
+            if arg._is_read:
+                continue
+            if not arg._is_vec_map or \
+               not all(m._columns_disjoint for m in arg.map) or \
+               any(a.data is arg.data for a in self.args if a is not arg):
+                return False
+        return True
+
+    @cached_property
+    def mat_insertion_batch(self):
+        """The number of element matrices buffered before they are added
+        to each :class:`Mat` argument of this loop, or 0 if they are
+        added one element at a time.
+
+        By default, the generated code calls ``MatSetValuesLocal`` (or
+        its blocked variant) once per element, and per layer for
+        extruded sets, each call translating its indices to the global
+        numbering.  In batched mode the element matrices and (unblocked)
+        row indices are copied into a buffer, and a full buffer is
+        translated with a single call to
+        ``ISLocalToGlobalMappingApply`` and added with a single call to
+        ``MatSetValuesBatch``.
+
+        A loop is eligible if all its :class:`Mat` arguments are
+        incremented (not written), are not mixed, and use the same map
+        (without component selection) for rows and columns with square
+        blocks, so that every element matrix is square with equal row
+        and column indices.  Block sparse matrices with blocks larger
+        than 1x1 are not eligible: ``MatSetValuesBatch`` inserts
+        unblocked values, which for them is slower than inserting each
+        element matrix blocked."""
+        batch = self._mat_insertion_batch
+        if not (batch > 0 and self._mat_insertion_batching_supported) or \
+           self.mat_csr_insertion:
+            return 0
+        mat_args = [arg for arg in self.args if arg._is_mat]
+        if not mat_args:
+            return 0
+        for arg in mat_args:
+            rmap, cmap = arg.map
+            if arg.access is not INC or arg._is_mixed or \
+               rmap is None or rmap is not cmap or \
+               rmap.vector_index is not None:
+                return 0
+            rdim, cdim = arg.data.dims[0][0]
+            if rdim != cdim or (rdim > 1 and arg.data.sparsity._block_sparse):
+                return 0
+        return batch
+
+    @cached_property
+    def mat_csr_insertion(self):
+        """Are element matrices added directly into the value arrays of
+        the :class:`Mat` arguments of this loop?
+
+        Each entry of an element matrix is normally added with
+        ``MatSetValuesLocal``, which translates its indices and
+        searches the row for the column each time the matrix is
+        assembled.  When inserting directly, the position of every
+        entry in the CSR value array is computed once from the
+        :class:`Sparsity` and cached on it for the pair of maps (see
+        :meth:`Sparsity._csr_offsets`), and the generated code adds
+        into the array without calling PETSc at all.  This takes
+        precedence over :attr:`mat_insertion_batch`, and is implied by
+        :attr:`mat_assembly_threads`.
+
+        A loop is eligible if it does not iterate over an
+        :class:`ExtrudedSet`, and all its :class:`Mat` arguments are
+        serial, not mixed, incremented or written, and accessed through
+        maps without component selection."""
+        if not ((self._mat_csr_insertion or self.mat_assembly_threads > 1) and
+                self._mat_csr_insertion_supported):
+            return False
+        return self._mat_csr_insertable
+
+    @cached_property
+    def _mat_csr_insertable(self):
+        if self._is_layered:
+            return False
+        mat_args = [arg for arg in self.args if arg._is_mat]
+        if not mat_args:
+            return False
+        for arg in mat_args:
+            rmap, cmap = arg.map
+            sparsity = arg.data.sparsity
+            if arg.access not in [INC, WRITE] or arg._is_mixed or \
+               rmap is None or cmap is None or \
+               rmap.vector_index is not None or cmap.vector_index is not None:
+                return False
+            if sparsity.comm.size > 1 or sparsity.rowptr is None or \
+               len(sparsity.rowptr) == 0:
+                return False
+        return True
+
+    @cached_property
+    def mat_assembly_threads(self):
+        """The number of threads adding element matrices into the value
+        array of the :class:`Mat` argument of this loop, or 1 if it is
+        assembled in serial.
+
+        Threads inserting into the same matrix would race on shared
+        rows.  Instead, the rows of the :class:`Sparsity` are split
+        into contiguous blocks with balanced numbers of nonzeros, one
+        per thread, and each thread executes the elements contributing
+        to its rows (found with the inverse of the row map), adding
+        only the entries in its own block at their precomputed
+        positions (see :attr:`mat_csr_insertion` and
+        :meth:`Sparsity._thread_partition`).  Elements straddling
+        several blocks are computed by each of the threads owning
+        them.
+
+        A loop is eligible if it is eligible for
+        :attr:`mat_csr_insertion`, does not iterate over a
+        :class:`Subset`, has exactly one :class:`Mat` argument, and
+        only reads its other arguments."""
+        nthreads = self._mat_assembly_threads
+        if not (nthreads > 1 and self._threaded_assembly_supported):
+            return 1
+        if isinstance(self.iterset, Subset) or not self._mat_csr_insertable:
+            return 1
+        mat_args = [arg for arg in self.args if arg._is_mat]
+        if len(mat_args) != 1:
+            return 1
+        if any(arg.access is not READ for arg in self.args if not arg._is_mat):
+            return 1
+        return nthreads
+
     @cached_property
     def kernel(self):
         """Kernel executed by this parallel loop."""
@@ -4392,6 +5565,10 @@ def par_loop(kernel, it_space, *args, **kwargs):
         into the kernel (as an ``int``). Only makes sense for
         indirect extruded iteration.
 
+    :kwarg vectorise: Should a Python function kernel be called once
+        with the data of all the iteration set entities, rather than
+        once per entity (see :mod:`pyop2.pyparloop`)?
+
     .. warning ::
         It is the caller's responsibility that the number and type of all
         :class:`base.Arg`\s passed to the :func:`par_loop` match those expected
@@ -4428,8 +5605,17 @@ def par_loop(kernel, it_space, *args, **kwargs):
     :class:`Map`, however no indices are passed so all entries of
     ``elem_node`` for the relevant member of ``elements`` will be
     passed to the kernel as a vector.
+
+    If the :class:`Mat` is matrix-free (see
+    :class:`~.petsc_base.MatrixFreeMat`), the loop is not executed but
+    recorded by the matrix, which applies its action when multiplied.
     """
     if isinstance(kernel, types.FunctionType):
         from pyop2 import pyparloop
         return pyparloop.ParLoop(pyparloop.Kernel(kernel), it_space, *args, **kwargs).enqueue()
+    for arg in args:
+        if arg._is_mat and arg.data._is_matrix_free:
+            # Nothing is assembled, the matrix applies the loop's
+            # action when multiplied.
+            return arg.data._add_action(kernel, it_space, args, kwargs)
     return _make_object('ParLoop', kernel, it_space, *args, **kwargs).enqueue()
@@ -0,0 +1,342 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Parallel checkpointing of :class:`~.Dat`\s, :class:`~.Global`\s
+and :class:`~.Mat`\s to a single HDF5 file.
+
+A checkpoint file holds one entry per named object:
+
+- a :class:`~.Dat` is stored as a dataset of shape ``(global size, ) +
+  dim`` holding the owned values of all processes, ordered by
+  process (or by a user supplied global numbering);
+- a :class:`~.MixedDat` is stored as a group of such datasets named
+  ``"0"``, ``"1"``, ...;
+- a :class:`~.Global` is stored as a dataset of its value;
+- a (non-nested) :class:`~.Mat` is stored as a group holding the
+  assembled matrix in CSR format (``rowptr``, ``colidx`` and
+  ``values``, in PETSc's global numbering).
+
+Since the layout does not depend on the number of processes,
+:func:`restart` may read a file written by a different number of
+processes: each process reads back just the rows it now owns.
+
+In parallel, h5py must be built with MPI support.
+"""
+
+from __future__ import absolute_import, print_function, division
+import six
+
+import numpy as np
+
+from pyop2 import base
+from pyop2.configuration import configuration
+from pyop2.exceptions import DataValueError
+from pyop2.logger import info
+from pyop2.mpi import MPI, COMM_WORLD, collective
+from pyop2.profiling import timed_region
+
+__all__ = ['checkpoint', 'restart']
+
+
+def _open(filename, mode, comm):
+    import h5py
+    if comm.size > 1:
+        if not h5py.get_config().mpi:
+            raise RuntimeError("Parallel checkpointing requires h5py built with MPI support")
+        return h5py.File(filename, mode, driver='mpio', comm=comm)
+    return h5py.File(filename, mode)
+
+
+def _transfer(comm):
+    """A dataset transfer property list for collective accesses, if
+    running in parallel."""
+    from h5py import h5fd, h5p
+    dxpl = h5p.create(h5p.DATASET_XFER)
+    if comm.size > 1:
+        dxpl.set_dxpl_mpio(h5fd.MPIO_COLLECTIVE)
+    return dxpl
+
+
+def _select_rows(dset, runs):
+    """A dataspace selecting the rows of ``dset`` in the ``(start,
+    stop)`` ranges ``runs`` (which may select nothing)."""
+    from h5py import h5s
+    fspace = dset.id.get_space()
+    fspace.select_none()
+    for start, stop in runs:
+        if stop > start:
+            fspace.select_hyperslab((int(start), ) + (0, ) * (len(dset.shape) - 1),
+                                    (int(stop - start), ) + dset.shape[1:],
+                                    op=h5s.SELECT_OR)
+    return fspace
+
+
+def _write_rows(dset, runs, values, comm):
+    """Write ``values`` to the rows of ``dset`` in the ``(start,
+    stop)`` ranges ``runs``.
+
+    Every process issues exactly one (collective) write, even if it
+    writes nothing: h5py's slicing skips empty selections, which would
+    leave the other processes waiting, and parallel HDF5 requires
+    collective writes to compressed datasets."""
+    from h5py import h5s
+    dset.id.write(h5s.create_simple(values.shape), _select_rows(dset, runs),
+                  np.ascontiguousarray(values), dxpl=_transfer(comm))
+
+
+def _read_rows(dset, start, stop, comm):
+    """Read rows ``start`` to ``stop`` of ``dset`` with exactly one
+    (collective) read on every process (see :func:`_write_rows`)."""
+    from h5py import h5s
+    values = np.empty((stop - start, ) + dset.shape[1:], dtype=dset.dtype)
+    dset.id.read(h5s.create_simple(values.shape), _select_rows(dset, [(start, stop)]),
+                 values, dxpl=_transfer(comm))
+    return values
+
+
+def _create_dataset(group, name, shape, dtype, compression):
+    """Create a dataset chunked in pieces of at most
+    ``hdf5_chunk_size`` bytes."""
+    shape = tuple(shape)
+    chunks = None
+    if compression is not None and shape[0] > 0:
+        row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape[1:], dtype=int))
+        rows = max(1, configuration["hdf5_chunk_size"] // max(1, row_bytes))
+        chunks = (min(rows, shape[0]), ) + shape[1:]
+    else:
+        compression = None
+    return group.create_dataset(name, shape=shape, dtype=dtype,
+                                chunks=chunks, compression=compression)
+
+
+def _offset(comm, size):
+    offset = comm.exscan(size)
+    return 0 if offset is None else offset
+
+
+def _runs(indices):
+    """Split ``indices`` into runs of consecutive values.
+
+    :returns: a list of ``(start, stop)`` pairs into ``indices``."""
+    if len(indices) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(indices) != 1) + 1
+    bounds = np.concatenate(([0], breaks, [len(indices)]))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _write_dat(group, name, dat, comm, compression, numbering):
+    data = dat.data_ro
+    size = comm.allreduce(len(data))
+    dset = _create_dataset(group, name, (size, ) + data.shape[1:],
+                           data.dtype, compression)
+    dset.attrs['type'] = 'dat'
+    if numbering is None:
+        offset = _offset(comm, len(data))
+        _write_rows(dset, [(offset, offset + len(data))], data, comm)
+    else:
+        numbering = np.asarray(numbering)
+        if numbering.shape != (len(data), ):
+            raise DataValueError("Numbering for %s must have one entry per owned value" % name)
+        order = np.argsort(numbering, kind='mergesort')
+        indices = numbering[order]
+        # The runs of consecutive rows, written with a single selection
+        runs = [(indices[start], indices[stop - 1] + 1) for start, stop in _runs(indices)]
+        _write_rows(dset, runs, data[order], comm)
+    return data.nbytes
+
+
+def _read_dat(group, name, dat, comm, numbering):
+    dset = group[name]
+    data = dat.data
+    if numbering is None:
+        size = comm.allreduce(len(data))
+        if dset.shape[0] != size:
+            raise DataValueError("%s has %d values, but %s holds %d"
+                                 % (dat.name, size, name, dset.shape[0]))
+        offset = _offset(comm, len(data))
+        data[:] = _read_rows(dset, offset, offset + len(data), comm)
+    else:
+        data[:] = base._hdf5_read_rows(dset, numbering)
+    return data.nbytes
+
+
+def _write_mat(group, name, mat, comm, compression):
+    if mat.sparsity.nested:
+        raise NotImplementedError("Can't checkpoint nested Mat %s" % mat.name)
+    mat.assemble()
+    base._trace.evaluate(set([mat]), set())
+    handle = mat.handle
+    nrows = handle.getSize()[0]
+    rstart, rend = handle.getOwnershipRange()
+    rowptr, colidx, values = handle.getValuesCSR()
+    nnz = len(values)
+    offset = _offset(comm, nnz)
+    total = comm.allreduce(nnz)
+    grp = group.create_group(name)
+    grp.attrs['type'] = 'mat'
+    grp.attrs['shape'] = handle.getSize()
+    drowptr = _create_dataset(grp, 'rowptr', (nrows + 1, ), rowptr.dtype, compression)
+    dcolidx = _create_dataset(grp, 'colidx', (total, ), colidx.dtype, compression)
+    dvalues = _create_dataset(grp, 'values', (total, ), values.dtype, compression)
+    # The process owning the last row also writes the end pointer
+    stop = rend + 1 if rend == nrows else rend
+    _write_rows(drowptr, [(rstart, stop)], rowptr[:stop - rstart] + offset, comm)
+    _write_rows(dcolidx, [(offset, offset + nnz)], colidx, comm)
+    _write_rows(dvalues, [(offset, offset + nnz)], values, comm)
+    return rowptr.nbytes + colidx.nbytes + values.nbytes
+
+
+def _read_mat(group, name, mat, comm):
+    if mat.sparsity.nested:
+        raise NotImplementedError("Can't restart nested Mat %s" % mat.name)
+    base._trace.evaluate(set([mat]), set([mat]))
+    grp = group[name]
+    handle = mat.handle
+    if tuple(grp.attrs['shape']) != tuple(handle.getSize()):
+        raise DataValueError("%s has shape %s, but %s has shape %s"
+                             % (mat.name, handle.getSize(), name, tuple(grp.attrs['shape'])))
+    rstart, rend = handle.getOwnershipRange()
+    drowptr, dcolidx, dvalues = grp['rowptr'], grp['colidx'], grp['values']
+    rowptr = _read_rows(drowptr, rstart, rend + 1, comm)
+    lo, hi = rowptr[0], rowptr[-1]
+    colidx = _read_rows(dcolidx, lo, hi, comm)
+    values = _read_rows(dvalues, lo, hi, comm)
+    handle.zeroEntries()
+    handle.setValuesCSR(rowptr - lo, colidx, values)
+    handle.assemble()
+    mat.assembly_state = base.Mat.ASSEMBLED
+    return rowptr.nbytes + colidx.nbytes + values.nbytes
+
+
+def _comm(objects):
+    for obj in six.itervalues(objects):
+        if isinstance(obj, base.Global):
+            continue
+        return obj.comm
+    return COMM_WORLD
+
+
+def _report(what, filename, nbytes, comm, elapsed):
+    nbytes = comm.allreduce(nbytes)
+    elapsed = comm.allreduce(elapsed, op=MPI.MAX)
+    rate = nbytes / elapsed / 1e9 if elapsed > 0 else float('inf')
+    info("%s %s: %d bytes in %.3fs (%.3f GB/s)", what, filename, nbytes, elapsed, rate)
+    return rate
+
+
+@collective
+def checkpoint(filename, objects, compression=None, numbering=None):
+    """Write a collection of objects to a single HDF5 file.
+
+    :arg filename: the file to write (it is overwritten).
+    :arg objects: a dict mapping names to :class:`~.Dat`\s,
+        :class:`~.Global`\s or :class:`~.Mat`\s.
+    :arg compression: HDF5 compression filter (e.g. ``"gzip"``).  If
+        given, datasets are chunked in pieces of at most
+        ``hdf5_chunk_size`` bytes and compressed.  Parallel writes of
+        compressed data need HDF5 1.10.2 or later.
+    :arg numbering: an optional dict mapping names of :class:`~.Dat`\s
+        to the global numbers of their owned entries.  Values are
+        stored in this order rather than in process order.
+    :returns: the achieved write bandwidth in GB/s.
+    """
+    numbering = numbering or {}
+    comm = _comm(objects)
+    nbytes = 0
+    with timed_region("Checkpoint write"):
+        start = MPI.Wtime()
+        with _open(filename, 'w', comm) as f:
+            for name in sorted(objects):
+                obj = objects[name]
+                if isinstance(obj, base.MixedDat):
+                    grp = f.create_group(name)
+                    grp.attrs['type'] = 'mixed_dat'
+                    for i, dat in enumerate(obj.split):
+                        nbytes += _write_dat(grp, str(i), dat, comm, compression, None)
+                elif isinstance(obj, base.Dat):
+                    nbytes += _write_dat(f, name, obj, comm, compression,
+                                         numbering.get(name))
+                elif isinstance(obj, base.Global):
+                    dset = f.create_dataset(name, data=obj.data_ro)
+                    dset.attrs['type'] = 'global'
+                    nbytes += obj.data_ro.nbytes
+                elif isinstance(obj, base.Mat):
+                    nbytes += _write_mat(f, name, obj, comm, compression)
+                else:
+                    raise TypeError("Don't know how to checkpoint %r" % obj)
+        elapsed = MPI.Wtime() - start
+    return _report("Checkpointed", filename, nbytes, comm, elapsed)
+
+
+@collective
+def restart(filename, objects, numbering=None):
+    """Read a collection of objects written by :func:`checkpoint`.
+
+    The objects must already exist with the same global sizes, but
+    may be distributed differently (and over a different number of
+    processes) from when the checkpoint was written.
+
+    :arg filename: the file to read.
+    :arg objects: a dict mapping names to the :class:`~.Dat`\s,
+        :class:`~.Global`\s or :class:`~.Mat`\s to read into.
+    :arg numbering: an optional dict mapping names of :class:`~.Dat`\s
+        to the global numbers of their owned entries.  Use this to
+        read values into a :class:`~.Dat` whose global numbering
+        differs from that at checkpoint time.
+    :returns: the achieved read bandwidth in GB/s.
+    """
+    numbering = numbering or {}
+    comm = _comm(objects)
+    nbytes = 0
+    with timed_region("Checkpoint read"):
+        start = MPI.Wtime()
+        with _open(filename, 'r', comm) as f:
+            for name in sorted(objects):
+                obj = objects[name]
+                if isinstance(obj, base.MixedDat):
+                    grp = f[name]
+                    for i, dat in enumerate(obj.split):
+                        nbytes += _read_dat(grp, str(i), dat, comm, None)
+                elif isinstance(obj, base.Dat):
+                    nbytes += _read_dat(f, name, obj, comm, numbering.get(name))
+                elif isinstance(obj, base.Global):
+                    obj.data = f[name][...]
+                    nbytes += obj.data_ro.nbytes
+                elif isinstance(obj, base.Mat):
+                    nbytes += _read_mat(f, name, obj, comm)
+                else:
+                    raise TypeError("Don't know how to restart %r" % obj)
+        elapsed = MPI.Wtime() - start
+    return _report("Restarted", filename, nbytes, comm, elapsed)
@@ -75,6 +75,58 @@ class Configuration(dict):
         cdim > 1 be built as block sparsities, or dof sparsities.  The
         former saves memory but changes which preconditioners are
         available for the resulting matrices.  (Default yes)
+    :param sparsity_threads: Number of threads used to build sparsity
+        patterns.  (Default 1)
+    :param sparsity_builder: How to build sparsity patterns, either
+        "vecset" (insert into a set per row) or "sort" (two-pass
+        counting sort, which has predictable memory use and builds
+        extruded patterns in closed form from the base mesh).
+        (Default "vecset")
+    :param sparsity_disk_cache: Should sparsity patterns be cached on
+        disk (in a "sparsity" subdirectory of `cache_dir`) and reused
+        across runs?  (Default no)
+    :param mat_coo_preallocation: Should the nonzero pattern of parallel
+        matrices be set up by coordinate (COO) preallocation, rather
+        than by inserting zeros element by element?  Requires PETSc
+        3.16 or later.  (Default no)
+    :param intern_map_values: Should :class:`~.Map`\s with identical
+        values share a single read-only buffer (and be treated as
+        equivalent by the :class:`~.Sparsity` cache)?  (Default no)
+    :param compact_maps: Should the maps of indirect :class:`~.Dat`
+        arguments be passed to generated code as 32-bit integers
+        (where the values fit), halving the memory traffic for map
+        reads if PETSc uses 64-bit integers?  (Default no)
+    :param owner_computes: Should indirect loops that only increment
+        :class:`~.Dat`\s through a single map be executed over the
+        target set, each target gathering the contributions of the
+        source entities referencing it, rather than over the source
+        set with redundant computation in the exec halo?  (Default no)
+    :param vectorise_columns: Should the layers of each column of an
+        extruded iteration set be executed as independent iterations
+        (where the loop allows it), hinting to the compiler that it may
+        vectorise across layers?  (Default no)
+    :param mat_insertion_batch: Number of element matrices buffered
+        by the generated code before they are added to a
+        :class:`~.Mat` with a single call (where the loop allows it),
+        rather than one call per element.  0 disables batching.
+        (Default 0)
+    :param mat_csr_insertion: Should the generated code add element
+        matrices directly into the value array of a serial
+        :class:`~.Mat` (where the loop allows it), using the positions
+        of the entries precomputed from the sparsity, rather than
+        calling ``MatSetValues``?  (Default no)
+    :param mat_assembly_threads: Number of OpenMP threads adding
+        element matrices directly into the value array of a serial
+        :class:`~.Mat` (where the loop allows it), each thread owning
+        a block of rows and executing the elements contributing to
+        them.  1 assembles in serial.  (Default 1)
+    :param numba_kernels: Should Python function kernels be compiled
+        with Numba, which must be installed, rather than executed by
+        the interpreter?  (Default no)
+    :param hdf5_chunk_size: Maximum number of bytes read from an HDF5
+        dataset at once when loading distributed data with
+        :meth:`~.Dat.fromhdf5` and :meth:`~.Map.fromhdf5`.  (Default
+        64MB)
     """
     # name, env variable, type, default, write once
     DEFAULTS = {
@@ -101,6 +153,19 @@ class Configuration(dict):
                               os.path.join(gettempdir(), "pyop2-gencode")),
         "matnest": ("PYOP2_MATNEST", bool, True),
         "block_sparsity": ("PYOP2_BLOCK_SPARSITY", bool, True),
+        "sparsity_threads": ("PYOP2_SPARSITY_THREADS", int, 1),
+        "sparsity_builder": ("PYOP2_SPARSITY_BUILDER", str, "vecset"),
+        "sparsity_disk_cache": ("PYOP2_SPARSITY_DISK_CACHE", bool, False),
+        "mat_coo_preallocation": ("PYOP2_MAT_COO_PREALLOCATION", bool, False),
+        "hdf5_chunk_size": ("PYOP2_HDF5_CHUNK_SIZE", int, 64 << 20),
+        "intern_map_values": ("PYOP2_INTERN_MAP_VALUES", bool, False),
+        "compact_maps": ("PYOP2_COMPACT_MAPS", bool, False),
+        "owner_computes": ("PYOP2_OWNER_COMPUTES", bool, False),
+        "vectorise_columns": ("PYOP2_VECTORISE_COLUMNS", bool, False),
+        "mat_insertion_batch": ("PYOP2_MAT_INSERTION_BATCH", int, 0),
+        "mat_csr_insertion": ("PYOP2_MAT_CSR_INSERTION", bool, False),
+        "mat_assembly_threads": ("PYOP2_MAT_ASSEMBLY_THREADS", int, 1),
+        "numba_kernels": ("PYOP2_NUMBA_KERNELS", bool, False),
     }
     """Default values for PyOP2 configuration parameters"""
 
@@ -45,6 +45,7 @@ from collections import OrderedDict
 from hashlib import md5
 
 import pyop2.base as base
+from pyop2.datatypes import IntType
 import pyop2.sequential as sequential
 from pyop2.utils import flatten, strip, as_tuple
 from pyop2.mpi import collective
@@ -61,6 +62,9 @@ class FusionArg(sequential.Arg):
 
     """An Arg specialized for kernels and loops subjected to any kind of fusion."""
 
+    # Fused kernels are handed the maps unchanged
+    _map_dtype = IntType
+
     def __init__(self, arg, gather=None, c_index=False):
         """Initialize a :class:`FusionArg`.
 
@@ -330,7 +334,11 @@ class ParLoop(sequential.ParLoop):
 
     """The root class of non-sequential parallel loops."""
 
-    pass
+    _owner_computes_supported = False
+    _column_vectorisation_supported = False
+    _mat_insertion_batching_supported = False
+    _mat_csr_insertion_supported = False
+    _threaded_assembly_supported = False
 
 
 class FusionParLoop(ParLoop):
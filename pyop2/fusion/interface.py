@@ -40,6 +40,7 @@ import os
 from contextlib import contextmanager
 
 from pyop2.base import _LazyMatOp
+from pyop2.snapshot import Snapshot
 from pyop2.mpi import MPI
 from pyop2.logger import warning, debug
 from pyop2.utils import flatten
@@ -88,9 +89,9 @@ def fuse(name, loop_chain, **kwargs):
     if len(loop_chain) in [0, 1]:
         return loop_chain
 
-    # Are there _LazyMatOp objects (i.e., synch points) preventing fusion?
+    # Are there _LazyMatOp or Snapshot objects (i.e., synch points) preventing fusion?
     remainder = []
-    synch_points = [l for l in loop_chain if isinstance(l, _LazyMatOp)]
+    synch_points = [l for l in loop_chain if isinstance(l, (_LazyMatOp, Snapshot))]
     if synch_points:
         # Fuse only the sub-sequence before the first synch point
         synch_point = loop_chain.index(synch_points[0])
@@ -38,6 +38,7 @@ from functools import partial
 import numpy as np
 
 from pyop2.datatypes import IntType
+from pyop2.configuration import configuration
 from pyop2 import base
 from pyop2 import mpi
 from pyop2 import sparsity
@@ -594,6 +595,22 @@ class MatBlock(base.Mat):
         return base._LazyMatOp(self, closure, new_state=Mat.INSERT_VALUES,
                                write=True).enqueue()
 
+    def addto_blocks(self, rows, cols, values):
+        """Add many blocks of values to the :class:`Mat`."""
+        closure = partial(self.handle.setValuesBlockedLocalRCV,
+                          rows, cols, values.reshape(len(rows), -1),
+                          addv=PETSc.InsertMode.ADD_VALUES)
+        return base._LazyMatOp(self, closure, new_state=Mat.ADD_VALUES,
+                               read=True, write=True).enqueue()
+
+    def set_blocks(self, rows, cols, values):
+        """Set many blocks of values in the :class:`Mat`."""
+        closure = partial(self.handle.setValuesBlockedLocalRCV,
+                          rows, cols, values.reshape(len(rows), -1),
+                          addv=PETSc.InsertMode.INSERT_VALUES)
+        return base._LazyMatOp(self, closure, new_state=Mat.INSERT_VALUES,
+                               write=True).enqueue()
+
     def assemble(self):
         raise RuntimeError("Should never call assemble on MatBlock")
 
@@ -733,12 +750,33 @@ class Mat(base.Mat):
             # the /dof/ sparsity.
             block_sparse = False
             create = mat.createAIJ
-        create(size=((self.nrows, None),
-                     (self.ncols, None)),
-               nnz=(self.sparsity.nnz, self.sparsity.onnz),
-               bsize=(rdim, cdim),
-               comm=self.comm)
+        # If we know the full pattern (serial, non-mixed), preallocate
+        # directly from the CSR structure: this inserts the nonzero
+        # pattern, so we need not walk the maps to fill in zeros.
+        rowptr = self.sparsity.rowptr
+        use_csr = self.comm.size == 1 and rowptr is not None and len(rowptr) > 0
+        use_coo = (not use_csr and not block_sparse and
+                   configuration["mat_coo_preallocation"] and
+                   not self.sparsity.maps[0][0].iterset._extruded)
+        with timed_region("MatZeroInitial"):
+            if use_csr:
+                create(size=((self.nrows, None),
+                             (self.ncols, None)),
+                       csr=(rowptr, self.sparsity.colidx),
+                       bsize=(rdim, cdim),
+                       comm=self.comm)
+            else:
+                create(size=((self.nrows, None),
+                             (self.ncols, None)),
+                       nnz=(self.sparsity.nnz, self.sparsity.onnz),
+                       bsize=(rdim, cdim),
+                       comm=self.comm)
         mat.setLGMap(rmap=row_lg, cmap=col_lg)
+        if use_coo:
+            with timed_region("MatZeroInitial"):
+                rows, cols = self._coo_pattern()
+                mat.setPreallocationCOOLocal(rows, cols)
+                mat.setValuesCOO(np.zeros(len(rows), dtype=PETSc.ScalarType))
         # Do not stash entries destined for other processors, just drop them
         # (we take care of those in the halo)
         mat.setOption(mat.Option.IGNORE_OFF_PROC_ENTRIES, True)
@@ -758,8 +796,9 @@ class Mat(base.Mat):
         mat.setOption(mat.Option.UNUSED_NONZERO_LOCATION_ERR, True)
 
         # Put zeros in all the places we might eventually put a value.
-        with timed_region("MatZeroInitial"):
-            sparsity.fill_with_zeros(mat, self.sparsity.dims[0][0], self.sparsity.maps, set_diag=self.sparsity._has_diagonal)
+        if not (use_csr or use_coo):
+            with timed_region("MatZeroInitial"):
+                sparsity.fill_with_zeros(mat, self.sparsity.dims[0][0], self.sparsity.maps, set_diag=self.sparsity._has_diagonal)
 
         # Now we've filled up our matrix, so the sparsity is
         # "complete", we can ignore subsequent zero entries.
@@ -767,6 +806,32 @@ class Mat(base.Mat):
             mat.setOption(mat.Option.IGNORE_ZERO_ENTRIES, True)
         self.handle = mat
 
+    def _coo_pattern(self):
+        """Return the (process local, unblocked) row and column indices
+        of every entry we might insert into, as coordinate arrays.
+
+        Rows owned by other processes are dropped, since we ignore
+        off-process entries."""
+        rdim, cdim = self.dims[0][0]
+        rows = []
+        cols = []
+        for rmap, cmap in self.sparsity.maps:
+            n = rmap.iterset.exec_size
+            r = rmap.values_with_halo[:n]
+            c = cmap.values_with_halo[:n]
+            r = (rdim * r[:, :, np.newaxis] + np.arange(rdim, dtype=IntType)).reshape(n, -1)
+            c = (cdim * c[:, :, np.newaxis] + np.arange(cdim, dtype=IntType)).reshape(n, -1)
+            rows.append(np.repeat(r, c.shape[1], axis=1).reshape(-1))
+            cols.append(np.tile(c, (1, r.shape[1])).reshape(-1))
+        if self.sparsity._has_diagonal:
+            diag = np.arange(min(self.nrows, self.ncols), dtype=IntType)
+            rows.append(diag)
+            cols.append(diag)
+        rows = np.concatenate(rows)
+        cols = np.concatenate(cols)
+        keep = (rows >= 0) & (rows < self.nrows) & (cols >= 0)
+        return rows[keep], cols[keep]
+
     def _init_global_block(self):
         """Initialise this block in the case where the matrix maps either
         to or from a :class:`Global`"""
@@ -817,9 +882,19 @@ class Mat(base.Mat):
 
     @collective
     def zero(self):
-        """Zero the matrix."""
+        """Zero the matrix.
+
+        This also freezes the nonzero pattern of the matrix: it is
+        already complete, so adding to an entry outside it is an error
+        and subsequent assemblies skip checking whether any process
+        changed its nonzero structure."""
         base._trace.evaluate(set(), set([self]))
+        for m in (self if self.sparsity.nested else [self]):
+            if any(isinstance(d, GlobalDataSet) for d in m.sparsity.dsets):
+                continue
+            m.handle.setOption(m.handle.Option.NEW_NONZERO_LOCATION_ERR, True)
         self.handle.zeroEntries()
+        self.assembly_state = Mat.ASSEMBLED
 
     @collective
     def zero_rows(self, rows, diag_val=1.0):
@@ -899,6 +974,22 @@ class Mat(base.Mat):
         return base._LazyMatOp(self, closure, new_state=Mat.INSERT_VALUES,
                                write=True).enqueue()
 
+    def addto_blocks(self, rows, cols, values):
+        """Add many blocks of values to the :class:`Mat`."""
+        closure = partial(self.handle.setValuesBlockedLocalRCV,
+                          rows, cols, values.reshape(len(rows), -1),
+                          addv=PETSc.InsertMode.ADD_VALUES)
+        return base._LazyMatOp(self, closure, new_state=Mat.ADD_VALUES,
+                               read=True, write=True).enqueue()
+
+    def set_blocks(self, rows, cols, values):
+        """Set many blocks of values in the :class:`Mat`."""
+        closure = partial(self.handle.setValuesBlockedLocalRCV,
+                          rows, cols, values.reshape(len(rows), -1),
+                          addv=PETSc.InsertMode.INSERT_VALUES)
+        return base._LazyMatOp(self, closure, new_state=Mat.INSERT_VALUES,
+                               write=True).enqueue()
+
     @utils.cached_property
     def blocks(self):
         """2-dimensional array of matrix blocks."""
@@ -918,6 +1009,154 @@ class Mat(base.Mat):
             return self.handle[:, :]
 
 
+class MatrixFreeMat(base.Mat):
+    """OP2 matrix which is never assembled.
+
+    A :func:`par_loop` incrementing a ``MatrixFreeMat`` does not
+    compute anything: the matrix records the loop instead, and
+    multiplying by it (see :meth:`mult`) executes a loop computing
+    the element matrices and applying them to the input :class:`Dat`
+    on the fly.  This saves storing (and streaming through) the
+    assembled matrix, at the cost of recomputing the element matrices
+    on every multiplication.  The arguments other than the matrix are
+    read when multiplying, so the matrix sees their current values.
+
+    The matrix is available to PETSc as a Python :class:`PETSc.Mat`
+    (see :attr:`handle`), for use with iterative solvers.  Mixed
+    matrices, and loops which do anything but read their other
+    arguments, are not supported."""
+
+    _is_matrix_free = True
+
+    def __init__(self, *args, **kwargs):
+        base.Mat.__init__(self, *args, **kwargs)
+        if not self.dtype == PETSc.ScalarType:
+            raise RuntimeError("Can only create a matrix of type %s, %s is not supported"
+                               % (PETSc.ScalarType, self.dtype))
+        if self.sparsity.shape != (1, 1) or \
+           any(isinstance(d, GlobalDataSet) for d in self.sparsity.dsets):
+            raise NotImplementedError("Matrix-free mixed matrices are not supported")
+        self._actions = []
+
+    @utils.cached_property
+    def handle(self):
+        """A Python :class:`PETSc.Mat` applying this matrix."""
+        mat = PETSc.Mat().createPython(((self.nrows, None), (self.ncols, None)),
+                                       comm=self.comm)
+        mat.setPythonContext(_MatrixFreePayload(self))
+        mat.setUp()
+        return mat
+
+    def _add_action(self, kernel, iterset, args, kwargs):
+        """Record the :func:`par_loop` executing ``kernel`` over
+        ``iterset`` with ``args``, one of which increments this
+        matrix, by building a loop applying its action."""
+        mat_arg, = [arg for arg in args if arg._is_mat and arg.data is self]
+        others = [arg for arg in args if arg is not mat_arg]
+        if mat_arg.access is not base.INC:
+            raise NotImplementedError("Matrix-free matrices can only be incremented")
+        if kernel._cpp:
+            raise NotImplementedError("Matrix-free matrices do not support C++ kernels")
+        if any(arg._is_mat or arg.access is not base.READ or arg._uses_itspace
+               for arg in others):
+            raise NotImplementedError("Matrix-free loops may only read their other arguments")
+        rmap, cmap = mat_arg.map
+        if rmap.vector_index is not None or cmap.vector_index is not None:
+            raise NotImplementedError("Matrix-free matrices do not support component maps")
+        rdim, cdim = self.dims[0][0]
+        facet = kwargs.get("iterate") is base.ON_INTERIOR_FACETS
+        nrows = rmap.arity * rdim * (2 if facet else 1)
+        ncols = cmap.arity * cdim * (2 if facet else 1)
+        # The kernel computes the element matrix into a local buffer
+        # and we multiply it into the vectors through their maps.  The
+        # other arguments are passed through as they are.
+        name = "%s_action" % kernel.name
+        params = ["%s **action_y" % self.ctype, "%s **action_x" % self.ctype]
+        params += ["void *action_arg%d" % n for n in range(len(others))]
+        call = ["action_arg%d" % n for n in range(len(others))]
+        position, = [n for n, arg in enumerate(args) if arg is mat_arg]
+        call.insert(position, "(void *)action_A")
+        if kwargs.get("pass_layer_arg", False):
+            params.append("int layer")
+            call.append("layer")
+        fdict = {'code': kernel.code(),
+                 'name': name,
+                 'params': ", ".join(params),
+                 'call': ", ".join(call),
+                 'kernel': kernel.name,
+                 'type': self.ctype,
+                 'nrows': nrows,
+                 'ncols': ncols,
+                 'rdim': rdim,
+                 'cdim': cdim}
+        code = """%(code)s
+
+void %(name)s(%(params)s) {
+  %(type)s action_A[%(nrows)d][%(ncols)d] = {{0}};
+  %(kernel)s(%(call)s);
+  for ( int r = 0; r < %(nrows)d; r++ ) {
+    %(type)s s = 0;
+    for ( int c = 0; c < %(ncols)d; c++ ) {
+      s += action_A[r][c] * action_x[c / %(cdim)d][c %% %(cdim)d];
+    }
+    action_y[r / %(rdim)d][r %% %(rdim)d] += s;
+  }
+}
+""" % fdict
+        action = _make_object('Kernel', code, name,
+                              include_dirs=kernel._include_dirs,
+                              headers=kernel._headers,
+                              user_code=kernel._user_code,
+                              ldargs=kernel._ldargs)
+        self._actions.append((action, iterset, rmap, cmap, others, kwargs))
+
+    @collective
+    def mult(self, x, y):
+        """Compute ``y = A x``, where ``A`` is this matrix.
+
+        :arg x: the :class:`Dat` to multiply, on the column space.
+        :arg y: the :class:`Dat` receiving the result, on the row space.
+        """
+        y.zero()
+        for action, iterset, rmap, cmap, others, kwargs in self._actions:
+            base.par_loop(action, iterset,
+                          y(base.INC, rmap), x(base.READ, cmap),
+                          *others, **kwargs)
+
+    @collective
+    def zero(self):
+        """Zero the matrix, forgetting the loops recorded so far."""
+        self._actions = []
+
+    def _assemble(self):
+        pass
+
+    @property
+    def values(self):
+        raise NotImplementedError("Matrix-free matrices have no values")
+
+    @utils.cached_property
+    def _work_dats(self):
+        rset, cset = self.sparsity.dsets
+        return (_make_object('Dat', cset, dtype=self.dtype),
+                _make_object('Dat', rset, dtype=self.dtype))
+
+
+class _MatrixFreePayload(object):
+
+    def __init__(self, mat):
+        self.mat = mat
+
+    def mult(self, mat, x, y):
+        """y = mat x"""
+        xdat, ydat = self.mat._work_dats
+        with xdat.vec as v:
+            x.copy(v)
+        self.mat.mult(xdat, ydat)
+        with ydat.vec_ro as v:
+            v.copy(y)
+
+
 class ParLoop(base.ParLoop):
 
     def log_flops(self):
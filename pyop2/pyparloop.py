@@ -72,11 +72,34 @@ Example usage::
   #  [ 3.  4.]
   #  [ 5.  6.]
   #  [ 3.  0.]]
+
+Calling the function once per entity is slow for large sets.  If
+``vectorise=True`` is passed to :func:`~.par_loop`, the function is
+instead called once with the data for all the entities, each argument
+having an extra leading dimension indexing the entities (arguments
+accessing a :class:`~.Global` are passed unchanged).  Incremented
+arguments are passed zeroed, and the increments of all the entities
+are summed into the data afterwards::
+
+  def fn3(x, y):
+      x[:, 0] += y[:, 0]
+      x[:, 1] += y[:, 0]
+
+  op2.par_loop(fn3, s, d2(op2.INC), d(op2.READ, m[1]), vectorise=True)
+
+Alternatively, if Numba is installed, passing ``numba=True`` (or
+setting the ``numba_kernels`` configuration option) compiles the
+function, together with a loop over the iteration set calling it with
+the same arguments as above, in Numba's ``nopython`` mode (see
+:class:`NumbaDriver`).  The function must then only use the Python and
+NumPy features Numba supports.
 """
 
 from __future__ import absolute_import, print_function, division
 import numpy as np
 from pyop2 import base
+from pyop2.caching import Cached
+from pyop2.configuration import configuration
 
 
 # Fake kernel for type checking
@@ -101,12 +124,59 @@ class Kernel(base.Kernel):
         return 'Kernel("""%s""", %r)' % (self._func, self._name)
 
 
+def _scatter_add(data, indices, values):
+    """Add ``values`` into the rows ``indices`` of ``data``, summing
+    the contributions to repeated rows.
+
+    :arg data: The array to increment, indexed along its first axis.
+    :arg indices: Integer array of rows of ``data``; negative entries
+        are ignored.
+    :arg values: Array of shape ``indices.shape + data.shape[1:]``."""
+    indices = indices.reshape(-1)
+    values = values.reshape((len(indices), -1))
+    valid = indices >= 0
+    if not valid.all():
+        indices, values = indices[valid], values[valid]
+    target = data.reshape((len(data), -1))
+    if target.dtype.kind != "f":
+        np.add.at(target, indices, values)
+        return
+    # Summing each component with bincount is much faster than
+    # unbuffered addition with np.add.at.
+    for c in range(target.shape[1]):
+        target[:, c] += np.bincount(indices, weights=values[:, c],
+                                    minlength=len(target))
+
+
 # Inherit from parloop for type checking and init
 class ParLoop(base.ParLoop):
 
+    """A :class:`~.ParLoop` executing a Python function.
+
+    An optional keyword argument, ``vectorise``, requests that the
+    function be called once per partition of the iteration set, with
+    the data of all its entities gathered into arrays, rather than once
+    per entity.
+
+    An optional keyword argument, ``numba``, (defaulting to the
+    ``numba_kernels`` configuration option) requests that the function
+    and the loop calling it be compiled with Numba (see
+    :class:`NumbaDriver`).  It cannot be combined with ``vectorise``."""
+
+    def __init__(self, kernel, iterset, *args, **kwargs):
+        super(ParLoop, self).__init__(kernel, iterset, *args, **kwargs)
+        self._vectorise = kwargs.get("vectorise", False)
+        self._numba = kwargs.get("numba", configuration["numba_kernels"])
+        if self._vectorise and self._numba:
+            raise ValueError("Can't compile vectorised Python kernels with Numba")
+
     def _compute(self, part, *arglist):
         if part.set._extruded:
             raise NotImplementedError
+        if self._vectorise:
+            return self._compute_vectorised(part)
+        if self._numba:
+            return self._compute_numba(part)
         subset = isinstance(self._it_space._iterset, base.Subset)
 
         for arg in self.args:
@@ -183,3 +253,229 @@ class ParLoop(base.ParLoop):
                 # everything to execute in the right order is
                 # otherwise madness.
                 arg.data._force_evaluation(read=True, write=False)
+
+    def _compute_vectorised(self, part):
+        """Execute the function over ``part`` with a single call.
+
+        Each :class:`~.Dat` argument is gathered (through the map
+        values of all the entities, for indirect arguments) into an
+        array with a leading dimension indexing the entities, and each
+        :class:`~.Mat` argument receives an array of element matrices.
+        Written arguments are scattered back afterwards, and
+        incremented ones are passed zeroed and summed into the data."""
+        if isinstance(self._it_space._iterset, base.Subset):
+            entities = self._it_space._iterset._indices[part.offset:part.offset + part.size]
+        else:
+            entities = np.arange(part.offset, part.offset + part.size)
+        n = len(entities)
+        if n == 0:
+            return
+        for arg in self.args:
+            if arg._is_dat and arg.data._is_allocated:
+                for d in arg.data:
+                    d._data.setflags(write=True)
+        args = []
+        rows = []
+        for arg in self.args:
+            if arg._is_global:
+                index = None
+                tmp = arg.data._data
+            elif arg._is_direct:
+                index = entities
+            elif arg._is_indirect:
+                if isinstance(arg.idx, base.IterationIndex):
+                    raise NotImplementedError
+                if arg._is_vec_map:
+                    index = arg.map.values_with_halo[entities]
+                else:
+                    index = arg.map.values_with_halo[entities, arg.idx:arg.idx+1]
+            elif arg._is_mat:
+                if arg.access not in [base.INC, base.WRITE]:
+                    raise NotImplementedError
+                if arg._is_mixed_mat:
+                    raise ValueError("Mixed Mats must be split before assembly")
+                index = None
+                tmp = np.zeros((n, ) + arg._block_shape[0][0], dtype=arg.data.dtype)
+            if arg._is_dat:
+                shape = index.shape + arg.data._data.shape[1:]
+                if arg.access is base.INC:
+                    tmp = np.zeros(shape, dtype=arg.data.dtype)
+                else:
+                    tmp = arg.data._data[index, ...]
+                if len(shape) == 1:
+                    # Direct access to a Dat of dimension 1
+                    tmp = tmp.reshape(n, 1)
+            if arg.access is base.READ:
+                tmp = tmp.view()
+                tmp.setflags(write=False)
+            if tmp.shape == ():
+                tmp = tmp.reshape(1)
+            args.append(tmp)
+            rows.append(index)
+        self._kernel(*args)
+        for arg, tmp, index in zip(self.args, args, rows):
+            if arg.access is base.READ:
+                continue
+            if arg._is_global:
+                arg.data._data[:] = tmp[:]
+            elif arg._is_dat:
+                tmp = tmp.reshape(index.shape + arg.data._data.shape[1:])
+                if arg.access is base.INC:
+                    _scatter_add(arg.data._data, index, tmp)
+                else:
+                    arg.data._data[index, ...] = tmp
+            elif arg._is_mat:
+                rmap, cmap = arg.map
+                insert = arg.data.addto_blocks if arg.access is base.INC else arg.data.set_blocks
+                insert(rmap.values_with_halo[entities], cmap.values_with_halo[entities], tmp)
+
+        for arg in self.args:
+            if arg._is_dat and arg.data._is_allocated:
+                for d in arg.data:
+                    d._data.setflags(write=False)
+            if arg._is_mat and arg.access is not base.READ:
+                # Queue up assembly of the matrix and force its
+                # evaluation (see _compute).
+                arg.data.assemble()
+                arg.data._force_evaluation(read=True, write=False)
+
+    def _compute_numba(self, part):
+        """Execute the function over ``part`` with a compiled
+        :class:`NumbaDriver`."""
+        iterset = self._it_space._iterset
+        driver = NumbaDriver(self._kernel, iterset, *self.args)
+        n = part.size
+        if n == 0:
+            return
+        arglist = [part.offset, part.offset + n]
+        if isinstance(iterset, base.Subset):
+            arglist.append(iterset._indices)
+        for arg in self.args:
+            if arg._is_dat and arg.data._is_allocated:
+                for d in arg.data:
+                    d._data.setflags(write=True)
+        blocks = {}
+        for arg in self.args:
+            if arg._is_mat:
+                if arg.access not in [base.INC, base.WRITE]:
+                    raise NotImplementedError
+                if arg._is_mixed_mat:
+                    raise ValueError("Mixed Mats must be split before assembly")
+                blocks[arg] = np.zeros((n, ) + arg._block_shape[0][0], dtype=arg.data.dtype)
+                arglist.append(blocks[arg])
+                continue
+            data = arg.data._data
+            if arg.access is base.READ:
+                data = data.view()
+                data.setflags(write=False)
+            arglist.append(data)
+            if arg._is_indirect:
+                arglist.append(arg.map.values_with_halo)
+        driver(*arglist)
+        if isinstance(iterset, base.Subset):
+            entities = iterset._indices[part.offset:part.offset + n]
+        else:
+            entities = np.arange(part.offset, part.offset + n)
+        for arg, tmp in blocks.items():
+            rmap, cmap = arg.map
+            insert = arg.data.addto_blocks if arg.access is base.INC else arg.data.set_blocks
+            insert(rmap.values_with_halo[entities], cmap.values_with_halo[entities], tmp)
+
+        for arg in self.args:
+            if arg._is_dat and arg.data._is_allocated:
+                for d in arg.data:
+                    d._data.setflags(write=False)
+            if arg._is_mat and arg.access is not base.READ:
+                # Queue up assembly of the matrix and force its
+                # evaluation (see _compute).
+                arg.data.assemble()
+                arg.data._force_evaluation(read=True, write=False)
+
+
+class NumbaDriver(Cached):
+
+    """A Python function kernel compiled with Numba, together with a
+    loop executing it over part of an iteration set.
+
+    The loop passes the function the same arguments as
+    :meth:`ParLoop._compute`: direct :class:`~.Dat` arguments are views
+    of the entity's data, indirect ones are gathered into a buffer
+    (and scattered back unless read), :class:`~.Global` arguments are
+    passed unchanged and :class:`~.Mat` arguments receive the entity's
+    block of an array of element matrices, which the caller adds to
+    the matrix.  Both are compiled in ``nopython`` mode without the
+    GIL.
+
+    The driver is called with the bounds ``start, end`` of the part,
+    the subset indices if iterating over a :class:`~.Subset`, and then
+    for each argument its data (or array of element matrices),
+    followed by the map values for indirect arguments.  Drivers are
+    cached by function and argument signature."""
+
+    _cache = {}
+
+    @classmethod
+    def _cache_key(cls, kernel, iterset, *args):
+        key = (kernel._func, isinstance(iterset, base.Subset))
+        for arg in args:
+            if arg._is_mat:
+                key += (("mat", arg._block_shape[0][0]), )
+                continue
+            if arg._is_dat and isinstance(arg.idx, base.IterationIndex):
+                raise NotImplementedError
+            sig = (arg.access, arg.data._data.shape[1:], arg.data.dtype)
+            if arg._is_indirect:
+                sig += (arg.map.arity, None if arg._is_vec_map else arg.idx)
+            key += (("global" if arg._is_global else "dat", ) + sig, )
+        return key
+
+    def __init__(self, kernel, iterset, *args):
+        if self._initialized:
+            return
+        import numba
+        params = ["start", "end"]
+        body = []
+        scatter = []
+        kernel_args = []
+        namespace = {"np": np, "kernel": numba.njit(nogil=True)(kernel._func)}
+        if isinstance(iterset, base.Subset):
+            params.append("ssinds")
+            body.append("i = ssinds[n]")
+        else:
+            body.append("i = n")
+        for count, arg in enumerate(args):
+            name = "arg%d" % count
+            params.append(name)
+            kernel_args.append("a%d" % count)
+            if arg._is_mat:
+                body.append("a%d = %s[n - start]" % (count, name))
+            elif arg._is_global:
+                body.append("a%d = %s" % (count, name))
+            elif arg._is_direct:
+                if arg.data._data.ndim == 1:
+                    body.append("a%d = %s[i:i + 1]" % (count, name))
+                else:
+                    body.append("a%d = %s[i]" % (count, name))
+            else:
+                params.append("map%d" % count)
+                shape = arg.data._data.shape[1:]
+                cmpts = ", :" * len(shape)
+                slots = list(range(arg.map.arity)) if arg._is_vec_map else [arg.idx]
+                namespace["dtype%d" % count] = arg.data.dtype.type
+                body.append("a%d = np.empty(%r, dtype%d)" % (count, (len(slots), ) + shape, count))
+                for k, slot in enumerate(slots):
+                    body.append("a%d[%d%s] = %s[map%d[i, %d]%s]" %
+                                (count, k, cmpts, name, count, slot, cmpts))
+                    if arg.access is not base.READ:
+                        scatter.append("%s[map%d[i, %d]%s] = a%d[%d%s]" %
+                                       (name, count, slot, cmpts, count, k, cmpts))
+        body.append("kernel(%s)" % ", ".join(kernel_args))
+        source = "def driver(%s):\n    for n in range(start, end):\n%s\n" % \
+            (", ".join(params), "\n".join("        " + line for line in body + scatter))
+        exec(source, namespace)
+        self._source = source
+        self._fun = numba.njit(nogil=True)(namespace["driver"])
+        self._initialized = True
+
+    def __call__(self, *args):
+        return self._fun(*args)
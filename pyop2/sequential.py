@@ -36,6 +36,7 @@ from __future__ import absolute_import, print_function, division
 from six.moves import range, zip
 
 import os
+import ctypes
 from textwrap import dedent
 from copy import deepcopy as dcopy
 from collections import OrderedDict
@@ -53,6 +54,7 @@ from pyop2.base import DatView                           # noqa: F401
 from pyop2.petsc_base import DataSet, MixedDataSet       # noqa: F401
 from pyop2.petsc_base import Global, GlobalDataSet       # noqa: F401
 from pyop2.petsc_base import Dat, MixedDat, Mat          # noqa: F401
+from pyop2.petsc_base import MatrixFreeMat               # noqa: F401
 from pyop2.configuration import configuration
 from pyop2.exceptions import *  # noqa: F401
 from pyop2.mpi import collective
@@ -109,7 +111,7 @@ class Arg(base.Arg):
             for i, map in enumerate(as_tuple(self.map, Map)):
                 if map is not None:
                     for j, m in enumerate(map):
-                        val += ", %s *%s" % (as_cstr(IntType), self.c_map_name(i, j))
+                        val += ", %s *%s" % (as_cstr(self._map_dtype), self.c_map_name(i, j))
         return val
 
     def c_vec_dec(self, is_facet=False):
@@ -140,14 +142,15 @@ class Arg(base.Arg):
                                                      'iname': self.c_arg_name(0, 0)}
         return val
 
-    def c_ind_data(self, idx, i, j=0, is_top=False, offset=None, var=None):
+    def c_ind_data(self, idx, i, j=0, is_top=False, offset=None, var=None,
+                   layer="start_layer"):
         return "%(name)s + (%(map_name)s[%(var)s * %(arity)s + %(idx)s]%(top)s%(off_mul)s%(off_add)s)* %(dim)s%(off)s" % \
             {'name': self.c_arg_name(i),
              'map_name': self.c_map_name(i, 0),
              'var': var if var else 'i',
              'arity': self.map.split[i].arity,
              'idx': idx,
-             'top': ' + start_layer' if is_top else '',
+             'top': ' + %s' % layer if is_top else '',
              'dim': self.data[i].cdim,
              'off': ' + %d' % j if j else '',
              'off_mul': ' * %d' % offset if is_top and offset is not None else '',
@@ -203,7 +206,7 @@ class Arg(base.Arg):
             return "%(name)s + %(idx)s" % {'name': self.c_arg_name(i),
                                            'idx': idx}
 
-    def c_vec_init(self, is_top, is_facet=False):
+    def c_vec_init(self, is_top, is_facet=False, layer="start_layer"):
         is_top_init = is_top
         val = []
         vec_idx = 0
@@ -214,7 +217,8 @@ class Arg(base.Arg):
                            {'vec_name': self.c_vec_name(),
                             'idx': vec_idx,
                             'data': self.c_ind_data(idx, i, is_top=is_top,
-                                                    offset=m.offset[idx] if is_top else None)})
+                                                    offset=m.offset[idx] if is_top else None,
+                                                    layer=layer)})
                 vec_idx += 1
             if is_facet:
                 for idx in range(m.arity):
@@ -222,7 +226,8 @@ class Arg(base.Arg):
                                {'vec_name': self.c_vec_name(),
                                 'idx': vec_idx,
                                 'data': self.c_ind_data(idx, i, is_top=is_top,
-                                                        offset=m.offset[idx])})
+                                                        offset=m.offset[idx],
+                                                        layer=layer)})
                     vec_idx += 1
         return ";\n".join(val)
 
@@ -342,6 +347,114 @@ class Arg(base.Arg):
         ret = " "*16 + "{\n" + "\n".join(ret) + "\n" + " "*16 + "}"
         return ret
 
+    def c_batch_size(self, is_facet=False):
+        """The number of rows (and columns) of the element matrices
+        this :class:`Mat` argument adds in batched insertion mode."""
+        rdim = self.data.dims[0][0][0]
+        return self.map[0].arity * rdim * (2 if is_facet else 1)
+
+    def c_batch_decl(self, batch, is_facet=False):
+        n = self.c_batch_size(is_facet=is_facet)
+        return """%(IntType)s *batch_rows_%(mat)s = (%(IntType)s *)malloc(%(batch)d * %(n)d * sizeof(%(IntType)s));
+PetscScalar *batch_vals_%(mat)s = (PetscScalar *)malloc(%(batch)d * %(n)d * %(n)d * sizeof(PetscScalar));
+int batch_n_%(mat)s = 0;
+ISLocalToGlobalMapping batch_l2g_%(mat)s;
+MatGetLocalToGlobalMapping(%(mat)s, &batch_l2g_%(mat)s, NULL)""" % \
+            {'mat': self.c_arg_name(0, 0),
+             'batch': batch,
+             'n': n,
+             'IntType': as_cstr(IntType)}
+
+    def c_batch_flush(self, is_facet=False, free=False):
+        # Translate the indices of the whole batch to the global
+        # numbering at once and add the element matrices with a single
+        # call.  Negative (discarded) indices stay negative.
+        fdict = {'mat': self.c_arg_name(0, 0),
+                 'n': self.c_batch_size(is_facet=is_facet)}
+        ret = """if ( batch_n_%(mat)s > 0 ) {
+  ISLocalToGlobalMappingApply(batch_l2g_%(mat)s, batch_n_%(mat)s * %(n)d,
+                              batch_rows_%(mat)s, batch_rows_%(mat)s);
+  MatSetValuesBatch(%(mat)s, batch_n_%(mat)s, %(n)d, batch_rows_%(mat)s, batch_vals_%(mat)s);
+  batch_n_%(mat)s = 0;
+}""" % fdict
+        if free:
+            ret += "\nfree(batch_rows_%(mat)s);\nfree(batch_vals_%(mat)s);" % fdict
+        return ret
+
+    def c_addto_batched(self, buf_name, batch, extruded=None, is_facet=False):
+        nrows = self.map[0].arity
+        rows_str = "%s + i * %s" % (self.c_map_name(0, 0), nrows)
+        if extruded is not None:
+            rows_str = extruded + self.c_map_name(0, 0)
+        if is_facet:
+            nrows *= 2
+        rdim = self.data.dims[0][0][0]
+        fdict = {'mat': self.c_arg_name(0, 0),
+                 'n': nrows * rdim,
+                 'nrows': nrows,
+                 'rdim': rdim,
+                 'rows': rows_str,
+                 'type': self.data.ctype,
+                 'vals': buf_name,
+                 'batch': batch,
+                 'flush': self.c_batch_flush(is_facet=is_facet).replace('\n', '\n    '),
+                 'IntType': as_cstr(IntType)}
+        return """{
+  %(IntType)s *rows = batch_rows_%(mat)s + batch_n_%(mat)s * %(n)d;
+  PetscScalar *vals = batch_vals_%(mat)s + batch_n_%(mat)s * %(n)d * %(n)d;
+  for ( int b = 0; b < %(nrows)d; b++ ) {
+    %(IntType)s row = (%(rows)s)[b];
+    for ( int k = 0; k < %(rdim)d; k++ ) {
+      rows[b * %(rdim)d + k] = row < 0 ? -1 : row * %(rdim)d + k;
+    }
+  }
+  for ( int b = 0; b < %(n)d * %(n)d; b++ ) {
+    vals[b] = ((%(type)s *)%(vals)s)[b];
+  }
+  if ( ++batch_n_%(mat)s == %(batch)d ) {
+    %(flush)s
+  }
+}""" % fdict
+
+    def _csr_mat_type(self):
+        rdim, cdim = self.data.dims[0][0]
+        block_sparse = self.data.sparsity._block_sparse
+        return "SeqBAIJ" if rdim == cdim and rdim > 1 and block_sparse else "SeqAIJ"
+
+    def c_csr_decl(self):
+        return """PetscScalar *csr_vals_%(mat)s;
+Mat%(type)sGetArray(%(mat)s, &csr_vals_%(mat)s)""" % {'mat': self.c_arg_name(0, 0),
+                                                      'type': self._csr_mat_type()}
+
+    def c_csr_restore(self):
+        return "Mat%(type)sRestoreArray(%(mat)s, &csr_vals_%(mat)s);" % \
+            {'mat': self.c_arg_name(0, 0),
+             'type': self._csr_mat_type()}
+
+    def c_addto_csr(self, buf_name, threaded=False):
+        rdim, cdim = self.data.dims[0][0]
+        fdict = {'mat': self.c_arg_name(0, 0),
+                 'n': self.map[0].arity * rdim * self.map[1].arity * cdim,
+                 'type': self.data.ctype,
+                 'vals': buf_name,
+                 'op': "=" if self.access == WRITE else "+=",
+                 'IntType': as_cstr(IntType)}
+        # The offsets of entries dropped from the matrix (negative
+        # map values) are negative.  A thread only adds the entries in
+        # its own block of rows, whose values are contiguous.
+        if threaded:
+            fdict['cond'] = "offsets[b] >= thread_values[t] && offsets[b] < thread_values[t + 1]"
+        else:
+            fdict['cond'] = "offsets[b] >= 0"
+        return """{
+  const %(IntType)s *offsets = csr_offsets_%(mat)s + i * %(n)d;
+  for ( int b = 0; b < %(n)d; b++ ) {
+    if ( %(cond)s ) {
+      csr_vals_%(mat)s[offsets[b]] %(op)s ((%(type)s *)%(vals)s)[b];
+    }
+  }
+}""" % fdict
+
     def c_add_offset(self, is_facet=False):
         if not self.map.iterset._extruded:
             return ""
@@ -569,15 +682,15 @@ class JITModule(base.JITModule):
     _wrapper = """
 void %(wrapper_name)s(int start,
                       int end,
-                      %(ssinds_arg)s
+                      %(subset_arg)s
                       %(wrapper_args)s
-                      %(layer_arg)s) {
+                      %(layer_arg)s
+                      %(csr_offsets_arg)s) {
   %(user_code)s
   %(wrapper_decs)s;
   %(map_decl)s
   %(vec_decs)s;
-  for ( int n = start; n < end; n++ ) {
-    %(IntType)s i = %(index_expr)s;
+  %(iterset_loop)s
     %(vec_inits)s;
     %(map_init)s;
     %(extr_loop)s
@@ -589,6 +702,31 @@ void %(wrapper_name)s(int start,
     %(map_bcs_p)s;
     %(apply_offset)s;
     %(extr_loop_close)s
+  %(iterset_loop_close)s
+  %(mat_finalise)s
+}
+"""
+
+    _owner_wrapper = """
+void %(wrapper_name)s(int start,
+                      int end,
+                      %(IntType)s *owner_offsets,
+                      %(IntType)s *owner_entries,
+                      %(wrapper_args)s) {
+  %(user_code)s
+  %(wrapper_decs)s;
+  %(vec_decs)s;
+  for ( int n = start; n < end; n++ ) {
+    for ( %(IntType)s p = owner_offsets[n]; p < owner_offsets[n + 1]; p++ ) {
+      %(IntType)s i = owner_entries[p] / %(owner_arity)d;
+      %(IntType)s slot = owner_entries[p] %% %(owner_arity)d;
+      %(owner_decl)s;
+      %(vec_inits)s;
+      %(buffer_decl)s;
+      %(buffer_gather)s
+      %(kernel_name)s(%(kernel_args)s);
+      %(owner_scatter)s;
+    }
   }
 }
 """
@@ -626,10 +764,19 @@ void %(wrapper_name)s(int start,
         self._direct = kwargs.get('direct', False)
         self._iteration_region = kwargs.get('iterate', ALL)
         self._pass_layer_arg = kwargs.get('pass_layer_arg', False)
+        self._owner_computes = kwargs.get('owner_computes', False)
+        self._vectorise_columns = kwargs.get('vectorise_columns', False)
+        self._mat_insertion_batch = kwargs.get('mat_insertion_batch', 0)
+        self._mat_csr_insertion = kwargs.get('mat_csr_insertion', False)
+        self._mat_assembly_threads = kwargs.get('mat_assembly_threads', 1)
         # Copy the class variables, so we don't overwrite them
         self._cppargs = dcopy(type(self)._cppargs)
         self._libraries = dcopy(type(self)._libraries)
         self._system_headers = dcopy(type(self)._system_headers)
+        if self._mat_assembly_threads > 1:
+            self._cppargs += ["-fopenmp"]
+            self._libraries += ["-fopenmp"]
+            self._system_headers += ["#include <omp.h>"]
         self.set_argtypes(itspace.iterset, *args)
         if not kwargs.get('delay', False):
             self.compile()
@@ -667,7 +814,8 @@ void %(wrapper_name)s(int start,
             %(code)s
             """ % {'code': self._kernel.code(),
                    'header': headers}
-        code_to_compile = strip(dedent(self._wrapper) % self.generate_code())
+        wrapper = self._owner_wrapper if self._owner_computes else self._wrapper
+        code_to_compile = strip(dedent(wrapper) % self.generate_code())
 
         code_to_compile = """
         #include <petsc.h>
@@ -723,12 +871,17 @@ void %(wrapper_name)s(int start,
 
     def generate_code(self):
         if not self._code_dict:
-            self._code_dict = wrapper_snippets(self._itspace, self._args,
-                                               kernel_name=self._kernel._name,
-                                               user_code=self._kernel._user_code,
-                                               wrapper_name=self._wrapper_name,
-                                               iteration_region=self._iteration_region,
-                                               pass_layer_arg=self._pass_layer_arg)
+            snippets = owner_computes_snippets if self._owner_computes else wrapper_snippets
+            self._code_dict = snippets(self._itspace, self._args,
+                                       kernel_name=self._kernel._name,
+                                       user_code=self._kernel._user_code,
+                                       wrapper_name=self._wrapper_name,
+                                       iteration_region=self._iteration_region,
+                                       pass_layer_arg=self._pass_layer_arg,
+                                       vectorise_columns=self._vectorise_columns,
+                                       mat_insertion_batch=self._mat_insertion_batch,
+                                       mat_csr_insertion=self._mat_csr_insertion,
+                                       mat_assembly_threads=self._mat_assembly_threads)
         return self._code_dict
 
     def set_argtypes(self, iterset, *args):
@@ -736,6 +889,8 @@ void %(wrapper_name)s(int start,
         argtypes = [index_type, index_type]
         if isinstance(iterset, Subset):
             argtypes.append(iterset._argtype)
+        if self._owner_computes:
+            argtypes += [ctypes.c_voidp, ctypes.c_voidp]
         for arg in args:
             if arg._is_mat:
                 argtypes.append(arg.data._argtype)
@@ -749,19 +904,35 @@ void %(wrapper_name)s(int start,
                         for m in map:
                             argtypes.append(m._argtype)
 
-        if iterset._extruded:
+        if iterset._extruded and not iterset.constant_layers:
+            argtypes.append(ctypes.c_voidp)
+        elif iterset._extruded:
             argtypes.append(index_type)
             argtypes.append(index_type)
 
+        if self._mat_csr_insertion:
+            argtypes += [ctypes.c_voidp for arg in args if arg._is_mat]
+        if self._mat_assembly_threads > 1:
+            argtypes += [ctypes.c_voidp, ctypes.c_voidp, ctypes.c_voidp]
+
         self._argtypes = argtypes
 
 
 class ParLoop(petsc_base.ParLoop):
 
+    _owner_computes_supported = True
+    _column_vectorisation_supported = True
+    _mat_insertion_batching_supported = True
+    _mat_csr_insertion_supported = True
+    _threaded_assembly_supported = True
+
     def prepare_arglist(self, iterset, *args):
         arglist = []
         if isinstance(iterset, Subset):
-            arglist.append(iterset._indices.ctypes.data)
+            arglist.append(iterset._layout_array.ctypes.data)
+        if self.owner_map is not None:
+            offsets, entries = self.owner_map._inverse
+            arglist += [offsets.ctypes.data, entries.ctypes.data]
 
         for arg in args:
             if arg._is_mat:
@@ -775,9 +946,12 @@ class ParLoop(petsc_base.ParLoop):
                 for map in arg._map:
                     if map is not None:
                         for m in map:
-                            arglist.append(m._values.ctypes.data)
+                            arglist.append(arg._map_values(m).ctypes.data)
 
-        if iterset._extruded:
+        if iterset._extruded and not iterset.constant_layers:
+            # The wrapper reads the layer bounds of each column
+            arglist.append(iterset.layers_array.ctypes.data)
+        elif iterset._extruded:
             region = self.iteration_region
             # Set up appropriate layer iteration bounds
             if region is ON_BOTTOM:
@@ -796,24 +970,43 @@ class ParLoop(petsc_base.ParLoop):
                 arglist.append(0)
                 arglist.append(iterset.layers - 1)
                 arglist.append(iterset.layers - 1)
+        if self.mat_csr_insertion:
+            for arg in args:
+                if arg._is_mat:
+                    offsets = arg.data.sparsity._csr_offsets(*arg.map)
+                    arglist.append(offsets.ctypes.data)
+        if self.mat_assembly_threads > 1:
+            arg, = [arg for arg in args if arg._is_mat]
+            partition = arg.data.sparsity._thread_partition(arg.map[0], self.mat_assembly_threads)
+            arglist += [a.ctypes.data for a in partition]
         return arglist
 
     @cached_property
     def _jitmodule(self):
         return JITModule(self.kernel, self.it_space, *self.args,
                          direct=self.is_direct, iterate=self.iteration_region,
-                         pass_layer_arg=self._pass_layer_arg)
+                         pass_layer_arg=self._pass_layer_arg,
+                         owner_computes=self.owner_map is not None,
+                         vectorise_columns=self.column_vectorised,
+                         mat_insertion_batch=self.mat_insertion_batch,
+                         mat_csr_insertion=self.mat_csr_insertion,
+                         mat_assembly_threads=self.mat_assembly_threads)
 
     @collective
     def _compute(self, part, fun, *arglist):
         with timed_region("ParLoop%s" % self.iterset.name):
-            fun(part.offset, part.offset + part.size, *arglist)
+            start, end = part.offset, part.offset + part.size
+            if isinstance(part.set, Subset):
+                start, end = part.set._layout_bounds(start, end)
+            fun(start, end, *arglist)
             self.log_flops()
 
 
 def wrapper_snippets(itspace, args,
                      kernel_name=None, wrapper_name=None, user_code=None,
-                     iteration_region=ALL, pass_layer_arg=False):
+                     iteration_region=ALL, pass_layer_arg=False,
+                     vectorise_columns=False, mat_insertion_batch=0,
+                     mat_csr_insertion=False, mat_assembly_threads=1):
     """Generates code snippets for the wrapper,
     ready to be into a template.
 
@@ -825,6 +1018,24 @@ def wrapper_snippets(itspace, args,
     :param wrapper_name: Wrapper function name (forwarded)
     :param iteration_region: Iteration region, this is specified when
                              creating a :class:`ParLoop`.
+    :param vectorise_columns: Execute the layers of each column as
+                              independent iterations (see
+                              :attr:`~.ParLoop.column_vectorised`).
+    :param mat_insertion_batch: Number of element matrices to buffer
+                                before adding them to each :class:`Mat`
+                                argument (see
+                                :attr:`~.ParLoop.mat_insertion_batch`),
+                                0 to add them one at a time.
+    :param mat_csr_insertion: Add element matrices directly into the
+                              value arrays of the :class:`Mat`
+                              arguments (see
+                              :attr:`~.ParLoop.mat_csr_insertion`).
+    :param mat_assembly_threads: Number of OpenMP threads adding
+                                 element matrices into the value array
+                                 of the :class:`Mat` argument, each
+                                 owning a block of rows (see
+                                 :attr:`~.ParLoop.mat_assembly_threads`),
+                                 1 to assemble in serial.
 
     :return: dict containing the code snippets
     """
@@ -847,12 +1058,17 @@ def wrapper_snippets(itspace, args,
 
     _ssinds_arg = ""
     _index_expr = "(%s)n" % as_cstr(IntType)
+    _subset_arg = ""
+    _iterset_loop = """for ( int n = start; n < end; n++ ) {
+    %s i = (%s)n;""" % (as_cstr(IntType), as_cstr(IntType))
+    _iterset_loop_close = "}"
     is_top = (iteration_region == ON_TOP)
     is_facet = (iteration_region == ON_INTERIOR_FACETS)
 
     if isinstance(itspace._iterset, Subset):
         _ssinds_arg = "%s* ssinds," % as_cstr(IntType)
         _index_expr = "ssinds[n]"
+        _subset_arg, _iterset_loop, _iterset_loop_close = itspace._iterset._c_iteration
 
     _wrapper_args = ', '.join([arg.c_wrapper_arg() for arg in args])
 
@@ -860,8 +1076,40 @@ def wrapper_snippets(itspace, args,
     # an extruded mesh.
     _wrapper_decs = ';\n'.join([arg.c_wrapper_dec() for arg in args])
 
+    _csr_offsets_arg = ""
+    _mat_finalise = ""
+    if mat_csr_insertion:
+        _csr_offsets_arg = ''.join([", %s *csr_offsets_%s" % (as_cstr(IntType), arg.c_arg_name(0, 0))
+                                    for arg in args if arg._is_mat])
+        _wrapper_decs += ';\n' + ';\n'.join([arg.c_csr_decl() for arg in args if arg._is_mat])
+        _mat_finalise = '\n'.join([arg.c_csr_restore() for arg in args if arg._is_mat])
+        if mat_assembly_threads > 1:
+            _csr_offsets_arg += ", %(IntType)s *thread_values, %(IntType)s *thread_offsets, " \
+                "%(IntType)s *thread_elements" % {'IntType': as_cstr(IntType)}
+    elif mat_insertion_batch:
+        _wrapper_decs += ';\n' + ';\n'.join([arg.c_batch_decl(mat_insertion_batch,
+                                                              is_facet=is_facet)
+                                             for arg in args if arg._is_mat])
+        _mat_finalise = '\n'.join([arg.c_batch_flush(is_facet=is_facet, free=True)
+                                   for arg in args if arg._is_mat])
+
     _vec_decs = ';\n'.join([arg.c_vec_dec(is_facet=is_facet) for arg in args if arg._is_vec_map])
 
+    if mat_assembly_threads > 1:
+        # Each thread executes the elements contributing to its block
+        # of rows, with private pointers into the indirect data.
+        _iterset_loop = """#pragma omp parallel num_threads(%(nthreads)d)
+  {
+    int t = omp_get_thread_num();
+    %(vec_decs)s;
+    for ( %(IntType)s p = thread_offsets[t]; p < thread_offsets[t + 1]; p++ ) {
+    %(IntType)s i = thread_elements[p];
+    if ( i < start || i >= end ) continue;""" % {'nthreads': mat_assembly_threads,
+                                                 'vec_decs': _vec_decs.replace('\n', '\n    '),
+                                                 'IntType': as_cstr(IntType)}
+        _iterset_loop_close = "}\n  }"
+        _vec_decs = ""
+
     _intermediate_globals_decl = ';\n'.join(
         [arg.c_intermediate_globals_decl(count)
          for count, arg in enumerate(args)
@@ -888,8 +1136,22 @@ def wrapper_snippets(itspace, args,
     _map_bcs_m = ""
     _map_bcs_p = ""
     _layer_arg = ""
+    variable_layers = itspace._extruded and not itspace.iterset.constant_layers
     if itspace._extruded:
         _layer_arg = ", int start_layer, int end_layer, int top_layer"
+        if variable_layers:
+            # The layer bounds are read per column and are relative to
+            # the bottom of the column (which the map values refer to).
+            start, end, top = {ON_BOTTOM: ("0", "1", "nlayers - 1"),
+                               ON_TOP: ("nlayers - 2", "nlayers - 1", "nlayers - 1"),
+                               ON_INTERIOR_FACETS: ("0", "nlayers - 2", "nlayers - 2")
+                               }.get(iteration_region, ("0", "nlayers - 1", "nlayers - 1"))
+            _layer_arg = ", %s *layers" % as_cstr(IntType)
+            _iterset_loop += """
+    %(IntType)s bottom_layer = layers[2 * i];
+    int nlayers = layers[2 * i + 1] - bottom_layer;
+    int start_layer = %(start)s, end_layer = %(end)s, top_layer = %(top)s;""" % \
+                {'IntType': as_cstr(IntType), 'start': start, 'end': end, 'top': top}
         _map_decl += ';\n'.join([arg.c_map_decl(is_facet=is_facet)
                                  for arg in args if arg._uses_itspace])
         _map_init += ';\n'.join([arg.c_map_init(is_top=is_top, is_facet=is_facet)
@@ -902,6 +1164,18 @@ def wrapper_snippets(itspace, args,
                                      for arg in args if arg._is_vec_map])
         _extr_loop = '\n' + extrusion_loop()
         _extr_loop_close = '}\n'
+        if vectorise_columns:
+            # Compute the data pointers from the layer number rather
+            # than bumping them after each layer, and tell the compiler
+            # that the layers are independent iterations.  The kernel
+            # is still called once per layer.
+            _vec_inits = ';\n'.join([arg.c_vec_init(True, layer="j_0") for arg in args
+                                     if arg._is_vec_map])
+            _extr_loop = '\n'.join(['', '#pragma GCC ivdep', extrusion_loop(),
+                                    indent(_vec_decs, 1), indent(_vec_inits, 1) + ';'])
+            _vec_decs = ""
+            _vec_inits = ""
+            _apply_offset = ""
 
     # Build kernel invocation. Let X be a parameter of the kernel representing a
     # tensor accessed in an iteration space. Let BUFFER be an array of the same
@@ -937,7 +1211,7 @@ def wrapper_snippets(itspace, args,
                               for count, arg in enumerate(args)])
 
     if pass_layer_arg:
-        _kernel_args += ", j_0"
+        _kernel_args += ", bottom_layer + j_0" if variable_layers else ", j_0"
 
     _buf_gather = ";\n".join(_buf_gather.values())
     _buf_decl = ";\n".join(_buf_decl.values())
@@ -981,7 +1255,17 @@ def wrapper_snippets(itspace, args,
             }
         scatter = ";\n".join(_buf_scatter.values())
 
-        if itspace._extruded:
+        if mat_csr_insertion:
+            _addtos_extruded = ""
+            _addtos = ';\n'.join([arg.c_addto_csr(_buf_name[arg], threaded=mat_assembly_threads > 1)
+                                  for arg in args if arg._is_mat])
+        elif mat_insertion_batch:
+            _addto = ';\n'.join([arg.c_addto_batched(_buf_name[arg], mat_insertion_batch,
+                                                     "xtr_" if itspace._extruded else None,
+                                                     is_facet=is_facet)
+                                 for arg in args if arg._is_mat])
+            _addtos_extruded, _addtos = (_addto, "") if itspace._extruded else ("", _addto)
+        elif itspace._extruded:
             _addtos_extruded = ';\n'.join([arg.c_addto(i, j, _buf_name[arg],
                                                        _tmp_name[arg],
                                                        _tmp_decl[arg],
@@ -1015,11 +1299,16 @@ def wrapper_snippets(itspace, args,
             'wrapper_name': wrapper_name,
             'ssinds_arg': _ssinds_arg,
             'index_expr': _index_expr,
+            'subset_arg': _subset_arg,
+            'iterset_loop': _iterset_loop,
+            'iterset_loop_close': _iterset_loop_close,
+            'mat_finalise': indent(_mat_finalise, 1),
             'wrapper_args': _wrapper_args,
             'user_code': user_code,
             'wrapper_decs': indent(_wrapper_decs, 1),
             'vec_inits': indent(_vec_inits, 2),
             'layer_arg': _layer_arg,
+            'csr_offsets_arg': _csr_offsets_arg,
             'map_decl': indent(_map_decl, 2),
             'vec_decs': indent(_vec_decs, 2),
             'map_init': indent(_map_init, 5),
@@ -1039,6 +1328,62 @@ def wrapper_snippets(itspace, args,
                                           for i, j, shape, offsets in itspace])}
 
 
+def owner_computes_snippets(itspace, args, **kwargs):
+    """Generates code snippets for the owner-computes wrapper (see
+    :attr:`~.ParLoop.owner_map`), ready to be put into a template.
+
+    The wrapper iterates over target entities ``n`` and, for every map
+    entry ``slot`` of source entity ``i`` referencing ``n``, executes
+    the kernel with the incremented :class:`Dat`\s redirected into
+    zeroed scratch space, of which only the contribution for ``slot``
+    is added to ``n``.
+
+    Takes the same arguments as :func:`wrapper_snippets`.
+
+    :return: dict containing the code snippets
+    """
+    snippets = wrapper_snippets(itspace, args, **kwargs)
+    owned = [arg for arg in args if arg._is_indirect_reduction]
+    arity = owned[0].map.arity
+
+    _owner_decl, _vec_inits, _kernel_args, _owner_scatter = [], [], [], []
+    for count, arg in enumerate(args):
+        if not arg._is_indirect_reduction:
+            if arg._is_vec_map:
+                _vec_inits.append(arg.c_vec_init(False))
+            _kernel_args.append(arg.c_kernel_arg(count) if not arg._uses_itspace
+                                else "buffer_%s" % arg.c_arg_name(count))
+            continue
+        dim = arg.data.cdim
+        scatter = "%(name)s[n * %(dim)d + c] += %%s[%%s * %(dim)d + c]" % \
+            {'name': arg.c_arg_name(0), 'dim': dim}
+        if arg._uses_itspace:
+            # The buffer is already zeroed for incrementing
+            buf = "buffer_%s" % arg.c_arg_name(count)
+            _kernel_args.append(buf)
+            stmt = scatter % (buf, "slot")
+        else:
+            buf = "scratch_%s" % arg.c_arg_name(count)
+            if arg._is_vec_map:
+                _owner_decl.append("%s %s[%d] = {0}" % (arg.ctype, buf, arity * dim))
+                _vec_inits.append(";\n".join("%s[%d] = %s + %d" % (arg.c_vec_name(), j, buf, j * dim)
+                                             for j in range(arity)))
+                _kernel_args.append(arg.c_vec_name())
+                stmt = scatter % (buf, "slot")
+            else:
+                _owner_decl.append("%s %s[%d] = {0}" % (arg.ctype, buf, dim))
+                _kernel_args.append(buf)
+                stmt = "if (slot == %d) %s" % (arg.idx, scatter % (buf, "0"))
+        _owner_scatter.append("for ( int c = 0; c < %d; c++ ) %s" % (dim, stmt))
+
+    snippets.update({'owner_arity': arity,
+                     'owner_decl': ";\n".join(_owner_decl),
+                     'vec_inits': ";\n".join(_vec_inits),
+                     'kernel_args': ", ".join(_kernel_args),
+                     'owner_scatter': ";\n".join(_owner_scatter)})
+    return snippets
+
+
 def generate_cell_wrapper(itspace, args, forward_args=(), kernel_name=None, wrapper_name=None):
     """Generates wrapper for a single cell. No iteration loop, but cellwise data is extracted.
     Cell is expected as an argument to the wrapper. For extruded, the numbering of the cells
@@ -1053,6 +1398,13 @@ def generate_cell_wrapper(itspace, args, forward_args=(), kernel_name=None, wrap
     :param wrapper_name: Wrapper function name
 
     :return: string containing the C code for the single-cell wrapper
+
+    .. note::
+
+       Map arguments are declared with the type given by each
+       :class:`Arg`'s ``_map_dtype``, so when the ``compact_maps``
+       configuration option is set, callers must pass the arrays
+       returned by ``arg._map_values(map)``.
     """
 
     direct = all(a.map is None for a in args)
@@ -0,0 +1,192 @@
+# This file is part of PyOP2
+#
+# PyOP2 is Copyright (c) 2012, Imperial College London and
+# others. Please see the AUTHORS file in the main source directory for
+# a full list of copyright holders.  All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * The name of Imperial College London or that of other
+#       contributors may not be used to endorse or promote products
+#       derived from this software without specific prior written
+#       permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTERS
+# ''AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDERS OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED
+# OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""Asynchronous export of :class:`~.Dat` values.
+
+A :class:`SnapshotWriter` writes copies of the owned values of
+:class:`~.Dat`\s to disk in a background thread, so that a time
+stepping loop does not wait on I/O ::
+
+    with SnapshotWriter(maxsize=2) as writer:
+        for step in range(nsteps):
+            op2.par_loop(...)
+            writer.snapshot(dat, "u_%d.npy" % step)
+
+Taking a snapshot does not force evaluation of the lazy trace.  The
+copy is made when the trace is evaluated up to the point where the
+snapshot was taken (at the latest, before ``dat`` is next modified),
+so the values written are those ``dat`` had at that point.  Copies are
+made into buffers recycled by the writer once written, at most
+``maxsize`` of which are waiting to be written at any time; taking
+another one blocks until the writer has caught up.
+"""
+
+from __future__ import absolute_import, print_function, division
+from six.moves import queue
+
+import threading
+import numpy as np
+
+from pyop2 import base
+from pyop2.profiling import timed_region
+
+__all__ = ['Snapshot', 'SnapshotWriter']
+
+
+class Snapshot(base.LazyComputation):
+
+    """A lazily evaluated copy of the owned values of a :class:`~.Dat`,
+    written to ``filename`` by ``writer``.
+
+    Use :meth:`SnapshotWriter.snapshot` to create one."""
+
+    def __init__(self, writer, dat, filename):
+        super(Snapshot, self).__init__(reads=[dat], writes=[], incs=[])
+        # So that evaluating the trace for this snapshot runs it
+        self.writes = set([self])
+        self._writer = writer
+        self._dat = dat
+        self.filename = filename
+        self._done = threading.Event()
+
+    def _run(self):
+        self._writer._submit(self)
+
+    @property
+    def done(self):
+        """Have the values been written?"""
+        return self._done.is_set()
+
+    def wait(self):
+        """Wait until the values have been written."""
+        base._trace.evaluate(set([self]), set())
+        self._done.wait()
+        self._writer._check()
+
+
+class SnapshotWriter(object):
+
+    """Write snapshots of :class:`~.Dat`\s in a background thread.
+
+    :kwarg maxsize: the maximum number of snapshots waiting to be
+        written.
+    """
+
+    def __init__(self, maxsize=2):
+        self._queue = queue.Queue(maxsize)
+        self._buffers = {}
+        self._lock = threading.Lock()
+        self._pending = []
+        self._error = None
+        self._thread = threading.Thread(target=self._work, name="pyop2-snapshot")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def snapshot(self, dat, filename):
+        """Write the owned values of ``dat`` to ``filename`` (in NumPy
+        format) in the background.
+
+        When running in parallel, ``filename`` should differ between
+        processes.
+
+        :returns: the :class:`Snapshot`.
+        """
+        if self._thread is None:
+            raise RuntimeError("Can't take a snapshot with a closed SnapshotWriter")
+        if isinstance(dat, base.MixedDat):
+            raise TypeError("Take snapshots of the components of a MixedDat instead")
+        self._check()
+        self._pending = [s for s in self._pending if not s.done]
+        snapshot = Snapshot(self, dat, filename)
+        self._pending.append(snapshot)
+        return snapshot.enqueue()
+
+    def wait(self):
+        """Wait until all snapshots taken so far have been written."""
+        if self._pending:
+            base._trace.evaluate(set(self._pending), set())
+        self._queue.join()
+        self._pending = []
+        self._check()
+
+    def close(self):
+        """Write outstanding snapshots and stop the writer thread."""
+        if self._thread is None:
+            return
+        try:
+            self.wait()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _submit(self, snapshot):
+        dat = snapshot._dat
+        values = dat._data[:dat.dataset.size]
+        key = (values.shape, values.dtype)
+        with self._lock:
+            free = self._buffers.get(key)
+            buf = free.pop() if free else np.empty_like(values)
+        buf[...] = values
+        with timed_region("Snapshot wait"):
+            self._queue.put((snapshot, buf))
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            snapshot, buf = item
+            try:
+                with timed_region("Snapshot write"):
+                    np.save(snapshot.filename, buf)
+            except Exception as e:
+                self._error = self._error or e
+            finally:
+                with self._lock:
+                    self._buffers.setdefault((buf.shape, buf.dtype), []).append(buf)
+                snapshot._done.set()
+                self._queue.task_done()
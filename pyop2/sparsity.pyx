@@ -34,6 +34,7 @@
 from libcpp.vector cimport vector
 from vecset cimport vecset
 from cython.operator cimport dereference as deref, preincrement as inc
+from cython.parallel cimport prange
 from cpython cimport bool
 import numpy as np
 cimport numpy as np
@@ -58,6 +59,33 @@ cdef extern from "petsc.h":
                           PetscScalar*, PetscInsertMode)
 
 
+cdef extern from "<algorithm>" namespace "std" nogil:
+    void sort[Iter](Iter first, Iter last)
+    Iter unique[Iter](Iter first, Iter last)
+    Iter lower_bound[Iter, T](Iter first, Iter last, const T& value)
+
+
+cdef enum IterationRegion:
+    REGION_ALL
+    REGION_ON_BOTTOM
+    REGION_ON_TOP
+    REGION_ON_INTERIOR_FACETS
+
+
+cdef IterationRegion decode_region(region) except *:
+    """Decode an iteration region, so that loops over the entities
+    can branch on a C enum rather than compare strings."""
+    if region.where == "ALL":
+        return REGION_ALL
+    elif region.where == "ON_BOTTOM":
+        return REGION_ON_BOTTOM
+    elif region.where == "ON_TOP":
+        return REGION_ON_TOP
+    elif region.where == "ON_INTERIOR_FACETS":
+        return REGION_ON_INTERIOR_FACETS
+    raise RuntimeError("Unhandled iteration region %s", region)
+
+
 cdef object set_writeable(map):
      flag = map.values_with_halo.flags['WRITEABLE']
      map.values_with_halo.setflags(write=True)
@@ -112,6 +140,507 @@ cdef inline void add_entries(rset, rmap, cset, cmap,
                             odiag[row + j].insert(col)
 
 
+def inverse_map(rmap, PetscInt nent, PetscInt nnodes):
+    """Restrict the inverse of a map (see :attr:`~.Map.inverse`) to
+    its first ``nent`` source entities and first ``nnodes`` targets.
+
+    :arg rmap: the :class:`~.Map` to invert.
+    :arg nent: the number of (leading) map rows to consider.
+    :arg nnodes: the number of (leading) target entities to consider.
+    :returns: a pair of arrays ``(offsets, elements)`` such that the
+         map rows referencing target ``n`` are
+         ``elements[offsets[n]:offsets[n+1]]``."""
+    offsets, elements = rmap.inverse
+    offsets = offsets[:nnodes + 1]
+    elements = elements[:offsets[-1]]
+    keep = elements < nent
+    if keep.all():
+        return np.array(offsets), np.array(elements)
+    counts = np.zeros(len(keep) + 1, dtype=IntType)
+    np.cumsum(keep, out=counts[1:])
+    return counts[offsets], elements[keep]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void add_entries_threaded(rset, rmap, cset, cmap,
+                               PetscInt row_offset,
+                               vector[vecset[PetscInt]]& diag,
+                               vector[vecset[PetscInt]]& odiag,
+                               bint should_block, int nthreads):
+    """Threaded version of :func:`add_entries`.
+
+    The owned rows are partitioned across threads, each thread walks
+    the inverse of the row map to find the elements contributing to
+    its rows.  Hence every row's set is only ever touched by a single
+    thread and no locking is required."""
+    cdef:
+        PetscInt nrows, ncols, j, k, l, nent, e, n, p, nnodes
+        PetscInt carity, row, col, rdim, cdim
+        PetscInt[:, ::1] cmap_vals
+        PetscInt[::1] offsets, elements
+
+    nent = rmap.iterset.exec_size
+
+    if should_block:
+        rdim = cdim = 1
+    else:
+        rdim = rset.cdim
+        cdim = cset.cdim
+
+    nnodes = rset.size
+    offsets, elements = inverse_map(rmap, nent, nnodes)
+    cmap_vals = cmap.values_with_halo
+
+    ncols = cset.size * cdim
+    carity = cmap.arity
+
+    for n in prange(nnodes, nogil=True, num_threads=nthreads,
+                    schedule="static"):
+        for p in range(offsets[n], offsets[n + 1]):
+            e = elements[p]
+            for j in range(rdim):
+                row = rdim * n + j + row_offset
+                for k in range(carity):
+                    for l in range(cdim):
+                        col = cdim * cmap_vals[e, k] + l
+                        if col < ncols:
+                            diag[row].insert(col)
+                        else:
+                            odiag[row].insert(col)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void count_entries(rset, rmap, cset, cmap,
+                        PetscInt row_offset,
+                        PetscInt[::1] counts,
+                        bint should_block,
+                        PetscInt estart, PetscInt eend):
+    """Count (an upper bound on) the entries in each row contributed
+    by a pair of maps over the elements ``[estart, eend)``."""
+    cdef:
+        PetscInt nrows, i, j, e, rarity, row, rdim, cdim, ncol
+
+    if should_block:
+        rdim = cdim = 1
+    else:
+        rdim = rset.cdim
+        cdim = cset.cdim
+
+    cdef PetscInt[:, ::1] rmap_vals = rmap.values_with_halo
+
+    nrows = rset.size * rdim
+    rarity = rmap.arity
+    ncol = cmap.arity * cdim
+
+    with nogil:
+        for e in range(estart, eend):
+            for i in range(rarity):
+                row = rdim * rmap_vals[e, i]
+                if row >= nrows:
+                    continue
+                row += row_offset
+                for j in range(rdim):
+                    counts[row + j] += ncol
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void emit_entries(rset, rmap, cset, cmap,
+                       PetscInt row_offset,
+                       PetscInt[::1] fill,
+                       PetscInt[::1] cols,
+                       bint should_block,
+                       PetscInt estart, PetscInt eend):
+    """Write the column entries contributed by a pair of maps over the
+    elements ``[estart, eend)`` into their row's slot of ``cols``,
+    ``fill`` holds the next free position of each row."""
+    cdef:
+        PetscInt nrows, i, j, k, l, e
+        PetscInt rarity, carity, row, col, rdim, cdim
+
+    if should_block:
+        rdim = cdim = 1
+    else:
+        rdim = rset.cdim
+        cdim = cset.cdim
+
+    cdef PetscInt[:, ::1] rmap_vals = rmap.values_with_halo
+    cdef PetscInt[:, ::1] cmap_vals = cmap.values_with_halo
+
+    nrows = rset.size * rdim
+    rarity = rmap.arity
+    carity = cmap.arity
+
+    with nogil:
+        for e in range(estart, eend):
+            for i in range(rarity):
+                row = rdim * rmap_vals[e, i]
+                if row >= nrows:
+                    continue
+                row += row_offset
+                for j in range(rdim):
+                    for k in range(carity):
+                        for l in range(cdim):
+                            col = cdim * cmap_vals[e, k] + l
+                            cols[fill[row + j]] = col
+                            fill[row + j] += 1
+
+
+def extruded_progressions(rset, rmap, cset, cmap, bint should_block):
+    """Return the entries contributed by a pair of extruded maps as
+    arithmetic progressions.
+
+    :returns: a tuple of arrays ``(rows, rstride, length, cols,
+         cstride)`` such that entry ``t < length[g]`` of progression
+         ``g`` couples row ``rows[g] + t * rstride[g]`` to column
+         ``cols[g] + t * cstride[g]``.
+
+    Walking up a column, the entries of every (row, column) pair of
+    map values are shifted by the map offsets, so one progression is
+    built per base entity and pair of map values.  Progressions along
+    the same lattice (those of neighbouring base entities sharing a
+    column of nodes, or of map values one layer apart) are merged, so
+    that expanding them costs time proportional to the number of
+    nonzeros rather than to the number of (entity, layer, row, column)
+    tuples."""
+    nent = rmap.iterset.exec_size
+
+    if should_block:
+        rdim = cdim = 1
+    else:
+        rdim = rset.cdim
+        cdim = cset.cdim
+
+    nrows = rset.size * rdim
+    rvals = rmap.values_with_halo[:nent]
+    cvals = cmap.values_with_halo[:nent]
+    roffset = np.asarray(rmap.offset, dtype=IntType)
+    coffset = np.asarray(cmap.offset, dtype=IntType)
+    nlayers = np.diff(rmap.iterset.layers_array[:nent], axis=1).reshape(-1)
+
+    gens = []
+    for region in rmap.iteration_region:
+        # Layer range (relative to the bottom of each column) and
+        # number of cells spanned by the maps, as in
+        # add_entries_extruded
+        start = np.zeros_like(nlayers)
+        end = nlayers - 1
+        reps = 1
+        if region.where == "ON_BOTTOM":
+            end = np.ones_like(nlayers)
+        elif region.where == "ON_TOP":
+            start = nlayers - 2
+        elif region.where == "ON_INTERIOR_FACETS":
+            end = nlayers - 2
+            reps = 2
+        elif region.where != "ALL":
+            raise RuntimeError("Unhandled iteration region %s", region)
+        length = end - start
+        brows = rvals + start[:, np.newaxis] * roffset
+        bcols = cvals + start[:, np.newaxis] * coffset
+        # Columns are not split between processes, so whether the
+        # bottom row is local decides for the whole column
+        mask = ((rdim * brows < nrows)[:, :, np.newaxis] &
+                (length > 0)[:, np.newaxis, np.newaxis])
+        mask = np.broadcast_to(mask, (nent, rmap.arity, cmap.arity))
+        for rrep in range(reps):
+            for crep in range(reps):
+                for j in range(rdim):
+                    for l in range(cdim):
+                        r = rdim * (brows + rrep * roffset) + j
+                        c = cdim * (bcols + crep * coffset) + l
+                        gens.append(np.stack(
+                            [a[mask] for a in np.broadcast_arrays(
+                                r[:, :, np.newaxis],
+                                rdim * roffset[np.newaxis, :, np.newaxis],
+                                length[:, np.newaxis, np.newaxis],
+                                c[:, np.newaxis, :],
+                                cdim * coffset[np.newaxis, np.newaxis, :])]))
+    if not gens:
+        return tuple(np.empty(0, dtype=IntType) for _ in range(5))
+    rows, rstride, length, cols, cstride = np.concatenate(gens, axis=1).astype(IntType)
+
+    # Progressions with a positive row stride couple row
+    # residue + t * rstride to the column fixed by the intercept
+    # cols * rstride - rows * cstride.  Merge overlapping (or
+    # adjacent) ranges of t with the same lattice.
+    lattice = rstride > 0
+    other = tuple(a[~lattice] for a in (rows, rstride, length, cols, cstride))
+    rows, rstride, length, cols, cstride = (a[lattice] for a in (rows, rstride, length, cols, cstride))
+    residue = rows % rstride
+    intercept = cols * rstride - rows * cstride
+    t0 = rows // rstride
+    t1 = t0 + length
+    order = np.lexsort((t0, intercept, residue, cstride, rstride))
+    rstride, cstride, residue, intercept, t0, t1 = (a[order] for a in
+                                                    (rstride, cstride, residue, intercept, t0, t1))
+    keep = merge_progressions(rstride, cstride, residue, intercept, t0, t1)
+    rstride, cstride, residue, intercept, t0, t1 = (a[keep] for a in
+                                                    (rstride, cstride, residue, intercept, t0, t1))
+    rows = residue + t0 * rstride
+    cols = (intercept + rows * cstride) // rstride
+    return tuple(np.concatenate([a, b]) for a, b in
+                 zip((rows, rstride, t1 - t0, cols, cstride), other))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef object merge_progressions(PetscInt[::1] rstride, PetscInt[::1] cstride,
+                               PetscInt[::1] residue, PetscInt[::1] intercept,
+                               PetscInt[::1] t0, PetscInt[::1] t1):
+    """Merge the ranges ``[t0, t1)`` of progressions on the same
+    lattice, sorted by lattice and ``t0``.  The merged range is stored
+    in the first progression of every run, which is flagged in the
+    returned mask."""
+    cdef:
+        PetscInt g, n = -1
+        np.uint8_t[::1] keep = np.zeros(t0.shape[0], dtype=np.uint8)
+
+    with nogil:
+        for g in range(t0.shape[0]):
+            if n >= 0 and rstride[g] == rstride[n] and cstride[g] == cstride[n] and \
+               residue[g] == residue[n] and intercept[g] == intercept[n] and \
+               t0[g] <= t1[n]:
+                if t1[g] > t1[n]:
+                    t1[n] = t1[g]
+            else:
+                n = g
+                keep[g] = 1
+    return np.asarray(keep).view(bool)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void count_progressions(progressions, PetscInt nrows, PetscInt row_offset,
+                             PetscInt[::1] counts, PetscInt gstart, PetscInt gend):
+    """Count the entries of each (local) row contributed by the
+    progressions ``[gstart, gend)`` (see
+    :func:`extruded_progressions`)."""
+    cdef:
+        PetscInt g, t, row
+        PetscInt[::1] rows, rstride, length
+
+    rows, rstride, length = progressions[:3]
+    with nogil:
+        for g in range(gstart, gend):
+            for t in range(length[g]):
+                row = rows[g] + t * rstride[g]
+                if row < nrows:
+                    counts[row_offset + row] += 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void emit_progressions(progressions, PetscInt nrows, PetscInt row_offset,
+                            PetscInt[::1] fill, PetscInt[::1] cols,
+                            PetscInt gstart, PetscInt gend):
+    """Write the column entries contributed by the progressions
+    ``[gstart, gend)`` (see :func:`extruded_progressions`) into their
+    row's slot of ``cols``, ``fill`` holds the next free position of
+    each row."""
+    cdef:
+        PetscInt g, t, row
+        PetscInt[::1] rows, rstride, length, cstart, cstride
+
+    rows, rstride, length, cstart, cstride = progressions
+    with nogil:
+        for g in range(gstart, gend):
+            for t in range(length[g]):
+                row = rows[g] + t * rstride[g]
+                if row < nrows:
+                    row += row_offset
+                    cols[fill[row]] = cstart[g] + t * cstride[g]
+                    fill[row] += 1
+
+
+# Smallest number of (possibly repeated) entries emitted at a time by
+# build_sparsity_sorted.
+cdef PetscInt SORT_CHUNK_ENTRIES = 1 << 20
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void build_sparsity_sorted(object sparsity, bint should_block,
+                                bint make_rowptr, PetscInt nrows,
+                                PetscInt[::1] nnz, PetscInt[::1] onnz):
+    """Build the sparsity pattern with a chunked two-pass counting sort.
+
+    For each column block, the entries are generated a chunk of
+    elements at a time.  The first pass counts the (possibly repeated)
+    entries of every row in the chunk, the second writes their column
+    indices into a flat buffer after the row's unique entries so far.
+    Each row is then sorted and deduplicated in place, and the buffer
+    is compacted when the next chunk is emitted.  A chunk holds at
+    least ``SORT_CHUNK_ENTRIES`` entries and as many as the unique
+    entries found so far, so the buffer stays within a small multiple
+    of the final pattern rather than holding every repeated entry,
+    while the number of compactions stays small.
+
+    The entries of extruded maps are generated in closed form from
+    the base entities (see :func:`extruded_progressions`)."""
+    cdef:
+        PetscInt i, r, row, ncols, start, end, nz, ndiag, cur_nrows
+        PetscInt row_offset, e0, e1, nitems, per_item, budget
+        PetscInt[::1] counts, chunk, offsets, fill, cols, rowptr, colidx
+        PetscInt *begin
+
+    rset, cset = sparsity.dsets
+    for c in range(len(cset)):
+        if should_block:
+            ncols = cset[c].size
+        else:
+            ncols = cset[c].size * cset[c].cdim
+        # Memoryviews require writeable buffers
+        flags = [(m, set_writeable(m)) for rmaps, cmaps in sparsity.maps
+                 for m in tuple(rmaps) + tuple(cmaps)]
+        # Start from the diagonal, which is already sorted and unique.
+        counts = np.zeros(nrows, dtype=IntType)
+        row_offset = 0
+        for r in range(len(rset)):
+            cur_nrows = rset[r].size * (1 if should_block else rset[r].cdim)
+            if r == c and sparsity._has_diagonal:
+                for i in range(min(cur_nrows, ncols)):
+                    counts[row_offset + i] = 1
+            row_offset += cur_nrows
+        offsets = np.zeros(nrows + 1, dtype=IntType)
+        np.cumsum(counts, out=np.asarray(offsets)[1:])
+        cols = np.empty(offsets[nrows], dtype=IntType)
+        row_offset = 0
+        for r in range(len(rset)):
+            cur_nrows = rset[r].size * (1 if should_block else rset[r].cdim)
+            if r == c and sparsity._has_diagonal:
+                for i in range(min(cur_nrows, ncols)):
+                    cols[offsets[row_offset + i]] = i
+            row_offset += cur_nrows
+        nz = offsets[nrows]
+        for rmaps, cmaps in sparsity.maps:
+            row_offset = 0
+            for r, rmap in enumerate(rmaps):
+                cur_nrows = rset[r].size * (1 if should_block else rset[r].cdim)
+                cmap = tuple(cmaps)[c]
+                if rmap.iterset._extruded:
+                    prog = extruded_progressions(rset[r], rmap, cset[c], cmap, should_block)
+                    nitems = prog[0].shape[0]
+                    cost = np.cumsum(prog[2])
+                else:
+                    nitems = rmap.iterset.exec_size
+                    per_item = rmap.arity * cmap.arity
+                    if not should_block:
+                        per_item *= rset[r].cdim * cset[c].cdim
+                e0 = 0
+                while e0 < nitems:
+                    budget = max(SORT_CHUNK_ENTRIES, nz)
+                    if rmap.iterset._extruded:
+                        e1 = np.searchsorted(cost, budget + (cost[e0 - 1] if e0 else 0),
+                                             side="right")
+                    else:
+                        e1 = e0 + budget // max(per_item, 1)
+                    e1 = min(max(e1, e0 + 1), nitems)
+                    # Pass one: count
+                    chunk = np.zeros(nrows, dtype=IntType)
+                    if rmap.iterset._extruded:
+                        count_progressions(prog, cur_nrows, row_offset, chunk, e0, e1)
+                    else:
+                        count_entries(rset[r], rmap, cset[c], cmap,
+                                      row_offset, chunk, should_block, e0, e1)
+                    # Compact the unique entries so far, leaving space
+                    # for the chunk after them.
+                    offsets, cols = grow_rows(offsets, counts, chunk, cols)
+                    fill = np.add(offsets[:nrows], counts)
+                    # Pass two: emit
+                    if rmap.iterset._extruded:
+                        emit_progressions(prog, cur_nrows, row_offset, fill, cols, e0, e1)
+                    else:
+                        emit_entries(rset[r], rmap, cset[c], cmap,
+                                     row_offset, fill, cols, should_block, e0, e1)
+                    # Sort and deduplicate the rows the chunk touched
+                    # in place.  counts then holds the number of
+                    # unique entries in each row.
+                    nz = unique_rows(offsets, counts, chunk, cols)
+                    e0 = e1
+                row_offset += cur_nrows
+        for m, flag in reversed(flags):
+            restore_writeable(m, flag)
+        if offsets[nrows] > 0:
+            begin = &cols[0]
+            for row in range(nrows):
+                start = offsets[row]
+                ndiag = lower_bound(begin + start, begin + start + counts[row],
+                                    ncols) - (begin + start)
+                nnz[row] += ndiag
+                onnz[row] += counts[row] - ndiag
+        if make_rowptr:
+            rowptr = np.empty(nrows + 1, dtype=IntType)
+            rowptr[0] = 0
+            nz = 0
+            for row in range(nrows):
+                nz += counts[row]
+                rowptr[row + 1] = nz
+            colidx = np.empty(nz, dtype=IntType)
+            for row in range(nrows):
+                start = offsets[row]
+                for i in range(rowptr[row + 1] - rowptr[row]):
+                    colidx[rowptr[row] + i] = cols[start + i]
+            sparsity._rowptr = np.asarray(rowptr)
+            sparsity._colidx = np.asarray(colidx)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef object grow_rows(PetscInt[::1] offsets, PetscInt[::1] counts,
+                      PetscInt[::1] extra, PetscInt[::1] cols):
+    """Copy the first ``counts[row]`` entries of each row of ``cols``
+    (at ``offsets[row]``) into a new buffer with space for ``extra[row]``
+    more entries after them.
+
+    :returns: a tuple of the new offsets and buffer."""
+    cdef:
+        PetscInt row, i, nrows = counts.shape[0]
+        PetscInt[::1] new_offsets, new_cols
+
+    new_offsets = np.empty(nrows + 1, dtype=IntType)
+    new_offsets[0] = 0
+    for row in range(nrows):
+        new_offsets[row + 1] = new_offsets[row] + counts[row] + extra[row]
+    new_cols = np.empty(new_offsets[nrows], dtype=IntType)
+    with nogil:
+        for row in range(nrows):
+            for i in range(counts[row]):
+                new_cols[new_offsets[row] + i] = cols[offsets[row] + i]
+    return new_offsets, new_cols
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef PetscInt unique_rows(PetscInt[::1] offsets, PetscInt[::1] counts,
+                          PetscInt[::1] extra, PetscInt[::1] cols):
+    """Sort and deduplicate in place the rows of ``cols`` that hold
+    ``extra[row]`` new entries after their ``counts[row]`` unique
+    ones, updating ``counts``.
+
+    :returns: the total number of unique entries."""
+    cdef:
+        PetscInt row, nz = 0, nrows = counts.shape[0]
+        PetscInt *begin
+        PetscInt *last
+
+    if offsets[nrows] == 0:
+        return 0
+    begin = &cols[0]
+    with nogil:
+        for row in range(nrows):
+            if extra[row] > 0:
+                sort(begin + offsets[row],
+                     begin + offsets[row] + counts[row] + extra[row])
+                last = unique(begin + offsets[row],
+                              begin + offsets[row] + counts[row] + extra[row])
+                counts[row] = last - (begin + offsets[row])
+            nz += counts[row]
+    return nz
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 cdef inline void add_entries_extruded(rset, rmap, cset, cmap,
@@ -121,9 +650,10 @@ cdef inline void add_entries_extruded(rset, rmap, cset, cmap,
                                       bint should_block):
     cdef:
         PetscInt nrows, ncols, i, j, k, l, nent, e, start, end, layer
-        PetscInt rarity, carity, row, col, rdim, cdim, layers, tmp_row
+        PetscInt rarity, carity, row, col, rdim, cdim, nlayers, tmp_row
         PetscInt reps, crep, rrep
-        PetscInt[:, ::1] rmap_vals, cmap_vals
+        IterationRegion where
+        PetscInt[:, ::1] rmap_vals, cmap_vals, layers
         PetscInt[::1] roffset, coffset
 
     nent = rmap.iterset.exec_size
@@ -146,7 +676,9 @@ cdef inline void add_entries_extruded(rset, rmap, cset, cmap,
     roffset = rmap.offset
     coffset = cmap.offset
 
-    layers = rmap.iterset.layers
+    # Layer bounds of each column (a writeable copy for the memoryview);
+    # the map values refer to the bottom of the column.
+    layers = np.array(rmap.iterset.layers_array, dtype=IntType)
 
     for region in rmap.iteration_region:
         # The rowmap will have an iteration region attached to
@@ -155,20 +687,19 @@ cdef inline void add_entries_extruded(rset, rmap, cset, cmap,
         # range of the loop over layers, except in the
         # ON_INTERIOR_FACETS where we also have to "double" up
         # the map.
-        start = 0
-        end = layers - 1
-        reps = 1
-        if region.where == "ON_BOTTOM":
-            end = 1
-        elif region.where == "ON_TOP":
-            start = layers - 2
-        elif region.where == "ON_INTERIOR_FACETS":
-            end = layers - 2
-            reps = 2
-        elif region.where != "ALL":
-            raise RuntimeError("Unhandled iteration region %s", region)
+        where = decode_region(region)
+        reps = 2 if where == REGION_ON_INTERIOR_FACETS else 1
 
         for e in range(nent):
+            nlayers = layers[e, 1] - layers[e, 0]
+            start = 0
+            end = nlayers - 1
+            if where == REGION_ON_BOTTOM:
+                end = 1
+            elif where == REGION_ON_TOP:
+                start = nlayers - 2
+            elif where == REGION_ON_INTERIOR_FACETS:
+                end = nlayers - 2
             for i in range(rarity):
                 tmp_row = rdim * (rmap_vals[e, i] + start * roffset[i])
                 if tmp_row >= nrows:
@@ -192,12 +723,20 @@ cdef inline void add_entries_extruded(rset, rmap, cset, cmap,
 
 @cython.boundscheck(False)
 @cython.cdivision(True)
-def build_sparsity(object sparsity, bint parallel, bool block=True):
+def build_sparsity(object sparsity, bint parallel, bool block=True,
+                   int nthreads=1, method="vecset"):
     """Build a sparsity pattern defined by a list of pairs of maps
 
     :arg sparsity: the Sparsity object to build a pattern for
     :arg parallel: Are we running in parallel?
     :arg block: Should we build a block sparsity
+    :arg nthreads: Number of threads to use when inserting the
+         entries of non-extruded maps.  The resulting pattern does not
+         depend on the number of threads.
+    :arg method: How to build the pattern, either ``"vecset"``
+         (insert entries into a set per row) or ``"sort"`` (two-pass
+         counting sort into a flat buffer, generating the entries of
+         extruded maps in closed form from the base entities).
 
     The sparsity pattern is built from the outer products of the pairs
     of maps.  This code works for both the serial and (MPI-) parallel
@@ -238,6 +777,21 @@ def build_sparsity(object sparsity, bint parallel, bool block=True):
         sparsity._rowptr = dummy
         sparsity._colidx = dummy
 
+    if method == "sort":
+        d_nnz = np.zeros(nrows, dtype=IntType)
+        o_nnz = np.zeros(nrows, dtype=IntType)
+        sparsity._rowptr = np.empty(0, dtype=IntType).reshape(-1)
+        sparsity._colidx = np.empty(0, dtype=IntType).reshape(-1)
+        build_sparsity_sorted(sparsity, should_block, make_rowptr, nrows,
+                              d_nnz, o_nnz)
+        sparsity._d_nz = int(d_nnz.sum())
+        sparsity._o_nz = int(o_nnz.sum())
+        sparsity._d_nnz = d_nnz
+        sparsity._o_nnz = o_nnz
+        return
+    elif method not in ("sort", "vecset"):
+        raise ValueError("Unknown sparsity build method '%s'" % method)
+
     # Exposition:
     # When building a monolithic sparsity for a mixed space, we build
     # the contributions from each column set separately and then sum
@@ -289,6 +843,12 @@ def build_sparsity(object sparsity, bint parallel, bool block=True):
                                          row_offset,
                                          diag[c], odiag[c],
                                          should_block)
+                elif nthreads > 1:
+                    add_entries_threaded(rset[r], rmap,
+                                         cset[c], cmap,
+                                         row_offset,
+                                         diag[c], odiag[c],
+                                         should_block, nthreads)
                 else:
                     add_entries(rset[r], rmap,
                                 cset[c], cmap,
@@ -361,11 +921,12 @@ def fill_with_zeros(PETSc.Mat mat not None, dims, maps, set_diag=True):
         int set_size
         int layer_start, layer_end
         int layer
-        PetscInt i
+        PetscInt i, nlayers
         PetscScalar zero = 0.0
         PetscInt nrow, ncol
         PetscInt rarity, carity, tmp_rarity, tmp_carity
-        PetscInt[:, ::1] rmap, cmap
+        IterationRegion where
+        PetscInt[:, ::1] rmap, cmap, layers
         PetscInt *rvals
         PetscInt *cvals
         PetscInt *roffset
@@ -403,8 +964,9 @@ def fill_with_zeros(PETSc.Mat mat not None, dims, maps, set_diag=True):
                                          carity, &cmap[set_entry, 0],
                                          values, PETSC_INSERT_VALUES)
         else:
-            # The extruded case needs a little more work.
-            layers = pair[0].iterset.layers
+            # The extruded case needs a little more work.  The map
+            # values refer to the bottom of each column.
+            layers = np.array(pair[0].iterset.layers_array, dtype=IntType)
             # We only need the *4 if we have an ON_INTERIOR_FACETS
             # iteration region, but it doesn't hurt to make them all
             # bigger, since we can special case less code below.
@@ -420,31 +982,32 @@ def fill_with_zeros(PETSc.Mat mat not None, dims, maps, set_diag=True):
             if pair[0].iteration_region != pair[1].iteration_region:
                 raise NotImplementedError("fill_with_zeros: iteration regions of row and col maps don't match")
             for r in pair[0].iteration_region:
-                # Default is "ALL"
-                layer_start = 0
-                layer_end = layers - 1
                 tmp_rarity = rarity
                 tmp_carity = carity
-                if r.where == "ON_BOTTOM":
-                    # Finish after first layer
-                    layer_end = 1
-                elif r.where == "ON_TOP":
-                    # Start on penultimate layer
-                    layer_start = layers - 2
-                elif r.where == "ON_INTERIOR_FACETS":
-                    # Finish on penultimate layer
-                    layer_end = layers - 2
+                where = decode_region(r)
+                if where == REGION_ON_INTERIOR_FACETS:
                     # Double up rvals and cvals (the map is over two
                     # cells, not one)
                     tmp_rarity *= 2
                     tmp_carity *= 2
-                elif r.where != "ALL":
-                    raise RuntimeError("Unhandled iteration region %s", r)
                 for i in range(rarity):
                     roffset[i] = pair[0].offset[i]
                 for i in range(carity):
                     coffset[i] = pair[1].offset[i]
                 for set_entry in range(set_size):
+                    # Default is "ALL"
+                    nlayers = layers[set_entry, 1] - layers[set_entry, 0]
+                    layer_start = 0
+                    layer_end = nlayers - 1
+                    if where == REGION_ON_BOTTOM:
+                        # Finish after first layer
+                        layer_end = 1
+                    elif where == REGION_ON_TOP:
+                        # Start on penultimate layer
+                        layer_start = nlayers - 2
+                    elif where == REGION_ON_INTERIOR_FACETS:
+                        # Finish on penultimate layer
+                        layer_end = nlayers - 2
                     # In the case of tmp_rarity == rarity this is just:
                     #
                     # rvals[i] = rmap[set_entry, i] + layer_start * roffset[i]
@@ -38,6 +38,7 @@ from six.moves import range
 
 import os
 import sys
+import mmap
 import numpy as np
 from decorator import decorator
 import argparse
@@ -278,9 +279,11 @@ def parser(description=None, group=False):
 def maybe_setflags(array, write=None, align=None, uic=None):
     """Set flags on a numpy ary.
 
-    But don't try to set the write flag if the data aren't owned by this array.
+    But don't try to set the write flag if the data aren't owned by this array
+    (memory maps count as owning the mapped file's data).
     See `numpy.ndarray.setflags` for details of the parameters."""
-    write = write if array.flags['OWNDATA'] else None
+    owned = array.flags['OWNDATA'] or isinstance(array.base, mmap.mmap)
+    write = write if owned else None
     array.setflags(write=write, align=align, uic=uic)
 
 
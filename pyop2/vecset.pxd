@@ -18,7 +18,7 @@ cdef extern from "vecset.h":
         vecset(int) nogil except +
         vecset(vecset&) nogil except +
         const_iterator find(T&) nogil
-        bool insert(T&)
+        bool insert(T&) nogil
         void insert(const_iterator, const_iterator)
         const_iterator begin() nogil
         const_iterator end() nogil
@@ -120,6 +120,43 @@ if 'CC' not in env:
     env['CC'] = "mpicc"
 
 
+def get_openmp_flags():
+    """Return the flags enabling OpenMP for the sparsity extension.
+
+    Set PYOP2_OPENMP to 0 or 1 to disable or force OpenMP, otherwise
+    it is used if the compiler can build and link a test program with
+    it (Apple's clang cannot).  Without OpenMP, threaded sparsity
+    construction runs serially."""
+    if 'PYOP2_OPENMP' in env:
+        return ["-fopenmp"] if env['PYOP2_OPENMP'] not in ("", "0") else []
+    import shutil
+    import tempfile
+    from distutils.ccompiler import new_compiler
+    from distutils.errors import CompileError, LinkError
+    from distutils.sysconfig import customize_compiler
+    compiler = new_compiler()
+    customize_compiler(compiler)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tmpdir, "openmp.c")
+        with open(source, "w") as f:
+            f.write("#include <omp.h>\n"
+                    "int main(void) { return omp_get_max_threads() < 1; }\n")
+        objects = compiler.compile([source], output_dir=tmpdir,
+                                   extra_postargs=["-fopenmp"])
+        compiler.link_executable(objects, os.path.join(tmpdir, "openmp"),
+                                 extra_postargs=["-fopenmp"])
+    except (CompileError, LinkError):
+        print("OpenMP not supported, building the sparsity extension without it")
+        return []
+    finally:
+        shutil.rmtree(tmpdir)
+    return ["-fopenmp"]
+
+
+openmp_flags = get_openmp_flags()
+
+
 class sdist(_sdist):
     def run(self):
         # Make sure the compiled Cython files in the distribution are up-to-date
@@ -159,7 +196,9 @@ setup(name='PyOP2',
       ext_modules=[Extension('pyop2.sparsity', sparsity_sources,
                              include_dirs=['pyop2'] + includes, language="c++",
                              libraries=["petsc"],
-                             extra_link_args=["-L%s/lib" % d for d in petsc_dirs] +
+                             extra_compile_args=openmp_flags,
+                             extra_link_args=openmp_flags +
+                             ["-L%s/lib" % d for d in petsc_dirs] +
                              ["-Wl,-rpath,%s/lib" % d for d in petsc_dirs]),
                    Extension('pyop2.computeind', computeind_sources,
                              include_dirs=numpy_includes)])
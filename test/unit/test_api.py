@@ -1571,6 +1571,17 @@ class TestMapAPI:
             % (m_iterset_toset.name, m_iterset_toset.iterset, m_iterset_toset.toset, m_iterset_toset.arity)
         assert str(m_iterset_toset) == s
 
+    def test_map_inverse(self, iterset, toset):
+        "Map inverse should list the iterset entities referencing each toset entity."
+        m = op2.Map(iterset, toset, 2, [2, 0, 0, 0])
+        offsets, indices = m.inverse
+        assert list(offsets) == [0, 3, 3, 4]
+        assert list(indices) == [0, 1, 1, 0]
+
+    def test_map_inverse_cached(self, m_iterset_toset):
+        "Map inverse should be computed once."
+        assert m_iterset_toset.inverse is m_iterset_toset.inverse
+
 
 class TestMixedMapAPI:
 
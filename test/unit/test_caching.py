@@ -38,6 +38,7 @@ import pytest
 import numpy
 import random
 from pyop2 import op2, base
+from pyop2.configuration import configuration
 
 from coffee.base import *
 
@@ -667,6 +668,37 @@ class TestSparsityCache:
         sp2 = op2.Sparsity((ds2, ds2), ((m2, m2), (m1, m1)))
         assert sp1 is sp2
 
+    @pytest.fixture
+    def intern(cls, request):
+        old = configuration["intern_map_values"]
+        configuration["intern_map_values"] = True
+        request.addfinalizer(lambda: configuration.__setitem__("intern_map_values", old))
+
+    def test_interned_maps_share_values(self, intern, s1, s2):
+        "Maps with identical values should share a read-only buffer."
+        m1 = op2.Map(s1, s2, 1, [0, 1, 2, 3, 4])
+        m2 = op2.Map(s1, s2, 1, [0, 1, 2, 3, 4])
+        m3 = op2.Map(s1, s2, 1, [1, 2, 3, 4, 0])
+        assert m1.values_with_halo is m2.values_with_halo
+        assert m1.values_with_halo is not m3.values_with_halo
+        assert not m1.values_with_halo.flags.writeable
+        assert m1 <= m2 and m2 <= m1 and not m1 <= m3
+
+    def test_sparsities_identical_interned_maps_cached(self, intern, s1, s2, ds2):
+        "Sparsities on maps with identical values should share a C handle."
+        m1 = op2.Map(s1, s2, 1, [0, 1, 2, 3, 4])
+        m2 = op2.Map(s1, s2, 1, [0, 1, 2, 3, 4])
+        sp1 = op2.Sparsity(ds2, m1)
+        sp2 = op2.Sparsity(ds2, m2)
+        assert sp1 is sp2
+        assert (m2, m2) in sp1
+
+    def test_sparsities_identical_maps_not_cached(self, s1, s2, ds2):
+        "Without interning, maps with identical values are different."
+        m1 = op2.Map(s1, s2, 1, [0, 1, 2, 3, 4])
+        m2 = op2.Map(s1, s2, 1, [0, 1, 2, 3, 4])
+        assert op2.Sparsity(ds2, m1) is not op2.Sparsity(ds2, m2)
+
 
 if __name__ == '__main__':
     import os
@@ -34,13 +34,70 @@
 from __future__ import absolute_import, print_function, division
 from six.moves import range
 
+import subprocess
+import sys
 import pytest
 import numpy as np
 
-from pyop2 import op2
+from pyop2 import op2, exceptions
+from pyop2.configuration import configuration
+from pyop2.snapshot import SnapshotWriter
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
 
 nelems = 5
 
+halo_state_parallel_script = """
+import sys
+import numpy as np
+from pyop2 import op2
+from pyop2.mpi import COMM_WORLD as comm
+
+op2.init(lazy_evaluation=sys.argv[1] == "lazy")
+assert comm.size == 2
+if comm.rank == 0:
+    # Owns nodes 0, 1 (sending 1) and elements 0, 1; executes element
+    # 2 in its exec halo, reading halo nodes 2, 3.
+    node_sizes, numbering, sends, receives = [1, 2, 4, 4], [0, 1, 2, 3], {1: [1]}, {1: [2, 3]}
+    elem_sizes, values = [1, 2, 3, 3], [0, 1, 1, 2, 2, 3]
+else:
+    # Owns nodes 3, 2 (sending both) and element 2; executes element
+    # 1 in its exec halo, reading halo node 1.
+    node_sizes, numbering, sends, receives = [1, 2, 3, 3], [3, 2, 1], {0: [1, 0]}, {0: [2]}
+    elem_sizes, values = [1, 1, 2, 2], [1, 0, 2, 1]
+nodes = op2.Set(node_sizes, halo=op2.Halo(sends, receives, comm=comm))
+elements = op2.Set(elem_sizes, halo=op2.Halo({}, {}, comm=comm))
+elem_node = op2.Map(elements, nodes, 2, values)
+dat = op2.Dat(nodes, np.array(numbering, dtype=np.float64))
+out = op2.Dat(elements, dtype=np.float64)
+inc = op2.Kernel("void inc(double *v) { *v += 1.0; }", "inc")
+read = op2.Kernel("void k(double *o, double **v) { *o = v[0][0] + v[1][0]; }", "k")
+
+
+def check(written, counts):
+    # Only rank 0 writes, so rank 1 must join in any exchange
+    op2.par_loop(inc, op2.Subset(nodes, written if comm.rank == 0 else []), dat(op2.RW))
+    op2.par_loop(read, elements, out(op2.WRITE), dat(op2.READ, elem_node))
+    out.data_ro
+    assert dat.halo_exchange_counts == counts
+
+
+# A write to rank 0's send list makes rank 1's halo stale
+check([1], (1, 0))
+values = dat.data_ro_with_halos
+if comm.rank == 1:
+    assert values[2] == 2.0
+# A write away from the send lists leaves every halo valid (the
+# extra exchange is data_ro_with_halos's)
+check([0], (2, 1))
+values = dat.data_ro_with_halos
+if comm.rank == 0:
+    assert (values[2:] == [2.0, 3.0]).all()
+"""
+
 
 @pytest.fixture(scope='module')
 def s():
@@ -132,6 +189,155 @@ class TestDat:
         mdat2.load(output)
         assert all(all(d.data_ro == d_.data_ro) for d, d_ in zip(mdat, mdat2))
 
+    def test_dat_backing_file(self, tmpdir, s):
+        """A Dat backed by a file should write through to it on save
+        and pick up its values when reopened."""
+        backing = tmpdir.join('backing.npy').strpath
+        d = op2.Dat(s, np.arange(s.size, dtype=np.float64), backing_file=backing)
+        assert not d.data_ro.flags.writeable
+        d.data[:] += 1
+        d.save(backing)
+        assert (np.load(backing) == np.arange(s.size) + 1).all()
+        d2 = op2.Dat(s, backing_file=backing)
+        assert (d2.data_ro == d.data_ro).all()
+
+    def test_dat_backing_file_shape_mismatch(self, tmpdir, s):
+        """Reopening a backing file of the wrong shape should fail."""
+        backing = tmpdir.join('backing.npy').strpath
+        op2.Dat(s, backing_file=backing)
+        with pytest.raises(exceptions.DataValueError):
+            op2.Dat(s ** 2, backing_file=backing)
+
+
+class SendingHalo(op2.Halo):
+
+    """A serial halo which pretends that ``sends`` are sent to
+    another process.  Exchanges are no-ops."""
+
+    def __init__(self, sends):
+        super(SendingHalo, self).__init__({}, {})
+        self._fake_sends = np.asarray(sends)
+
+    @property
+    def send_indices(self):
+        return self._fake_sends
+
+    def begin(self, dat, reverse=False):
+        pass
+
+    def end(self, dat, reverse=False):
+        pass
+
+
+class TestHaloState:
+
+    """
+    Test tracking of halo validity
+    """
+
+    @pytest.fixture
+    def hset(self):
+        return op2.Set(nelems, halo=SendingHalo([0, 1]))
+
+    @pytest.fixture
+    def hdat(self, hset):
+        return op2.Dat(hset, np.zeros(nelems), dtype=np.float64)
+
+    @pytest.fixture
+    def inc(self):
+        return op2.Kernel("void inc(double *v) { *v += 1.0; }", "inc")
+
+    def read(self, hdat):
+        iterset = op2.Set(1)
+        m = op2.Map(iterset, hdat.dataset.set, 1, [nelems - 1])
+        g = op2.Global(1, 0.0, dtype=np.float64)
+        k = op2.Kernel("void k(double *g, double *v) { *g += *v; }", "k")
+        op2.par_loop(k, iterset, g(op2.INC), hdat(op2.READ, m))
+        return g.data_ro[0]
+
+    def test_initially_valid(self, hdat):
+        assert hdat.halo_state == op2.Dat.HALO_VALID
+        assert not hdat.needs_halo_update
+
+    def test_subset_write_away_from_sends(self, hset, hdat, inc):
+        ss = op2.Subset(hset, [2, 3, 4])
+        op2.par_loop(inc, ss, hdat(op2.RW))
+        hdat.data_ro
+        assert hdat.halo_state == op2.Dat.OWNED_DIRTY
+        assert not hdat.needs_halo_update
+        assert self.read(hdat) == 1.0
+        assert hdat.halo_exchange_counts == (0, 1)
+        assert hdat.halo_state == op2.Dat.HALO_VALID
+
+    def test_subset_write_touching_sends(self, hset, hdat, inc):
+        ss = op2.Subset(hset, [1, 4])
+        op2.par_loop(inc, ss, hdat(op2.RW))
+        hdat.data_ro
+        assert hdat.needs_halo_update
+        self.read(hdat)
+        assert hdat.halo_exchange_counts == (1, 0)
+
+    def test_full_write_invalidates(self, hset, hdat, inc):
+        op2.par_loop(inc, hset, hdat(op2.RW))
+        hdat.data_ro
+        assert hdat.halo_state == op2.Dat.HALO_STALE
+
+    def test_data_access_invalidates(self, hdat):
+        hdat.data
+        assert hdat.halo_state == op2.Dat.HALO_STALE
+
+    def test_needs_halo_update_setter(self, hdat):
+        hdat.needs_halo_update = True
+        assert hdat.halo_state == op2.Dat.HALO_STALE
+        hdat.needs_halo_update = False
+        assert hdat.halo_state == op2.Dat.HALO_VALID
+
+    @pytest.mark.skipif(which("mpiexec") is None, reason="mpiexec required to test in parallel")
+    def test_halo_state_parallel(self, tmpdir):
+        """A write to one process's send list should trigger a halo
+        exchange on every process."""
+        script = tmpdir.join("halo_state.py")
+        script.write(halo_state_parallel_script)
+        mode = "lazy" if configuration["lazy_evaluation"] else "greedy"
+        subprocess.check_call(["mpiexec", "-n", "2", sys.executable, str(script), mode])
+
+
+class TestSnapshot:
+
+    """
+    Test asynchronous snapshots of Dats
+    """
+
+    @pytest.fixture
+    def inc(self):
+        return op2.Kernel("void inc(double *v) { *v += 1.0; }", "inc")
+
+    def test_snapshot_sees_values_at_snapshot_time(self, tmpdir, s, inc):
+        d = op2.Dat(s, np.zeros(s.size), dtype=np.float64)
+        with SnapshotWriter(maxsize=1) as writer:
+            for i in range(4):
+                op2.par_loop(inc, s, d(op2.RW))
+                writer.snapshot(d, tmpdir.join('d%d.npy' % i).strpath)
+            op2.par_loop(inc, s, d(op2.RW))
+        for i in range(4):
+            assert (np.load(tmpdir.join('d%d.npy' % i).strpath) == i + 1).all()
+        assert (d.data_ro == 5).all()
+
+    def test_snapshot_wait(self, tmpdir, d1):
+        filename = tmpdir.join('d.npy').strpath
+        with SnapshotWriter() as writer:
+            snapshot = writer.snapshot(d1, filename)
+            snapshot.wait()
+            assert snapshot.done
+            assert (np.load(filename) == d1.data_ro).all()
+
+    def test_snapshot_error_is_raised(self, tmpdir, d1):
+        writer = SnapshotWriter()
+        snapshot = writer.snapshot(d1, tmpdir.join('missing', 'd.npy').strpath)
+        with pytest.raises(IOError):
+            snapshot.wait()
+        writer.close()
+
 
 if __name__ == '__main__':
     import os
@@ -39,7 +39,9 @@ import random
 from numpy.testing import assert_allclose
 
 from pyop2 import op2
+from pyop2.configuration import configuration
 from pyop2.computeind import compute_ind_extr
+from pyop2.exceptions import SizeTypeError
 
 from coffee.base import *
 
@@ -448,6 +450,142 @@ void comp_vol(double A[1], double *x[], double *y[])
 
         assert sum(sum(dat_c.data)) == nums[0] * layers * 2
 
+    def test_vectorise_columns(self, elements, dat_coords, coords_map,
+                               field_map, dat_f):
+        """Executing the layers of each column as independent iterations
+        should give the same result as walking up the columns."""
+        kernel = op2.Kernel("""
+void kernel_cols(double* x[], double* y[], int layer) {
+  double sum = 0.0;
+  for (int i=0; i<6; i++) {
+    sum += x[i][0] + 2*x[i][1];
+  }
+  y[0][0] += sum + layer;
+}""", "kernel_cols")
+
+        def run(vectorise):
+            f = op2.Dat(dat_f.dataset, dat_f.data_ro, numpy.float64, "f")
+            loop = op2.par_loop(kernel, elements,
+                                dat_coords(op2.READ, coords_map),
+                                f(op2.INC, field_map),
+                                pass_layer_arg=True,
+                                vectorise_columns=vectorise)
+            return loop, f.data_ro
+
+        loop, ref = run(False)
+        assert not loop.column_vectorised
+        loop, f = run(True)
+        assert loop.column_vectorised
+        assert_allclose(f, ref)
+
+    def test_vectorise_columns_ineligible(self, elements, dat_coords,
+                                          coords_map, dat_c):
+        """Loops modifying data shared between the layers of a column
+        should walk up the columns."""
+        kernel = op2.Kernel("""
+void kernel_shared(double* x[], double* y[]) {
+  for (int i=0; i<6; i++) {
+    y[i][0] += x[i][0];
+  }
+}""", "kernel_shared")
+
+        def run(vectorise):
+            c = op2.Dat(dat_c.dataset, dat_c.data_ro, numpy.float64, "c")
+            loop = op2.par_loop(kernel, elements,
+                                dat_coords(op2.READ, coords_map),
+                                c(op2.INC, coords_map),
+                                vectorise_columns=vectorise)
+            return loop, c.data_ro
+
+        assert not coords_map._columns_disjoint
+        _, ref = run(False)
+        loop, c = run(True)
+        assert not loop.column_vectorised
+        assert_allclose(c, ref)
+
+    @pytest.mark.parametrize("vectorise", [False, True])
+    def test_variable_layers(self, vectorise):
+        """Loops over an extruded set with a varying number of layers
+        should only visit the cells of each column, passing the
+        absolute layer number."""
+        base = op2.Set(4)
+        layers = numpy.array([[0, 4], [1, 4], [0, 2], [2, 6]])
+        extruded = op2.ExtrudedSet(base, layers=layers)
+        assert not extruded.constant_layers
+        assert extruded.layers == 4
+        # Cells are numbered consecutively up each column
+        ncells = layers[:, 1] - layers[:, 0] - 1
+        cells = op2.Set(int(ncells.sum()))
+        bottom = numpy.cumsum(ncells) - ncells
+        cell_map = op2.Map(extruded, cells, 1, bottom, "cell_map",
+                           numpy.array([1], dtype=numpy.int32))
+        x = op2.Dat(cells, numpy.full(cells.size, -1.0), numpy.float64, "x")
+        kernel = op2.Kernel("""void k(double* x[], int layer) {
+  x[0][0] = layer;
+}""", "k")
+        loop = op2.par_loop(kernel, extruded, x(op2.WRITE, cell_map),
+                            pass_layer_arg=True, vectorise_columns=vectorise)
+        assert loop.column_vectorised == vectorise
+        assert (x.data_ro == [0, 1, 2, 1, 2, 0, 2, 3, 4]).all()
+
+        x.data[:] = -1
+        op2.par_loop(kernel, extruded, x(op2.WRITE, cell_map),
+                     pass_layer_arg=True, iterate=op2.ON_TOP)
+        assert (x.data_ro == [-1, -1, 2, -1, 2, 0, -1, -1, 4]).all()
+
+    @pytest.mark.parametrize("builder", ["vecset", "sort"])
+    def test_variable_layers_sparsity(self, builder):
+        """The sparsity of an extruded set with a varying number of
+        layers should only couple the nodes within each column."""
+        base = op2.Set(2)
+        extruded = op2.ExtrudedSet(base, layers=[[0, 3], [1, 5]])
+        # Nodes are numbered consecutively up each column
+        nodes = op2.Set(7)
+        node_map = op2.Map(extruded, nodes, 2, [0, 1, 3, 4], "node_map",
+                           numpy.array([1, 1], dtype=numpy.int32))
+        old = configuration["sparsity_builder"]
+        configuration["sparsity_builder"] = builder
+        try:
+            sparsity = op2.Sparsity((nodes, nodes), (node_map, node_map))
+        finally:
+            configuration["sparsity_builder"] = old
+        assert all(sparsity.nnz == [2, 3, 2, 2, 3, 3, 2])
+        assert all(sparsity._colidx == [0, 1, 0, 1, 2, 1, 2, 3, 4,
+                                        3, 4, 5, 4, 5, 6, 5, 6])
+
+    def test_extruded_sparsity_sort(self):
+        """Building an extruded sparsity in closed form should give the
+        same pattern as inserting every layer."""
+        base = op2.Set(3)
+        extruded = op2.ExtrudedSet(base, layers=5)
+        # Two columns of nodes per base cell, with neighbouring cells
+        # sharing a column
+        nodes = op2.Set(20)
+        node_map = op2.Map(extruded, nodes, 4,
+                           [0, 1, 5, 6, 5, 6, 10, 11, 10, 11, 15, 16],
+                           "node_map", numpy.array([1, 1, 1, 1], dtype=numpy.int32))
+        patterns = []
+        old = configuration["sparsity_builder"]
+        for builder in ["vecset", "sort"]:
+            configuration["sparsity_builder"] = builder
+            try:
+                sparsity = op2.Sparsity((nodes, nodes), (node_map, node_map))
+            finally:
+                configuration["sparsity_builder"] = old
+            patterns.append((sparsity.nnz, sparsity._rowptr, sparsity._colidx))
+            # Fresh maps so the second builder is not served from the cache
+            node_map = op2.Map(extruded, nodes, 4, node_map.values,
+                               "node_map", node_map.offset)
+        for a, b in zip(*patterns):
+            assert (a == b).all()
+
+    @pytest.mark.parametrize("layers", [[[0, 3], [1, 2]], [[-1, 3], [0, 3]], [[0, 3]]])
+    def test_variable_layers_invalid(self, layers):
+        """Every column of an extruded set should have at least two
+        layers, starting from layer 0 or above."""
+        with pytest.raises(SizeTypeError):
+            op2.ExtrudedSet(op2.Set(2), layers=layers)
+
     def test_extruded_assemble_mat(
         self, xtr_mat, xtr_coords, xtr_elements,
         xtr_elem_node, extrusion_kernel, xtr_nodes, vol_comp,
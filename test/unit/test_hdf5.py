@@ -40,7 +40,9 @@ from __future__ import absolute_import, print_function, division
 import numpy as np
 import pytest
 
-from pyop2 import op2
+from pyop2 import op2, exceptions
+from pyop2.configuration import configuration
+from pyop2.checkpoint import checkpoint, restart
 
 # If h5py is not available this test module is skipped
 h5py = pytest.importorskip("h5py")
@@ -117,3 +119,91 @@ class TestHDF5:
         assert m.arity == 2
         assert m.values.sum() == sum((1, 2, 2, 3))
         assert m.name == 'map'
+
+    def test_set_hdf5_sizes(self, h5file):
+        "Set should take local sizes, checked against the global size."
+        s = op2.Set.fromhdf5(h5file, name='set', sizes=[3, 5, 6, 7])
+        assert s.size == 5 and s.total_size == 7
+
+    def test_set_hdf5_sizes_mismatch(self, h5file):
+        "Local sizes not matching the global size should raise."
+        with pytest.raises(exceptions.SizeTypeError):
+            op2.Set.fromhdf5(h5file, name='set', sizes=[4, 4, 4, 4])
+
+    @pytest.mark.parametrize("chunk_size", [16, 1 << 20])
+    def test_dat_hdf5_indices(self, h5file, chunk_size):
+        "Reading selected rows of a Dat should give those rows in order."
+        indices = [4, 0, 3]
+        old = configuration["hdf5_chunk_size"]
+        configuration["hdf5_chunk_size"] = chunk_size
+        try:
+            d = op2.Dat.fromhdf5(op2.Set(3) ** 2, h5file, 'dat', indices=indices)
+        finally:
+            configuration["hdf5_chunk_size"] = old
+        assert (d.data_ro == np.arange(10).reshape(5, 2)[indices]).all()
+
+    def test_map_hdf5_indices(self, toset, h5file):
+        "Reading selected rows of a Map should renumber into the local toset."
+        m = op2.Map.fromhdf5(op2.Set(1), toset, h5file, name="map",
+                             indices=[1], toset_indices=[3, 2, 7])
+        assert m.values.tolist() == [[1, 0]]
+        m = op2.Map.fromhdf5(op2.Set(1), toset, h5file, name="map",
+                             indices=[0], toset_indices=[2, 0, 5])
+        assert m.values.tolist() == [[-1, 0]]
+
+
+class TestCheckpoint:
+
+    @pytest.fixture
+    def objects(self):
+        s = op2.Set(4)
+        m = op2.Map(s, s, 2, [0, 1, 1, 2, 2, 3, 3, 0])
+        mat = op2.Mat(op2.Sparsity(s, m))
+        mat.set_values([0, 1], [0, 1], [[1.0, 2.0], [3.0, 4.0]])
+        mat.assemble()
+        return {'dat': op2.Dat(s ** 2, np.arange(8, dtype=np.float64)),
+                'mdat': op2.MixedDat([op2.Dat(s, np.arange(4, dtype=np.float64)),
+                                      op2.Dat(op2.Set(2), [5.0, 6.0])]),
+                'glob': op2.Global(2, [7.0, 8.0]),
+                'mat': mat}
+
+    def zeroed(self, objects):
+        mat = objects['mat']
+        return {'dat': op2.Dat(objects['dat'].dataset),
+                'mdat': op2.MixedDat(objects['mdat'].dataset),
+                'glob': op2.Global(2, [0.0, 0.0]),
+                'mat': op2.Mat(mat.sparsity)}
+
+    @pytest.mark.parametrize("compression", [None, "gzip"])
+    def test_checkpoint_restart(self, tmpdir, objects, compression):
+        "Restarting from a checkpoint should recover all values."
+        filename = str(tmpdir.join('checkpoint.h5'))
+        assert checkpoint(filename, objects, compression=compression) > 0
+        new = self.zeroed(objects)
+        restart(filename, new)
+        assert (new['dat'].data_ro == objects['dat'].data_ro).all()
+        for d, d_ in zip(new['mdat'], objects['mdat']):
+            assert (d.data_ro == d_.data_ro).all()
+        assert (new['glob'].data_ro == objects['glob'].data_ro).all()
+        assert (new['mat'].values == objects['mat'].values).all()
+
+    @pytest.mark.parametrize("compression", [None, "gzip"])
+    def test_checkpoint_numbering(self, tmpdir, objects, compression):
+        "Values written with a numbering should be stored in that order."
+        filename = str(tmpdir.join('checkpoint.h5'))
+        dat = objects['dat']
+        checkpoint(filename, {'dat': dat}, compression=compression,
+                   numbering={'dat': [2, 0, 3, 1]})
+        new = op2.Dat(dat.dataset)
+        restart(filename, {'dat': new})
+        assert (new.data_ro[[2, 0, 3, 1]] == dat.data_ro).all()
+        restart(filename, {'dat': new}, numbering={'dat': [2, 0, 3, 1]})
+        assert (new.data_ro == dat.data_ro).all()
+
+    def test_checkpoint_numbering_empty(self, tmpdir):
+        "A Dat with no owned values should checkpoint with a numbering."
+        filename = str(tmpdir.join('checkpoint.h5'))
+        dat = op2.Dat(op2.Set(0) ** 2)
+        checkpoint(filename, {'dat': dat}, compression="gzip",
+                   numbering={'dat': []})
+        restart(filename, {'dat': op2.Dat(dat.dataset)})
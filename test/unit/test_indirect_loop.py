@@ -39,6 +39,7 @@ import numpy as np
 import random
 
 from pyop2 import op2
+from pyop2.configuration import configuration
 from pyop2.exceptions import MapValueError, IndexValueError
 
 from coffee.base import *
@@ -226,6 +227,69 @@ class TestIndirectLoop:
         expected = np.arange(1, nedges * 2 + 1, 2)
         assert all(expected == edge_vals.data)
 
+    def test_compact_maps(self, iterset, indset, iterset2indset):
+        """Maps passed as 32-bit integers should give the same result."""
+        kernel_inc = "void kernel_inc(unsigned int* x) { (*x) = (*x) + 1; }\n"
+        x = op2.Dat(indset, np.zeros(nelems, dtype=np.uint32), np.uint32, "x")
+        old = configuration["compact_maps"]
+        configuration["compact_maps"] = True
+        try:
+            arg = x(op2.INC, iterset2indset[0])
+            assert arg._map_dtype == np.int32
+            op2.par_loop(op2.Kernel(kernel_inc, "kernel_inc"), iterset, arg)
+        finally:
+            configuration["compact_maps"] = old
+        assert iterset2indset._compact_values.dtype == np.int32
+        assert (iterset2indset._compact_values == iterset2indset.values_with_halo).all()
+        assert (x.data_ro == np.bincount(iterset2indset.values[:, 0], minlength=nelems)).all()
+
+    def test_owner_computes(self, indset):
+        """Executing an INC loop over the target set should give the same
+        result as executing it over the source set."""
+        edges = op2.Set(nelems, "edges")
+        values = np.random.RandomState(0).randint(0, nelems, size=(nelems, 2))
+        values[0] = [3, 3]
+        e2n = op2.Map(edges, indset, 2, values, "e2n")
+        w = op2.Dat(edges, np.arange(nelems, dtype=np.float64), np.float64, "w")
+        g = op2.Global(1, 2.0, np.float64, "g")
+        kernel = op2.Kernel("""
+void kernel_owner(double **x, double *y, double *w, double *g) {
+  x[0][0] += w[0];
+  x[1][0] += (*g) * w[0];
+  y[0] += 1.0;
+}""", "kernel_owner")
+
+        def run():
+            x = op2.Dat(indset, np.ones(nelems), np.float64, "x")
+            y = op2.Dat(indset, np.zeros(nelems), np.float64, "y")
+            loop = op2.par_loop(kernel, edges, x(op2.INC, e2n), y(op2.INC, e2n[1]),
+                                w(op2.READ), g(op2.READ))
+            return loop, x.data_ro, y.data_ro
+
+        loop, x, y = run()
+        assert loop.owner_map is None
+        old = configuration["owner_computes"]
+        configuration["owner_computes"] = True
+        try:
+            owner_loop, owner_x, owner_y = run()
+        finally:
+            configuration["owner_computes"] = old
+        assert owner_loop.owner_map is e2n
+        assert not owner_loop.needs_exec_halo
+        assert np.allclose(x, owner_x)
+        assert (y == owner_y).all()
+
+    def test_owner_computes_ineligible(self, iterset, indset, iterset2indset):
+        """Loops which do not only increment through a single map should
+        be executed over the source set."""
+        x = op2.Dat(indset, np.zeros(nelems), np.float64, "x")
+        g = op2.Global(1, 0.0, np.float64, "g")
+        kernel = op2.Kernel("void k(double *x, double *g) { *x += 1.0; *g += 1.0; }", "k")
+        loop = op2.par_loop(kernel, iterset, x(op2.INC, iterset2indset[0]), g(op2.INC),
+                            owner_computes=True)
+        assert loop.owner_map is None
+        assert g.data_ro[0] == iterset.size
+
 
 @pytest.fixture
 def mset(indset, unitset):
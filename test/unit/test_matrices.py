@@ -34,15 +34,23 @@
 from __future__ import absolute_import, print_function, division
 from six.moves import range, zip
 
+import subprocess
+import sys
 import pytest
 import numpy as np
 from numpy.testing import assert_allclose
 
 from pyop2 import op2
+from pyop2.configuration import configuration
 from pyop2.exceptions import MapValueError, ModeValueError
 
 from coffee.base import *
 
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
 # Data type
 valuetype = np.float64
 
@@ -56,6 +64,46 @@ elem_node_map = np.asarray([0, 1, 3, 2, 3, 1], dtype=np.uint32)
 
 xtr_elem_node_map = np.asarray([0, 1, 11, 12, 33, 34, 22, 23, 33, 34, 11, 12], dtype=np.uint32)
 
+# Assembles a matrix over a line of three elements, distributed over
+# two processes so that both add to rows owned by the other, zeroing
+# it before each assembly, and checks the owned rows.
+reassemble_parallel_script = """
+import sys
+import numpy as np
+from pyop2 import op2
+from pyop2.datatypes import IntType
+from pyop2.mpi import COMM_WORLD as comm
+
+op2.init(lazy_evaluation=sys.argv[1] == "lazy")
+assert comm.size == 2
+if comm.rank == 0:
+    # Owns elements 0, 1 and nodes 0, 1; executes element 2 in its
+    # exec halo, touching halo nodes 2, 3.
+    node_sizes, numbering, sends, receives = [1, 2, 4, 4], [0, 1, 2, 3], {1: [1]}, {1: [2, 3]}
+    elem_sizes, values = [1, 2, 3, 3], [0, 1, 1, 2, 2, 3]
+else:
+    # Owns element 2 and nodes 3, 2; executes element 1 in its exec
+    # halo, touching halo node 1.
+    node_sizes, numbering, sends, receives = [1, 2, 3, 3], [3, 2, 1], {0: [1, 0]}, {0: [2]}
+    elem_sizes, values = [1, 1, 2, 2], [1, 0, 2, 1]
+nodes = op2.Set(node_sizes, halo=op2.Halo(sends, receives, comm=comm,
+                                          gnn2unn=np.asarray(numbering, dtype=IntType)))
+elements = op2.Set(elem_sizes, halo=op2.Halo({}, {}, comm=comm))
+elem_node = op2.Map(elements, nodes, 2, values)
+mat = op2.Mat(op2.Sparsity((nodes, nodes), (elem_node, elem_node)), np.float64)
+kernel = op2.Kernel(\"\"\"void k(double A[2][2]) {
+  for (int i = 0; i < 2; i++) for (int j = 0; j < 2; j++) A[i][j] += 1.0;
+}\"\"\", "k")
+expected = np.array([[1, 1, 0, 0], [1, 2, 1, 0], [0, 1, 2, 1], [0, 0, 1, 1]], dtype=np.float64)
+for _ in range(3):
+    mat.zero()
+    op2.par_loop(kernel, elements, mat(op2.INC, (elem_node[op2.i[0]], elem_node[op2.i[1]])))
+    mat.assemble()
+    mat._force_evaluation()
+    start, end = mat.handle.getOwnershipRange()
+    assert np.allclose(mat.handle.getValues(range(start, end), range(4)), expected[start:end])
+"""
+
 
 @pytest.fixture(scope='module')
 def nodes():
@@ -554,6 +602,87 @@ class TestSparsity:
         assert all(sparsity._colidx == [0, 1, 3, 4, 0, 1, 2, 4, 1, 2,
                                         3, 4, 0, 2, 3, 4, 0, 1, 2, 3, 4])
 
+    @pytest.mark.parametrize(("option", "value"),
+                             [("sparsity_threads", 3),
+                              ("sparsity_builder", "sort")])
+    def test_build_sparsity_alternative(self, option, value):
+        """Building a sparsity with several threads or by sorting should
+        give the same pattern as the default builder."""
+        elements = op2.Set(4)
+        nodes = op2.Set(5)
+        elem_node = op2.Map(elements, nodes, 3, [0, 4, 3, 0, 1, 4,
+                                                 1, 2, 4, 2, 3, 4])
+        old = configuration[option]
+        configuration[option] = value
+        try:
+            sparsity = op2.Sparsity((nodes, nodes), (elem_node, elem_node))
+        finally:
+            configuration[option] = old
+        assert all(sparsity.nnz == [4, 4, 4, 4, 5])
+        assert all(sparsity._rowptr == [0, 4, 8, 12, 16, 21])
+        assert all(sparsity._colidx == [0, 1, 3, 4, 0, 1, 2, 4, 1, 2,
+                                        3, 4, 0, 2, 3, 4, 0, 1, 2, 3, 4])
+
+    def test_sparsity_csr_offsets(self):
+        """The CSR offsets for a pair of maps should give the positions
+        of the entries of every element matrix, and be cached."""
+        elements = op2.Set(4)
+        nodes = op2.Set(5)
+        elem_node = op2.Map(elements, nodes, 3, [0, 4, 3, 0, 1, 4,
+                                                 1, 2, 4, 2, 3, 4])
+        sparsity = op2.Sparsity((nodes, nodes), (elem_node, elem_node))
+        offsets = sparsity._csr_offsets(elem_node, elem_node)
+        rows = np.repeat(np.arange(5), np.diff(sparsity.rowptr))
+        values = elem_node.values
+        assert offsets.shape == (4, 9)
+        assert (rows[offsets] == np.repeat(values, 3, axis=1)).all()
+        assert (sparsity.colidx[offsets] == np.tile(values, (1, 3))).all()
+        assert sparsity._csr_offsets(elem_node, elem_node) is offsets
+
+    def test_sparsity_thread_partition(self):
+        """Partitioning the rows between threads should give each the
+        value positions of a contiguous block of rows, and every
+        element referencing a row in its block."""
+        elements = op2.Set(4)
+        nodes = op2.Set(5)
+        elem_node = op2.Map(elements, nodes, 3, [0, 4, 3, 0, 1, 4,
+                                                 1, 2, 4, 2, 3, 4])
+        sparsity = op2.Sparsity((nodes, nodes), (elem_node, elem_node))
+        values, offsets, elems = sparsity._thread_partition(elem_node, 2)
+        assert values[0] == 0 and values[-1] == len(sparsity.colidx)
+        assert set(values[1:-1]) <= set(sparsity.rowptr)
+        rows = np.repeat(np.arange(5), np.diff(sparsity.rowptr))
+        for t in range(2):
+            owned = rows[values[t]:values[t + 1]]
+            touching = [e for e in range(4) if np.isin(elem_node.values[e], owned).any()]
+            assert list(elems[offsets[t]:offsets[t + 1]]) == touching
+        assert sparsity._thread_partition(elem_node, 2)[0] is values
+
+    def test_sparsity_disk_cache(self, tmpdir):
+        """A sparsity built from maps with the same values should be
+        read back from the on-disk cache."""
+        elements = op2.Set(4)
+        nodes = op2.Set(5)
+        values = [0, 4, 3, 0, 1, 4, 1, 2, 4, 2, 3, 4]
+        old = configuration["sparsity_disk_cache"], configuration["cache_dir"]
+        configuration["sparsity_disk_cache"] = True
+        configuration["cache_dir"] = str(tmpdir)
+        try:
+            m1 = op2.Map(elements, nodes, 3, values)
+            s1 = op2.Sparsity((nodes, nodes), (m1, m1))
+            assert len(tmpdir.join("sparsity").listdir()) == 1
+            m2 = op2.Map(elements, nodes, 3, values)
+            s2 = op2.Sparsity((nodes, nodes), (m2, m2))
+            assert s1 is not s2
+            assert len(tmpdir.join("sparsity").listdir()) == 1
+        finally:
+            configuration["sparsity_disk_cache"], configuration["cache_dir"] = old
+        # Read-only, since it is mapped from the cache file
+        assert not s2._rowptr.flags["WRITEABLE"]
+        assert all(s2.nnz == s1.nnz)
+        assert all(s2._rowptr == [0, 4, 8, 12, 16, 21])
+        assert all(s2._colidx == s1._colidx)
+
     def test_build_mixed_sparsity(self, msparsity):
         """Building a sparsity from a pair of mixed maps should give the
         expected rowptr and colidx for each block."""
@@ -633,6 +762,21 @@ class TestMatrices:
         mat.assemble()
         assert (mat.values == np.identity(nrows * n)).all()
 
+    @pytest.mark.parametrize('n', [1, 2])
+    def test_mat_initial_pattern(self, nodes, elem_node, n):
+        """A new matrix should be assembled, zero, and have the
+        nonzero structure of its sparsity."""
+        sparsity = op2.Sparsity(nodes**n, elem_node)
+        mat = op2.Mat(sparsity, valuetype)
+        assert mat.handle.assembled
+        rowptr, colidx, values = mat.handle.getValuesCSR()
+        if n == 1 or not sparsity._block_sparse:
+            assert all(rowptr == sparsity.rowptr)
+            assert all(colidx == sparsity.colidx)
+        else:
+            assert len(values) == sparsity.nz * n * n
+        assert (values == 0).all()
+
     def test_mat_always_has_diagonal_space(self):
         # A sparsity should always have space for diagonal entries
         s = op2.Set(1)
@@ -686,6 +830,143 @@ class TestMatrices:
         eps = 1.e-5
         assert_allclose(mat.values, expected_matrix, eps)
 
+    def test_reassemble_mat(self, mass, mat, coords, elements,
+                            elem_node, expected_matrix):
+        """Reassembling a matrix after zeroing it should give the same
+        result each time."""
+        for _ in range(2):
+            mat.zero()
+            op2.par_loop(mass, elements,
+                         mat(op2.INC, (elem_node[op2.i[0]], elem_node[op2.i[1]])),
+                         coords(op2.READ, elem_node))
+            mat.assemble()
+            eps = 1.e-5
+            assert_allclose(mat.values, expected_matrix, eps)
+
+    @pytest.mark.skipif(which("mpiexec") is None, reason="mpiexec required to test in parallel")
+    def test_reassemble_mat_parallel(self, tmpdir):
+        """Reassembling a distributed matrix after zeroing it should
+        drop the contributions to rows owned by other processes each
+        time."""
+        script = tmpdir.join("reassemble.py")
+        script.write(reassemble_parallel_script)
+        mode = "lazy" if configuration["lazy_evaluation"] else "greedy"
+        subprocess.check_call(["mpiexec", "-n", "2", sys.executable, str(script), mode])
+
+    def test_assemble_mat_batched(self, mass, mat, coords, elements,
+                                  elem_node, expected_matrix):
+        """Assembling a matrix with batched insertion of the element
+        matrices should give the same result."""
+        mat.zero()
+        loop = op2.par_loop(mass, elements,
+                            mat(op2.INC, (elem_node[op2.i[0]], elem_node[op2.i[1]])),
+                            coords(op2.READ, elem_node),
+                            mat_insertion_batch=3)
+        assert loop.mat_insertion_batch == 3
+        mat.assemble()
+        eps = 1.e-5
+        assert_allclose(mat.values, expected_matrix, eps)
+
+    def test_assemble_vec_mat_batched(self, elements, elem_node, dvnodes):
+        """Assembling a vector-valued matrix with batched insertion should
+        give the same result as inserting each element matrix."""
+        kernel = op2.Kernel("""void k(double A[6][6]) {
+  for (int i = 0; i < 6; i++) for (int j = 0; j < 6; j++) A[i][j] += 1 + 6 * i + j;
+}""", "k")
+        values = []
+        for batch in [0, 3]:
+            sparsity = op2.Sparsity((dvnodes, dvnodes), (elem_node, elem_node),
+                                    block_sparse=False)
+            mat = op2.Mat(sparsity, valuetype)
+            loop = op2.par_loop(kernel, elements,
+                                mat(op2.INC, (elem_node[op2.i[0]], elem_node[op2.i[1]])),
+                                mat_insertion_batch=batch)
+            assert loop.mat_insertion_batch == batch
+            mat.assemble()
+            values.append(mat.values)
+        assert_allclose(values[0], values[1])
+
+    def test_mat_insertion_batch_block_sparse(self, elements, elem_node, dvnodes):
+        """Element matrices of block sparse vector-valued matrices are
+        inserted blocked rather than batched."""
+        sparsity = op2.Sparsity((dvnodes, dvnodes), (elem_node, elem_node),
+                                block_sparse=True)
+        mat = op2.Mat(sparsity, valuetype)
+        kernel = op2.Kernel("void k(double A[6][6]) { }", "k")
+        loop = op2.par_loop(kernel, elements,
+                            mat(op2.INC, (elem_node[op2.i[0]], elem_node[op2.i[1]])),
+                            mat_insertion_batch=3)
+        assert loop.mat_insertion_batch == 0
+
+    def test_assemble_mat_csr(self, mass, mat, coords, elements,
+                              elem_node, expected_matrix):
+        """Assembling a matrix by adding directly into its value array
+        should give the same result."""
+        mat.zero()
+        loop = op2.par_loop(mass, elements,
+                            mat(op2.INC, (elem_node[op2.i[0]], elem_node[op2.i[1]])),
+                            coords(op2.READ, elem_node),
+                            mat_csr_insertion=True)
+        assert loop.mat_csr_insertion
+        mat.assemble()
+        eps = 1.e-5
+        assert_allclose(mat.values, expected_matrix, eps)
+
+    @pytest.mark.parametrize("nthreads", [2, 3])
+    def test_assemble_mat_threaded(self, mass, mat, coords, elements,
+                                   elem_node, expected_matrix, nthreads):
+        """Assembling a matrix from several threads, each owning a block
+        of rows, should give the same result."""
+        mat.zero()
+        loop = op2.par_loop(mass, elements,
+                            mat(op2.INC, (elem_node[op2.i[0]], elem_node[op2.i[1]])),
+                            coords(op2.READ, elem_node),
+                            mat_assembly_threads=nthreads)
+        assert loop.mat_assembly_threads == nthreads
+        assert loop.mat_csr_insertion
+        mat.assemble()
+        eps = 1.e-5
+        assert_allclose(mat.values, expected_matrix, eps)
+
+    def test_mat_assembly_threads_rhs(self, elements, elem_node, dnodes):
+        """A loop also incrementing a Dat is assembled in serial."""
+        sparsity = op2.Sparsity((dnodes, dnodes), (elem_node, elem_node))
+        mat = op2.Mat(sparsity, valuetype)
+        rhs = op2.Dat(dnodes, dtype=valuetype)
+        kernel = op2.Kernel("void k(double A[3][3], double **b) { }", "k")
+        loop = op2.par_loop(kernel, elements,
+                            mat(op2.INC, (elem_node[op2.i[0]], elem_node[op2.i[1]])),
+                            rhs(op2.INC, elem_node),
+                            mat_assembly_threads=2)
+        assert loop.mat_assembly_threads == 1
+        assert not loop.mat_csr_insertion
+
+    def test_matrix_free_mult(self, mass, coords, elements, elem_node,
+                              dnodes, expected_matrix):
+        """Multiplying by a matrix-free matrix should apply the action
+        of the loop it was given."""
+        sparsity = op2.Sparsity((dnodes, dnodes), (elem_node, elem_node))
+        mf = op2.MatrixFreeMat(sparsity, valuetype, "mf")
+        op2.par_loop(mass, elements,
+                     mf(op2.INC, (elem_node[op2.i[0]], elem_node[op2.i[1]])),
+                     coords(op2.READ, elem_node))
+        x = op2.Dat(dnodes, np.arange(1, NUM_NODES + 1, dtype=valuetype))
+        y = op2.Dat(dnodes, dtype=valuetype)
+        mf.mult(x, y)
+        eps = 1.e-5
+        assert_allclose(y.data_ro, np.dot(expected_matrix, x.data_ro), eps)
+        mf.zero()
+        mf.mult(x, y)
+        assert (y.data_ro == 0).all()
+
+    def test_mat_insertion_batch_write(self, mat, elements, elem_node):
+        """Element matrices written into a matrix are not batched."""
+        kernel = op2.Kernel("void k(double A[3][3]) { }", "k")
+        loop = op2.par_loop(kernel, elements,
+                            mat(op2.WRITE, (elem_node[op2.i[0]], elem_node[op2.i[1]])),
+                            mat_insertion_batch=3)
+        assert loop.mat_insertion_batch == 0
+
     def test_assemble_rhs(self, rhs, elements, b, coords, f,
                           elem_node, expected_rhs):
         """Assemble a simple finite-element right-hand side and check result."""
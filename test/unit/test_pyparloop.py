@@ -38,6 +38,11 @@ import numpy as np
 
 from pyop2 import op2
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 @pytest.fixture
 def s1():
@@ -201,6 +206,166 @@ class TestPyParLoop:
 
         assert (mat.values == expected).all()
 
+    def test_vectorised_direct(self, s1, d1):
+        d1.data[:] = range(4)
+
+        def fn(a):
+            assert a.shape == (4, 1)
+            a[:, 0] *= 2.0
+
+        op2.par_loop(fn, s1, d1(op2.RW), vectorise=True)
+        assert np.allclose(d1.data, 2.0 * np.arange(4))
+
+    def test_vectorised_indirect_inc(self, s1, s2, m2):
+        d = op2.Dat(s2 ** 2, np.ones((4, 2)))
+
+        def fn(a):
+            assert a.shape == (4, 2, 2)
+            a[:, :, 0] += 1.0
+            a[:, :, 1] += 2.0
+
+        op2.par_loop(fn, s1, d(op2.INC, m2), vectorise=True)
+        assert np.allclose(d.data, [[3.0, 5.0]] * 4)
+
+    def test_vectorised_direct_read_indirect_subset(self, s1, d1, d2, m12):
+        subset = op2.Subset(s1, [1, 3])
+        d2.data[:] = range(4)
+        d1.data[:] = 10.0
+
+        def fn(a, b):
+            a[:] = b
+
+        op2.par_loop(fn, subset, d1(op2.WRITE), d2(op2.READ, m12), vectorise=True)
+
+        expect = np.empty_like(d1.data)
+        expect[:] = 10.0
+        expect[subset.indices] = d2.data[m12.values[subset.indices, 0]]
+        assert np.allclose(d1.data, expect)
+
+    def test_vectorised_global_inc(self, s1, d2, m2):
+        d2.data[:] = range(4)
+        g = op2.Global(1, 1.0)
+
+        def fn(s, a):
+            s[0] += a.sum()
+
+        op2.par_loop(fn, s1, g(op2.INC), d2(op2.READ, m2), vectorise=True)
+        assert g.data[0] == 1.0 + 2 * sum(range(4))
+
+    def test_vectorised_cant_write_to_read(self, s1, d1):
+        d1.data[:] = 0.0
+
+        def fn(a):
+            a[:] = 1.0
+
+        with pytest.raises((RuntimeError, ValueError)):
+            op2.par_loop(fn, s1, d1(op2.READ), vectorise=True)
+            assert np.allclose(d1.data, 0.0)
+
+    def test_vectorised_matrix_addto(self, s1, m2, mat):
+
+        def fn(a):
+            assert a.shape == (4, 2, 2)
+            a[:] = 1.0
+
+        expected = np.array([[2., 1., 0., 1.],
+                             [1., 2., 1., 0.],
+                             [0., 1., 2., 1.],
+                             [1., 0., 1., 2.]])
+
+        op2.par_loop(fn, s1, mat(op2.INC, (m2[op2.i[0]], m2[op2.i[0]])), vectorise=True)
+
+        assert (mat.values == expected).all()
+
+
+@pytest.mark.skipif(numba is None, reason="Numba required to compile Python kernels")
+class TestNumbaParLoop:
+
+    """
+    Python par_loop tests compiled with Numba
+    """
+
+    def test_direct(self, s1):
+        d = op2.Dat(s1 ** 2, np.ones((4, 2)))
+
+        def fn(a):
+            a[0] = 2.0 * a[1]
+
+        op2.par_loop(fn, s1, d(op2.RW), numba=True)
+        assert np.allclose(d.data, [[2.0, 1.0]] * 4)
+
+    def test_indirect_inc(self, s1, d2, m2):
+        d2.data[:] = range(4)
+
+        def fn(a):
+            a[0] += 1.0
+            a[1] += 2.0
+
+        op2.par_loop(fn, s1, d2(op2.INC, m2), numba=True)
+        assert np.allclose(d2.data, np.arange(4) + 3.0)
+
+    def test_indirect_read_direct_subset(self, s1, d1, d2, m12):
+        subset = op2.Subset(s1, [1, 3])
+        d1.data[:] = range(4)
+        d2.data[:] = 10.0
+
+        def fn(a, b):
+            a[0] = b[0]
+
+        op2.par_loop(fn, subset, d2(op2.WRITE, m12), d1(op2.READ), numba=True)
+
+        expect = np.empty_like(d2.data)
+        expect[:] = 10.0
+        expect[m12.values[subset.indices, 0]] = d1.data[subset.indices]
+        assert np.allclose(d2.data, expect)
+
+    def test_global_inc(self, s1, d2, m12):
+        d2.data[:] = range(4)
+        g = op2.Global(1, 1.0)
+
+        def fn(s, a):
+            s[0] += a[0]
+
+        op2.par_loop(fn, s1, g(op2.INC), d2(op2.READ, m12[0]), numba=True)
+        assert g.data[0] == 1.0 + sum(range(4))
+
+    def test_driver_cached(self, s1, d1, d2, m12):
+        from pyop2.pyparloop import NumbaDriver
+        d2.data[:] = range(4)
+
+        def fn(a, b):
+            a[0] = b[0]
+
+        op2.par_loop(fn, s1, d1(op2.WRITE), d2(op2.READ, m12), numba=True)
+        assert np.allclose(d1.data, d2.data[m12.values[:, 0]])
+        ndrivers = len(NumbaDriver._cache)
+        d3 = op2.Dat(d2.dataset, np.arange(4.0, 8.0))
+        op2.par_loop(fn, s1, d1(op2.WRITE), d3(op2.READ, m12), numba=True)
+        assert np.allclose(d1.data, d3.data[m12.values[:, 0]])
+        assert len(NumbaDriver._cache) == ndrivers
+
+    def test_matrix_addto(self, s1, m2, mat):
+
+        def fn(a):
+            a[:, :] = 1.0
+
+        expected = np.array([[2., 1., 0., 1.],
+                             [1., 2., 1., 0.],
+                             [0., 1., 2., 1.],
+                             [1., 0., 1., 2.]])
+
+        op2.par_loop(fn, s1, mat(op2.INC, (m2[op2.i[0]], m2[op2.i[0]])), numba=True)
+
+        assert (mat.values == expected).all()
+
+    def test_cant_vectorise(self, s1, d1):
+
+        def fn(a):
+            a[:] = 1.0
+
+        with pytest.raises(ValueError):
+            op2.par_loop(fn, s1, d1(op2.WRITE), numba=True, vectorise=True)
+
 
 if __name__ == '__main__':
     import os
@@ -33,10 +33,13 @@
 
 from __future__ import absolute_import, print_function, division
 
+import gc
 import pytest
+import weakref
 import numpy as np
 
 from pyop2 import op2
+from pyop2.exceptions import SetValueError
 
 from coffee.base import *
 
@@ -210,6 +213,59 @@ inc(unsigned int* v1, unsigned int* v2) {
         assert np.sum(dat1.data) == nelems
         assert np.sum(dat2.data) == nelems
 
+    @pytest.mark.parametrize(('indices', 'layout'),
+                             [(list(range(4, 12)) + list(range(20, 28)), "ranges"),
+                              ([i for i in range(nelems) if i % 3], "bitmask"),
+                              ([1, 17, 30], "indices")])
+    def test_subset_layout(self, iterset, indices, layout):
+        """Subsets should be stored compactly and iterated over correctly
+        whatever their layout."""
+        ss = op2.Subset(iterset, indices)
+        assert ss._layout == layout
+        assert (ss.indices == indices).all()
+
+        d = op2.Dat(iterset ** 1, data=None, dtype=np.uint32)
+        k = op2.Kernel("void inc(unsigned int* v) { *v += 1; }", "inc")
+        op2.par_loop(k, ss, d(op2.RW))
+        inds, = np.where(d.data)
+        assert (inds == indices).all()
+        assert (d.data[inds] == 1).all()
+
+    def test_subset_algebra(self, iterset):
+        """Set algebra on Subsets should match NumPy's and be memoized
+        on the operands."""
+        a = np.array([0, 3, 4, 7, 9, 12, 15, 16], dtype=np.int32)
+        b = np.array([1, 3, 7, 8, 15, 20], dtype=np.int32)
+        ssa = op2.Subset(iterset, a)
+        ssb = op2.Subset(iterset, b)
+        assert (ssa.intersection(ssb).indices == np.intersect1d(a, b)).all()
+        assert (ssa.union(ssb).indices == np.union1d(a, b)).all()
+        assert (ssa.difference(ssb).indices == np.setdiff1d(a, b)).all()
+        assert (ssa.complement().indices ==
+                np.setdiff1d(np.arange(iterset.total_size), a)).all()
+        assert ssa & ssb is ssb & ssa
+        assert ssa | ssb is ssb | ssa
+        assert ssa - ssb is ssa.difference(ssb)
+        assert ~ssa is ssa.complement()
+        assert (ssa | ~ssa).sizes == iterset.sizes
+
+    def test_subset_algebra_frees_operands(self, iterset):
+        """Memoizing set algebra should not keep its operands or result
+        alive."""
+        ssa = op2.Subset(iterset, [0, 1, 2])
+        ssb = op2.Subset(iterset, [1, 2, 3])
+        refs = [weakref.ref(ssb), weakref.ref(ssa & ssb), weakref.ref(ssb - ssa)]
+        del ssb
+        gc.collect()
+        assert all(ref() is None for ref in refs)
+        assert not any(ssa._algebra_cache.values())
+
+    def test_subset_algebra_superset_mismatch(self, iterset):
+        """Set algebra on Subsets of different supersets should fail."""
+        other = op2.Set(nelems)
+        with pytest.raises(SetValueError):
+            op2.Subset(iterset, [0, 1]) & op2.Subset(other, [0, 1])
+
     def test_matrix(self):
         """Test a indirect par_loop with a matrix argument"""
         iterset = op2.Set(2)